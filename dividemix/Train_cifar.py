@@ -39,6 +39,7 @@ parser.add_argument('--dataset', default='cifar10', type=str)
 parser.add_argument('--distill', default=None, type=str, help='use "dynamic" for robust training')
 parser.add_argument('--distill_mode', type=str, default='eigen', choices=['kmeans','fine-kmeans','fine-gmm'], help='mode for distillation kmeans or eigen.')
 parser.add_argument('--refinement', action='store_true', help='use refined label if in teacher_idx')
+parser.add_argument('--batch_augment', action='store_true', help='crop, flip and normalize whole uint8 batches in the loaders instead of per-sample PIL transforms')
 
 args = parser.parse_args()
 
@@ -174,16 +175,17 @@ def test(epoch,net1,net2):
     test_log.flush()
     return acc
 
-def eval_train(model,all_loss):    
-    model.eval()
-    losses = torch.zeros(50000)    
-    with torch.no_grad():
-        for batch_idx, (inputs, targets, index) in enumerate(eval_loader):
-            inputs, targets = inputs.cuda(), targets.cuda() 
-            outputs = model(inputs) 
-            loss = CE(outputs, targets)  
-            for b in range(inputs.size(0)):
-                losses[index[b]]=loss[b]         
+def eval_train(model,all_loss,losses=None):    
+    if losses is None: # not already collected by get_census
+        model.eval()
+        losses = torch.zeros(50000)    
+        with torch.no_grad():
+            for batch_idx, (inputs, targets, index) in enumerate(eval_loader):
+                inputs, targets = inputs.cuda(), targets.cuda() 
+                outputs = model(inputs) 
+                loss = CE(outputs, targets)  
+                for b in range(inputs.size(0)):
+                    losses[index[b]]=loss[b]         
     losses = (losses-losses.min())/(losses.max()-losses.min())    
     all_loss.append(losses)
 
@@ -268,39 +270,60 @@ def get_singular_vector(features, labels):
 
     return singular_vector_dict    
     
-def get_features(model, dataloader):
+def get_census(model, dataloader):
     '''
-    Concatenate the hidden features and corresponding labels 
+    One pass collecting the hidden features, labels and per-sample CE losses,
+    addressed by the sample indices, so fine and the loss GMM share a single forward
     '''
-    labels = np.empty((0,))
+    num = len(dataloader.dataset)
+    features = None
+    labels = np.zeros(num, dtype=np.int64)
+    losses = torch.zeros(num)
 
     model.eval()
     model.cuda()
-    with tqdm(dataloader) as progress:
+    with torch.no_grad(), tqdm(dataloader) as progress:
         for batch_idx, (data, label, index) in enumerate(progress):
-            data, label = data.cuda(), label.long()
+            data, label = data.cuda(), label.long().cuda()
             feature = model.forward(data, lout=4)
             feature = F.avg_pool2d(feature, 4)
             feature = feature.view(feature.size(0), -1)
+            outputs = model.linear(feature)
             
-            labels = np.concatenate((labels, label.cpu()))
-            if batch_idx == 0:
-                features = feature.detach().cpu()
-            else:
-                features = np.concatenate((features, feature.detach().cpu()), axis=0)
+            if features is None:
+                features = np.zeros((num, feature.size(1)), dtype=np.float32)
+            features[index.numpy()] = feature.cpu().numpy()
+            labels[index.numpy()] = label.cpu().numpy()
+            losses[index] = CE(outputs, label).cpu()
     
+    return features, labels, losses
+
+def get_features(model, dataloader):
+    '''
+    The hidden features and corresponding labels, read from the census
+    '''
+    features, labels, _ = get_census(model, dataloader)
     return features, labels
 
-def get_score(singular_vector_dict, features, labels, normalization=True):
+def get_score(singular_vector_dict, features, labels, normalization=True, chunk_size=65536):
     '''
     Calculate the score providing the degree of showing whether the data is clean or not.
+    The class vectors are gathered into one (C, d) matrix and the features are scored chunk by chunk.
+    A copy of dynamic_selection/selection/svd_classifier.py:get_score, keep the two in sync.
     '''
-    if normalization:
-        scores = [np.abs(np.inner(singular_vector_dict[labels[indx]], feat/np.linalg.norm(feat))) for indx, feat in enumerate(tqdm(features))]
-    else:
-        scores = [np.abs(np.inner(singular_vector_dict[labels[indx]], feat)) for indx, feat in enumerate(tqdm(features))]    
+    # the vector of every label class, a label without a vector raises a KeyError
+    classes, rows = np.unique(np.asarray(labels), return_inverse=True)
+    vectors = np.stack([singular_vector_dict[cls] for cls in classes])
+    features = np.asarray(features)
+
+    scores = np.empty(len(features), dtype=np.result_type(vectors, features))
+    for start in tqdm(range(0, len(features), chunk_size)):
+        feats = features[start:start+chunk_size]
+        if normalization:
+            feats = feats / np.linalg.norm(feats, axis=1, keepdims=True)
+        scores[start:start+chunk_size] = np.abs(np.einsum('ij,ij->i', vectors[rows[start:start+chunk_size]], feats))
     
-    return np.array(scores)
+    return scores
     
 def fit_mixture(scores, labels, p_threshold=0.5):
     '''
@@ -393,17 +416,17 @@ def extract_cleanidx(model, loader, mode='fine-kmeans', p_threshold=0.6):
         
     # get teacher_idx
     if 'fine' in mode:
-        features, labels = get_features(model, loader)
+        features, labels, losses = get_census(model, loader)
         teacher_idx, probs = fine(current_features=features, current_labels=labels, fit = mode, p_threshold=p_threshold)
     else: # get teacher _idx via kmeans
         teacher_idx = get_loss_list(model, loader)
-        probs = None
+        probs, losses = None, None
         
     for params in model.parameters(): params.requires_grad = True
     model.train()
     
     teacher_idx = torch.tensor(teacher_idx)
-    return teacher_idx, probs
+    return teacher_idx, probs, losses
     
 
 if args.distill:
@@ -426,7 +449,7 @@ elif args.dataset=='cifar100':
 
     
 loader = dataloader.cifar_dataloader(args.dataset,r=args.r,noise_mode=args.noise_mode,batch_size=args.batch_size,num_workers=5,\
-    root_dir=args.data_path,log=stats_log,noise_file='%s/%.1f_%s.json'%(args.data_path,args.r,args.noise_mode))
+    root_dir=args.data_path,log=stats_log,noise_file='%s/%.1f_%s.json'%(args.data_path,args.r,args.noise_mode),batch_augment=args.batch_augment)
 
 print('| Building net')
 net1 = create_model()
@@ -469,8 +492,8 @@ for epoch in range(args.num_epochs+1):
 #     root_dir=args.data_path,log=stats_log,noise_file='%s/%.1f_%s.json'%(args.data_path,args.r,args.noise_mode))
 #             all_loader = loader.run('warmup')
         
-            teacher_idx_1, prob1_dict = extract_cleanidx(net1, eval_loader, mode=args.distill_mode, p_threshold=args.p_threshold)
-            teacher_idx_2, prob2_dict = extract_cleanidx(net2, eval_loader, mode=args.distill_mode, p_threshold=args.p_threshold)
+            teacher_idx_1, prob1_dict, loss1 = extract_cleanidx(net1, eval_loader, mode=args.distill_mode, p_threshold=args.p_threshold)
+            teacher_idx_2, prob2_dict, loss2 = extract_cleanidx(net2, eval_loader, mode=args.distill_mode, p_threshold=args.p_threshold)
             
             pred1, pred2 = np.zeros(50000, dtype=bool), np.zeros(50000, dtype=bool)
             prob1, prob2 = np.zeros(50000), np.zeros(50000)
@@ -486,8 +509,8 @@ for epoch in range(args.num_epochs+1):
             
             if args.refinement:
                 
-                prob1,all_loss[0]=eval_train(net1,all_loss[0])   
-                prob2,all_loss[1]=eval_train(net2,all_loss[1])          
+                prob1,all_loss[0]=eval_train(net1,all_loss[0],losses=loss1)   
+                prob2,all_loss[1]=eval_train(net2,all_loss[1],losses=loss2)          
 
                 pred1 = (prob1 > args.p_threshold)      
                 pred2 = (prob2 > args.p_threshold)
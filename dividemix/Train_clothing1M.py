@@ -30,6 +30,9 @@ parser.add_argument('--T', default=0.5, type=float, help='sharpening temperature
 parser.add_argument('--num_epochs', default=80, type=int)
 parser.add_argument('--id', default='clothing1m')
 parser.add_argument('--data_path', default='../../Clothing1M/data', type=str, help='path to dataset')
+parser.add_argument('--shard_dir', default=None, type=str, help='pre-decoded image shards (dynamic_selection/data_loader/shards.py)')
+parser.add_argument('--jpeg_draft', action='store_true', help='decode JPEGs at the smallest DCT scale covering the resize')
+parser.add_argument('--tar_dir', default=None, type=str, help='tar shards to stream the training images from (dynamic_selection/data_loader/tar_stream.py)')
 parser.add_argument('--seed', default=123)
 parser.add_argument('--gpuid', default=0, type=int)
 parser.add_argument('--num_class', default=14, type=int)
@@ -237,16 +240,25 @@ def get_features(model, dataloader):
     
     return features, labels, paths
 
-def get_score(singular_vector_dict, features, labels, normalization=True):
+def get_score(singular_vector_dict, features, labels, normalization=True, chunk_size=65536):
     '''
     Calculate the score providing the degree of showing whether the data is clean or not.
+    The class vectors are gathered into one (C, d) matrix and the features are scored chunk by chunk.
+    A copy of dynamic_selection/selection/svd_classifier.py:get_score, keep the two in sync.
     '''
-    if normalization:
-        scores = [np.abs(np.inner(singular_vector_dict[labels[indx]], feat/np.linalg.norm(feat))) for indx, feat in enumerate(tqdm(features))]
-    else:
-        scores = [np.abs(np.inner(singular_vector_dict[labels[indx]], feat)) for indx, feat in enumerate(tqdm(features))]    
+    # the vector of every label class, a label without a vector raises a KeyError
+    classes, rows = np.unique(np.asarray(labels), return_inverse=True)
+    vectors = np.stack([singular_vector_dict[cls] for cls in classes])
+    features = np.asarray(features)
+
+    scores = np.empty(len(features), dtype=np.result_type(vectors, features))
+    for start in tqdm(range(0, len(features), chunk_size)):
+        feats = features[start:start+chunk_size]
+        if normalization:
+            feats = feats / np.linalg.norm(feats, axis=1, keepdims=True)
+        scores[start:start+chunk_size] = np.abs(np.einsum('ij,ij->i', vectors[rows[start:start+chunk_size]], feats))
     
-    return np.array(scores)
+    return scores
     
 def fit_mixture(scores, labels, p_threshold=0.5):
     '''
@@ -355,7 +367,7 @@ def extract_cleanidx(model, loader, mode='fine-kmeans', p_threshold=0.6):
 
 log=open('./checkpoint/%s.txt'%args.id,'w')     
 log.flush()
-loader = dataloader.clothing_dataloader(root=args.data_path,batch_size=args.batch_size,num_workers=5,num_batches=args.num_batches)
+loader = dataloader.clothing_dataloader(root=args.data_path,batch_size=args.batch_size,num_workers=5,num_batches=args.num_batches,seed=int(args.seed),shard_dir=args.shard_dir,jpeg_draft=args.jpeg_draft,tar_dir=args.tar_dir)
 print('| Building net')
 net1 = create_model()
 net2 = create_model()
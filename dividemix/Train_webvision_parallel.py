@@ -31,6 +31,9 @@ parser.add_argument('--gpuid1', default=0, type=int)
 parser.add_argument('--gpuid2', default=2, type=int)
 parser.add_argument('--num_class', default=50, type=int)
 parser.add_argument('--data_path', default='./dataset/', type=str, help='path to dataset')
+parser.add_argument('--shard_dir', default=None, type=str, help='pre-decoded image shards (dynamic_selection/data_loader/shards.py)')
+parser.add_argument('--jpeg_draft', action='store_true', help='decode JPEGs at the smallest DCT scale covering the resize')
+parser.add_argument('--tar_dir', default=None, type=str, help='tar shards to stream the training images from (dynamic_selection/data_loader/tar_stream.py)')
 
 parser.add_argument('--distill', default=None, type=str, help='use "dynamic" for robust training')
 parser.add_argument('--distill_mode', type=str, default='fine-gmm', choices=['kmeans','fine-kmeans','fine-gmm'], help='mode for distillation kmeans or eigen.')
@@ -259,16 +262,25 @@ def get_features(model, dataloader, device):
     
     return features, labels, paths
 
-def get_score(singular_vector_dict, features, labels, normalization=True):
+def get_score(singular_vector_dict, features, labels, normalization=True, chunk_size=65536):
     '''
     Calculate the score providing the degree of showing whether the data is clean or not.
+    The class vectors are gathered into one (C, d) matrix and the features are scored chunk by chunk.
+    A copy of dynamic_selection/selection/svd_classifier.py:get_score, keep the two in sync.
     '''
-    if normalization:
-        scores = [np.abs(np.inner(singular_vector_dict[labels[indx]], feat/np.linalg.norm(feat))) for indx, feat in enumerate(tqdm(features))]
-    else:
-        scores = [np.abs(np.inner(singular_vector_dict[labels[indx]], feat)) for indx, feat in enumerate(tqdm(features))]    
+    # the vector of every label class, a label without a vector raises a KeyError
+    classes, rows = np.unique(np.asarray(labels), return_inverse=True)
+    vectors = np.stack([singular_vector_dict[cls] for cls in classes])
+    features = np.asarray(features)
+
+    scores = np.empty(len(features), dtype=np.result_type(vectors, features))
+    for start in tqdm(range(0, len(features), chunk_size)):
+        feats = features[start:start+chunk_size]
+        if normalization:
+            feats = feats / np.linalg.norm(feats, axis=1, keepdims=True)
+        scores[start:start+chunk_size] = np.abs(np.einsum('ij,ij->i', vectors[rows[start:start+chunk_size]], feats))
     
-    return np.array(scores)
+    return scores
     
 def fit_mixture(scores, labels, p_threshold=0.5):
     '''
@@ -386,7 +398,7 @@ if __name__ == "__main__":
     warm_up=-1
     data_num = None
 
-    loader = dataloader.webvision_dataloader(batch_size=args.batch_size,num_class = args.num_class,num_workers=8,root_dir=args.data_path,log=stats_log)
+    loader = dataloader.webvision_dataloader(batch_size=args.batch_size,num_class = args.num_class,num_workers=8,root_dir=args.data_path,log=stats_log,shard_dir=args.shard_dir,jpeg_draft=args.jpeg_draft,tar_dir=args.tar_dir)
 
     print('| Building net')
     
@@ -1,4 +1,5 @@
 from torch.utils.data import Dataset, DataLoader
+from torch.utils.data.dataloader import default_collate
 import torchvision.transforms as transforms
 import random
 import numpy as np
@@ -17,6 +18,55 @@ def fix_seed(seed=888):
     torch.backends.cudnn.deterministic = True
     np.random.seed(seed)
             
+class BatchAugment(object):
+    '''
+    RandomCrop(padding) + RandomHorizontalFlip + ToTensor + Normalize on a whole uint8 batch (N, H, W, C).
+    Crop offsets and flips are drawn per sample and applied in one gather, the scaling to [0, 1] is fused
+    into the normalization. Returns a float (N, C, H, W) batch, or a list of views independently augmented batches.
+    A copy of dynamic_selection/data_loader/augment.py:BatchAugment, keep the two in sync.
+    '''
+    def __init__(self, mean, std, padding=0, flip=False, views=1):
+        self.scale = 1. / (255. * torch.tensor(std, dtype=torch.float32).view(1, -1, 1, 1))
+        self.shift = (torch.tensor(mean, dtype=torch.float32) / torch.tensor(std, dtype=torch.float32)).view(1, -1, 1, 1)
+        self.padding = padding
+        self.flip = flip
+        self.views = views
+
+    def __call__(self, images):
+        n, h, w, _ = images.shape
+        images = images.permute(0, 3, 1, 2)
+        if self.padding:
+            images = torch.nn.functional.pad(images, (self.padding,) * 4)
+
+        outputs = []
+        for _ in range(self.views):
+            rows = torch.arange(h).expand(n, h)
+            cols = torch.arange(w).expand(n, w)
+            if self.padding:
+                rows = rows + torch.randint(0, 2 * self.padding + 1, (n, 1))
+                cols = cols + torch.randint(0, 2 * self.padding + 1, (n, 1))
+            if self.flip:
+                cols = torch.where(torch.rand(n, 1) < 0.5, cols.flip(1), cols)
+            out = images[torch.arange(n)[:, None, None], :, rows[:, :, None], cols[:, None, :]]
+            out = out.permute(0, 3, 1, 2).float().mul_(self.scale).sub_(self.shift)
+            outputs.append(out.contiguous())
+
+        return outputs[0] if self.views == 1 else outputs
+
+class BatchAugmentCollate(object):
+    '''
+    collate_fn that augments the uint8 images (first field of every sample) after collation,
+    the views of a multi-view augment replace the image field in order
+    A copy of dynamic_selection/data_loader/augment.py:BatchAugmentCollate, keep the two in sync.
+    '''
+    def __init__(self, augment):
+        self.augment = augment
+
+    def __call__(self, samples):
+        batch = list(default_collate(samples))
+        views = self.augment(batch[0])
+        return (views if isinstance(views, list) else [views]) + batch[1:]
+
 def unpickle(file):
     import _pickle as cPickle
     with open(file, 'rb') as fo:
@@ -168,6 +218,18 @@ class cifar_dataset(Dataset):
 
                 
     def __getitem__(self, index):
+        if self.transform is None:
+            # raw uint8 image, the loader augments (and makes the two views of) whole batches
+            img = self.train_data[index] if self.mode!='test' else self.test_data[index]
+            img = torch.from_numpy(img)
+            if self.mode=='labeled' or self.mode=='labeled_svd':
+                return img, self.noise_label[index], self.probability[index]
+            elif self.mode=='unlabeled' or self.mode=='unlabeled_svd':
+                return (img,)
+            elif self.mode=='all':
+                return img, self.noise_label[index], index
+            elif self.mode=='test':
+                return img, self.test_label[index]
         if self.mode=='labeled' or self.mode=='labeled_svd':
             img, target, prob = self.train_data[index], self.noise_label[index], self.probability[index]
             img = Image.fromarray(img)
@@ -222,7 +284,7 @@ class cifar_dataset(Dataset):
         
         
 class cifar_dataloader():  
-    def __init__(self, dataset, r, noise_mode, batch_size, num_workers, root_dir, log, noise_file='', _teacher_idx=None, _truncate_mode=None):
+    def __init__(self, dataset, r, noise_mode, batch_size, num_workers, root_dir, log, noise_file='', _teacher_idx=None, _truncate_mode=None, batch_augment=False):
         self.dataset = dataset
         self.r = r
         self.noise_mode = noise_mode
@@ -255,6 +317,18 @@ class cifar_dataloader():
                     transforms.ToTensor(),
                     transforms.Normalize((0.507, 0.487, 0.441), (0.267, 0.256, 0.276)),
                 ])   
+        # batch_augment: the datasets return uint8 images and the loaders crop, flip and normalize whole batches
+        self.batch_augment = batch_augment
+        mean, std = ((0.4914, 0.4822, 0.4465),(0.2023, 0.1994, 0.2010)) if self.dataset=='cifar10' else ((0.507, 0.487, 0.441), (0.267, 0.256, 0.276))
+        self.collate_train = BatchAugmentCollate(BatchAugment(mean, std, padding=4, flip=True))
+        self.collate_train_views = BatchAugmentCollate(BatchAugment(mean, std, padding=4, flip=True, views=2))
+        self.collate_test = BatchAugmentCollate(BatchAugment(mean, std))
+        if self.batch_augment:
+            self.transform_train = self.transform_test = None
+            
+    def collate(self, name):
+        return getattr(self, 'collate_' + name) if self.batch_augment else default_collate
+        
     def print_statistics(self, teacher_idx):
         all_dataset = cifar_dataset(dataset=self.dataset, noise_mode=self.noise_mode, r=self.r, root_dir=self.root_dir, transform=self.transform_train, mode="all",noise_file=self.noise_file,teacher_idx=self.teacher_idx,truncate_mode=self.truncate_mode)
         all_dataset._print_statistics(teacher_idx)
@@ -266,7 +340,8 @@ class cifar_dataloader():
                 dataset=all_dataset, 
                 batch_size=self.batch_size*2,
                 shuffle=True,
-                num_workers=self.num_workers)             
+                num_workers=self.num_workers,
+                collate_fn=self.collate('train'))
             return trainloader
         
         elif mode=='train_svd':
@@ -275,14 +350,16 @@ class cifar_dataloader():
                 dataset=labeled_dataset, 
                 batch_size=self.batch_size,
                 shuffle=True,
-                num_workers=self.num_workers)
+                num_workers=self.num_workers,
+                collate_fn=self.collate('train_views'))
             
             unlabeled_dataset = cifar_dataset(dataset=self.dataset, noise_mode=self.noise_mode, r=self.r, root_dir=self.root_dir, transform=self.transform_train, mode="unlabeled_svd", noise_file=self.noise_file, pred=pred, probability=prob,log=self.log,teacher_idx=teacher_idx, refinement=refinement)
             unlabeled_trainloader = DataLoader(
                 dataset=unlabeled_dataset, 
                 batch_size=self.batch_size,
                 shuffle=True,
-                num_workers=self.num_workers)
+                num_workers=self.num_workers,
+                collate_fn=self.collate('train_views'))
             
             return labeled_trainloader, unlabeled_trainloader
                                      
@@ -292,14 +369,16 @@ class cifar_dataloader():
                 dataset=labeled_dataset, 
                 batch_size=self.batch_size,
                 shuffle=True,
-                num_workers=self.num_workers)   
+                num_workers=self.num_workers,
+                collate_fn=self.collate('train_views'))
             
             unlabeled_dataset = cifar_dataset(dataset=self.dataset, noise_mode=self.noise_mode, r=self.r, root_dir=self.root_dir, transform=self.transform_train, mode="unlabeled", noise_file=self.noise_file, pred=pred,teacher_idx=self.teacher_idx,truncate_mode=self.truncate_mode)                    
             unlabeled_trainloader = DataLoader(
                 dataset=unlabeled_dataset, 
                 batch_size=self.batch_size,
                 shuffle=True,
-                num_workers=self.num_workers)     
+                num_workers=self.num_workers,
+                collate_fn=self.collate('train_views'))
             return labeled_trainloader, unlabeled_trainloader
         
         elif mode=='test':
@@ -308,7 +387,8 @@ class cifar_dataloader():
                 dataset=test_dataset, 
                 batch_size=self.batch_size,
                 shuffle=False,
-                num_workers=self.num_workers)          
+                num_workers=self.num_workers,
+                collate_fn=self.collate('test'))
             return test_loader
         
         elif mode=='eval_train':
@@ -317,5 +397,6 @@ class cifar_dataloader():
                 dataset=eval_dataset, 
                 batch_size=self.batch_size,
                 shuffle=False,
-                num_workers=self.num_workers)          
+                num_workers=self.num_workers,
+                collate_fn=self.collate('test'))
             return eval_loader        
\ No newline at end of file
@@ -5,46 +5,196 @@ import numpy as np
 from PIL import Image
 import json
 import torch
+import os
+import io
+import tarfile
+from torch.utils.data import IterableDataset, get_worker_info
+
+def open_rgb(path, draft=None):
+    '''
+    open path as an RGB image; with draft (the shorter side the transforms resize to), a JPEG is decoded
+    at the smallest DCT scale (1/2, 1/4 or 1/8) whose output still covers draft x draft
+    '''
+    image = Image.open(path)
+    if draft is not None and image.format == 'JPEG':
+        image.draft('RGB', (draft, draft))
+    return image.convert('RGB')
+
+def store_positions(tar_dir, keys):
+    # positions of keys in the tar store, as dynamic_selection/data_loader/tar_stream.py:store_positions
+    index = {name: np.load(os.path.join(tar_dir, name + '.npy'), mmap_mode='r') for name in TarStream.INDEX_FILES}
+    blob, offsets = index['keys'], index['key_offsets']
+    store = {blob[offsets[i]:offsets[i+1]].tobytes().decode(): i for i in range(len(offsets) - 1)}
+    return np.array([store[key] for key in keys], dtype=np.int64)
+
+def store_shards(tar_dir, keys):
+    # shard of every key in the tar store, as dynamic_selection/data_loader/tar_stream.py:store_shards
+    shard_starts = np.load(os.path.join(tar_dir, 'shard_starts.npy'))
+    return np.searchsorted(shard_starts, store_positions(tar_dir, keys), side='right') - 1
+
+class TarStream(IterableDataset):
+    '''
+    Streams the samples of a dataset from the tar shards written by dynamic_selection/data_loader/tar_stream.py with
+    sequential reads only: shards in a fresh order every pass, split over the workers, samples shuffled within a
+    buffer of buffer_size encoded images. Only the members of the dataset (a per-shard bitmap) are decoded,
+    shards without members are not read, but a shard with one member is read in full: the balanced draws of
+    the warmup / eval_train runs are therefore drawn shard by shard (balanced_subset with blocks).
+    dataset provides stream_keys() and sample(index, image).
+    '''
+    INDEX_FILES = ('keys', 'key_offsets', 'shard_starts')
+
+    def __init__(self, dataset, tar_dir, buffer_size=1000):
+        self.dataset = dataset
+        self.tar_dir = tar_dir
+        self.buffer_size = buffer_size
+        self.shard_starts = np.load(os.path.join(tar_dir, 'shard_starts.npy'))
+        self.positions = store_positions(tar_dir, dataset.stream_keys())
+        self.order = np.argsort(self.positions)
+        member = np.zeros(self.shard_starts[-1], dtype=bool)
+        member[self.positions] = True
+        self.bitmaps = [np.packbits(member[self.shard_starts[s]:self.shard_starts[s+1]]) for s in range(len(self.shard_starts) - 1)]
+
+    def _read(self, shards):
+        for s in shards:
+            bitmap, start = self.bitmaps[s], self.shard_starts[s]
+            with tarfile.open(os.path.join(self.tar_dir, 'shard_%05d.tar' % s), 'r|') as tar:
+                for member in tar:
+                    position = int(member.name[:9])
+                    i = position - start
+                    if bitmap[i >> 3] & (0x80 >> (i & 7)):
+                        index = int(self.order[np.searchsorted(self.positions, position, sorter=self.order)])
+                        yield index, tar.extractfile(member).read()
+
+    def __iter__(self):
+        # the same shard order in every worker of one pass, a new one every pass
+        info = get_worker_info()
+        seed = torch.randint(2**31, (1,)).item() if info is None else info.seed - info.id
+        shards = [s for s in np.random.default_rng(seed).permutation(len(self.bitmaps)) if self.bitmaps[s].any()]
+        if info is not None:
+            shards = shards[info.id::info.num_workers]
+        rng = np.random.default_rng(seed if info is None else info.seed)
+        buffer = []
+        for item in self._read(shards):
+            if len(buffer) < self.buffer_size:
+                buffer.append(item)
+                continue
+            i = rng.integers(len(buffer))
+            item, buffer[i] = buffer[i], item
+            yield self.sample(*item)
+        for i in rng.permutation(len(buffer)):
+            yield self.sample(*buffer[i])
+
+    def sample(self, index, data):
+        return self.dataset.sample(index, open_rgb(io.BytesIO(data), getattr(self.dataset, 'draft', None)))
+
+    def __len__(self):
+        return len(self.positions)
+
+class ShardStore(object):
+    '''
+    Reader of the pre-decoded image shards written by dynamic_selection/data_loader/shards.py: raw uint8 HWC
+    pixels in shard_*.bin files, indexed by shard/offset/shape .npy arrays and the packed keys (paths under the root).
+    The shards are memory-mapped on first use in every process. Datasets map their keys to store positions with
+    positions(keys) when they are built (in the main process) and read by position only.
+    '''
+    INDEX_FILES = ('shard', 'offset', 'shape', 'keys', 'key_offsets')
+
+    def __init__(self, shard_dir):
+        self.shard_dir = shard_dir
+        for name in self.INDEX_FILES:
+            setattr(self, name, np.load(os.path.join(shard_dir, name + '.npy'), mmap_mode='r'))
+        self._shards = {}
+        self._positions = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_shards'] = {}
+        state['_positions'] = None
+        return state
+
+    def positions(self, keys):
+        '''
+        the store positions (int64) of keys; the key table is built on the first call and kept, as the datasets
+        are rebuilt every epoch from the same store
+        '''
+        if self._positions is None:
+            blob, offsets = self.keys, self.key_offsets
+            self._positions = {blob[offsets[i]:offsets[i+1]].tobytes().decode(): i for i in range(len(offsets) - 1)}
+        return np.array([self._positions[key] for key in keys], dtype=np.int64)
+
+    def image(self, i):
+        s = int(self.shard[i])
+        if s not in self._shards:
+            self._shards[s] = np.memmap(os.path.join(self.shard_dir, 'shard_%05d.bin' % s), dtype=np.uint8, mode='r')
+        h, w = self.shape[i]
+        start = int(self.offset[i])
+        return Image.fromarray(np.array(self._shards[s][start:start + h*w*3].reshape(h, w, 3)))
+
+def read_annotations(root):
+    '''
+    label dicts of the annotation files, the train key list and its per-class index table (positions of every class)
+    '''
+    annotations = {'train_labels': {}, 'test_labels': {}}
+    with open('%s/noisy_label_kv.txt'%root,'r') as f:
+        lines = f.read().splitlines()
+        for l in lines:
+            entry = l.split()           
+            img_path = '%s/'%root+entry[0][7:]
+            annotations['train_labels'][img_path] = int(entry[1])                         
+    with open('%s/clean_label_kv.txt'%root,'r') as f:
+        lines = f.read().splitlines()
+        for l in lines:
+            entry = l.split()           
+            img_path = '%s/'%root+entry[0][7:]
+            annotations['test_labels'][img_path] = int(entry[1])   
+    with open('%s/noisy_train_key_list.txt'%root,'r') as f:
+        annotations['train_imgs'] = ['%s/'%root+l[7:] for l in f.read().splitlines()]
+    labels = np.array([annotations['train_labels'][img_path] for img_path in annotations['train_imgs']])
+    order = np.argsort(labels, kind='stable')
+    annotations['class_index'] = np.split(order, np.cumsum(np.bincount(labels))[:-1])
+    return annotations
+
+def balanced_subset(class_index, num_samples, rng, num_class=14, blocks=None):
+    '''
+    Class-balanced random subset: a uniform draw of ceil(num_samples / num_class) positions of every class of
+    class_index (all of a smaller class), at most num_samples in total, in random order. The same distribution as
+    scanning a shuffled list with per-class quotas, in O(num_samples) numpy draws.
+    blocks: tar shard of every position; a class is then taken shard by shard, in random order, so a draw reads
+    few shards (see dynamic_selection/data_loader/clothing1m.py:balanced_subset)
+    '''
+    quota = int(np.ceil(num_samples / num_class))
+    if blocks is None:
+        picked = [idx[rng.choice(len(idx), min(quota, len(idx)), replace=False)] for idx in class_index]
+    else:
+        picked = []
+        for idx in class_index:
+            idx_blocks = blocks[idx]
+            names = np.unique(idx_blocks)
+            rank = rng.permutation(len(names))[np.searchsorted(names, idx_blocks)]
+            picked.append(idx[np.lexsort((rng.random(len(idx)), rank))[:quota]])
+    picked = np.concatenate(picked) if picked else np.empty(0, dtype=np.int64)
+    return rng.permutation(picked)[:num_samples]
 
 class clothing_dataset(Dataset): 
-    def __init__(self, root, transform, mode, num_samples=0, pred=[], probability=[], paths=[], num_class=14): 
+    def __init__(self, root, transform, mode, num_samples=0, pred=[], probability=[], paths=[], num_class=14, annotations=None, rng=None, shards=None, draft=None): 
         
         self.root = root
         self.transform = transform
         self.mode = mode
-        self.train_labels = {}
-        self.test_labels = {}
+        self.shards = shards
+        self.draft = draft
+        if annotations is None:
+            annotations = read_annotations(self.root)
+        self.train_labels = annotations['train_labels']
+        self.test_labels = annotations['test_labels']
         self.val_labels = {}            
-        
-        with open('%s/noisy_label_kv.txt'%self.root,'r') as f:
-            lines = f.read().splitlines()
-            for l in lines:
-                entry = l.split()           
-                img_path = '%s/'%self.root+entry[0][7:]
-                self.train_labels[img_path] = int(entry[1])                         
-        with open('%s/clean_label_kv.txt'%self.root,'r') as f:
-            lines = f.read().splitlines()
-            for l in lines:
-                entry = l.split()           
-                img_path = '%s/'%self.root+entry[0][7:]
-                self.test_labels[img_path] = int(entry[1])   
 
         if mode == 'all':
-            train_imgs=[]
-            with open('%s/noisy_train_key_list.txt'%self.root,'r') as f:
-                lines = f.read().splitlines()
-                for l in lines:
-                    img_path = '%s/'%self.root+l[7:]
-                    train_imgs.append(img_path)                                
-            random.shuffle(train_imgs)
-            class_num = torch.zeros(num_class)
-            self.train_imgs = []
-            for impath in train_imgs:
-                label = self.train_labels[impath] 
-                if class_num[label]<(num_samples/14) and len(self.train_imgs)<num_samples:
-                    self.train_imgs.append(impath)
-                    class_num[label]+=1
-            random.shuffle(self.train_imgs)       
+            if rng is None:
+                rng = np.random.default_rng()
+            train_imgs = annotations['train_imgs']
+            self.train_imgs = [train_imgs[i] for i in balanced_subset(annotations['class_index'], num_samples, rng, num_class,
+                                                                      blocks=annotations.get('train_shards'))]
         elif self.mode == "labeled":   
             train_imgs = paths 
             pred_idx = pred.nonzero()[0]
@@ -72,41 +222,50 @@ class clothing_dataset(Dataset):
                 for l in lines:
                     img_path = '%s/'%self.root+l[7:]
                     self.val_imgs.append(img_path)
+        if self.shards is not None:
+            # store position of every image (stored under the path relative to root), looked up once here
+            self.shard_pos = self.shards.positions(self.image_path(i)[len(self.root)+1:] for i in range(len(self)))
                     
+    def image_path(self, index):
+        if self.mode=='test':
+            return self.test_imgs[index]
+        elif self.mode=='val':
+            return self.val_imgs[index]
+        return self.train_imgs[index]
+
     def __getitem__(self, index):  
+        if self.shards is not None:
+            image = self.shards.image(self.shard_pos[index])
+        else:
+            image = open_rgb(self.image_path(index), self.draft)
+        return self.sample(index, image)
+
+    def sample(self, index, image):
+        # the sample of index for its decoded image, shared with TarStream
+        img_path = self.image_path(index)
         if self.mode=='labeled':
-            img_path = self.train_imgs[index]
             target = self.train_labels[img_path] 
             prob = self.probability[index]
-            image = Image.open(img_path).convert('RGB')    
             img1 = self.transform(image) 
             img2 = self.transform(image) 
             return img1, img2, target, prob              
         elif self.mode=='unlabeled':
-            img_path = self.train_imgs[index]
-            image = Image.open(img_path).convert('RGB')    
             img1 = self.transform(image) 
             img2 = self.transform(image) 
             return img1, img2  
         elif self.mode=='all':
-            img_path = self.train_imgs[index]
             target = self.train_labels[img_path]     
-            image = Image.open(img_path).convert('RGB')   
             img = self.transform(image)
             return img, target, img_path        
-        elif self.mode=='test':
-            img_path = self.test_imgs[index]
+        else:
             target = self.test_labels[img_path]     
-            image = Image.open(img_path).convert('RGB')   
             img = self.transform(image) 
             return img, target
-        elif self.mode=='val':
-            img_path = self.val_imgs[index]
-            target = self.test_labels[img_path]     
-            image = Image.open(img_path).convert('RGB')   
-            img = self.transform(image) 
-            return img, target    
-        
+
+    def stream_keys(self):
+        # tar members are keyed by the path relative to root
+        return [self.image_path(i)[len(self.root)+1:] for i in range(len(self))]
+
     def __len__(self):
         if self.mode=='test':
             return len(self.test_imgs)
@@ -116,11 +275,23 @@ class clothing_dataset(Dataset):
             return len(self.train_imgs)            
         
 class clothing_dataloader():  
-    def __init__(self, root, batch_size, num_batches, num_workers):    
+    def __init__(self, root, batch_size, num_batches, num_workers, seed=None, shard_dir=None, jpeg_draft=False, tar_dir=None):    
         self.batch_size = batch_size
         self.num_workers = num_workers
         self.num_batches = num_batches
         self.root = root
+        # annotations are read once; every warmup / eval_train run draws a fresh balanced subset from this generator
+        self.annotations = read_annotations(self.root)
+        self.rng = np.random.default_rng(seed)
+        # pre-decoded images instead of the JPEGs when given
+        self.shards = ShardStore(shard_dir) if shard_dir is not None else None
+        # JPEGs decoded at the smallest DCT scale that still covers the Resize(256) below
+        self.draft = 256 if jpeg_draft else None
+        # train-side modes stream their images from tar shards when given
+        self.tar_dir = tar_dir
+        if tar_dir is not None:
+            # tar shard of every train image (keyed by the path relative to root), the balanced draws read few shards
+            self.annotations['train_shards'] = store_shards(tar_dir, [path[len(root)+1:] for path in self.annotations['train_imgs']])
                    
         self.transform_train = transforms.Compose([
                 transforms.Resize(256),
@@ -135,39 +306,42 @@ class clothing_dataloader():
                 transforms.ToTensor(),
                 transforms.Normalize((0.6959, 0.6537, 0.6371),(0.3113, 0.3192, 0.3214)),
             ])        
+    def stream(self, dataset):
+        return TarStream(dataset, self.tar_dir) if self.tar_dir is not None else dataset
+
     def run(self,mode,pred=[],prob=[],paths=[]):        
         if mode=='warmup':
-            warmup_dataset = clothing_dataset(self.root,transform=self.transform_train, mode='all',num_samples=self.num_batches*self.batch_size*2)
+            warmup_dataset = clothing_dataset(self.root,transform=self.transform_train, mode='all',num_samples=self.num_batches*self.batch_size*2,annotations=self.annotations,rng=self.rng,shards=self.shards,draft=self.draft)
             warmup_loader = DataLoader(
-                dataset=warmup_dataset, 
+                dataset=self.stream(warmup_dataset), 
                 batch_size=self.batch_size*2,
-                shuffle=True,
+                shuffle=self.tar_dir is None,
                 num_workers=self.num_workers)  
             return warmup_loader
         elif mode=='train':
-            labeled_dataset = clothing_dataset(self.root,transform=self.transform_train, mode='labeled',pred=pred, probability=prob,paths=paths)
+            labeled_dataset = clothing_dataset(self.root,transform=self.transform_train, mode='labeled',pred=pred, probability=prob,paths=paths,annotations=self.annotations,shards=self.shards,draft=self.draft)
             labeled_loader = DataLoader(
-                dataset=labeled_dataset, 
+                dataset=self.stream(labeled_dataset), 
                 batch_size=self.batch_size,
-                shuffle=True,
+                shuffle=self.tar_dir is None,
                 num_workers=self.num_workers)           
-            unlabeled_dataset = clothing_dataset(self.root,transform=self.transform_train, mode='unlabeled',pred=pred, probability=prob,paths=paths)
+            unlabeled_dataset = clothing_dataset(self.root,transform=self.transform_train, mode='unlabeled',pred=pred, probability=prob,paths=paths,annotations=self.annotations,shards=self.shards,draft=self.draft)
             unlabeled_loader = DataLoader(
-                dataset=unlabeled_dataset, 
+                dataset=self.stream(unlabeled_dataset), 
                 batch_size=int(self.batch_size),
-                shuffle=True,
+                shuffle=self.tar_dir is None,
                 num_workers=self.num_workers)   
             return labeled_loader,unlabeled_loader
         elif mode=='eval_train':
-            eval_dataset = clothing_dataset(self.root,transform=self.transform_test, mode='all',num_samples=self.num_batches*self.batch_size)
+            eval_dataset = clothing_dataset(self.root,transform=self.transform_test, mode='all',num_samples=self.num_batches*self.batch_size,annotations=self.annotations,rng=self.rng,shards=self.shards,draft=self.draft)
             eval_loader = DataLoader(
-                dataset=eval_dataset, 
+                dataset=self.stream(eval_dataset), 
                 batch_size=self.batch_size,
                 shuffle=False,
                 num_workers=self.num_workers)          
             return eval_loader        
         elif mode=='test':
-            test_dataset = clothing_dataset(self.root,transform=self.transform_test, mode='test')
+            test_dataset = clothing_dataset(self.root,transform=self.transform_test, mode='test',annotations=self.annotations,shards=self.shards,draft=self.draft)
             test_loader = DataLoader(
                 dataset=test_dataset, 
                 batch_size=1000,
@@ -175,7 +349,7 @@ class clothing_dataloader():
                 num_workers=self.num_workers)             
             return test_loader             
         elif mode=='val':
-            val_dataset = clothing_dataset(self.root,transform=self.transform_test, mode='val')
+            val_dataset = clothing_dataset(self.root,transform=self.transform_test, mode='val',annotations=self.annotations,shards=self.shards,draft=self.draft)
             val_loader = DataLoader(
                 dataset=val_dataset, 
                 batch_size=1000,
@@ -5,6 +5,9 @@ import numpy as np
 from PIL import Image
 import torch
 import os
+import io
+import tarfile
+from torch.utils.data import IterableDataset, get_worker_info
 
 # class imagenet_dataset(Dataset):
 #     def __init__(self, root_dir, transform, num_class):
@@ -31,106 +34,223 @@ import os
 #     def __len__(self):
 #         return len(self.val_data)
     
+def open_rgb(path, draft=None):
+    '''
+    open path as an RGB image; with draft (the shorter side the transforms resize to), a JPEG is decoded
+    at the smallest DCT scale (1/2, 1/4 or 1/8) whose output still covers draft x draft
+    '''
+    image = Image.open(path)
+    if draft is not None and image.format == 'JPEG':
+        image.draft('RGB', (draft, draft))
+    return image.convert('RGB')
+
+class TarStream(IterableDataset):
+    '''
+    Streams the samples of a dataset from the tar shards written by dynamic_selection/data_loader/tar_stream.py with
+    sequential reads only: shards in a fresh order every pass, split over the workers, samples shuffled within a
+    buffer of buffer_size encoded images. Only the members of the dataset (a per-shard bitmap) are decoded,
+    shards without members are not read. dataset provides stream_keys() and sample(index, image).
+    '''
+    INDEX_FILES = ('keys', 'key_offsets', 'shard_starts')
+
+    def __init__(self, dataset, tar_dir, buffer_size=1000):
+        self.dataset = dataset
+        self.tar_dir = tar_dir
+        self.buffer_size = buffer_size
+        index = {name: np.load(os.path.join(tar_dir, name + '.npy'), mmap_mode='r') for name in self.INDEX_FILES}
+        self.shard_starts = np.asarray(index['shard_starts'])
+        blob, offsets = index['keys'], index['key_offsets']
+        store = {blob[offsets[i]:offsets[i+1]].tobytes().decode(): i for i in range(len(offsets) - 1)}
+        self.positions = np.array([store[key] for key in dataset.stream_keys()], dtype=np.int64)
+        self.order = np.argsort(self.positions)
+        member = np.zeros(self.shard_starts[-1], dtype=bool)
+        member[self.positions] = True
+        self.bitmaps = [np.packbits(member[self.shard_starts[s]:self.shard_starts[s+1]]) for s in range(len(self.shard_starts) - 1)]
+
+    def _read(self, shards):
+        for s in shards:
+            bitmap, start = self.bitmaps[s], self.shard_starts[s]
+            with tarfile.open(os.path.join(self.tar_dir, 'shard_%05d.tar' % s), 'r|') as tar:
+                for member in tar:
+                    position = int(member.name[:9])
+                    i = position - start
+                    if bitmap[i >> 3] & (0x80 >> (i & 7)):
+                        index = int(self.order[np.searchsorted(self.positions, position, sorter=self.order)])
+                        yield index, tar.extractfile(member).read()
+
+    def __iter__(self):
+        # the same shard order in every worker of one pass, a new one every pass
+        info = get_worker_info()
+        seed = torch.randint(2**31, (1,)).item() if info is None else info.seed - info.id
+        shards = [s for s in np.random.default_rng(seed).permutation(len(self.bitmaps)) if self.bitmaps[s].any()]
+        if info is not None:
+            shards = shards[info.id::info.num_workers]
+        rng = np.random.default_rng(seed if info is None else info.seed)
+        buffer = []
+        for item in self._read(shards):
+            if len(buffer) < self.buffer_size:
+                buffer.append(item)
+                continue
+            i = rng.integers(len(buffer))
+            item, buffer[i] = buffer[i], item
+            yield self.sample(*item)
+        for i in rng.permutation(len(buffer)):
+            yield self.sample(*buffer[i])
+
+    def sample(self, index, data):
+        return self.dataset.sample(index, open_rgb(io.BytesIO(data), getattr(self.dataset, 'draft', None)))
+
+    def __len__(self):
+        return len(self.positions)
+
+class ShardStore(object):
+    '''
+    Reader of the pre-decoded image shards written by dynamic_selection/data_loader/shards.py: raw uint8 HWC
+    pixels in shard_*.bin files, indexed by shard/offset/shape .npy arrays and the packed keys (paths under the root).
+    The shards are memory-mapped on first use in every process. Datasets map their keys to store positions with
+    positions(keys) when they are built (in the main process) and read by position only.
+    '''
+    INDEX_FILES = ('shard', 'offset', 'shape', 'keys', 'key_offsets')
+
+    def __init__(self, shard_dir):
+        self.shard_dir = shard_dir
+        for name in self.INDEX_FILES:
+            setattr(self, name, np.load(os.path.join(shard_dir, name + '.npy'), mmap_mode='r'))
+        self._shards = {}
+        self._positions = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_shards'] = {}
+        state['_positions'] = None
+        return state
+
+    def positions(self, keys):
+        '''
+        the store positions (int64) of keys; the key table is built on the first call and kept, as the datasets
+        are rebuilt every epoch from the same store
+        '''
+        if self._positions is None:
+            blob, offsets = self.keys, self.key_offsets
+            self._positions = {blob[offsets[i]:offsets[i+1]].tobytes().decode(): i for i in range(len(offsets) - 1)}
+        return np.array([self._positions[key] for key in keys], dtype=np.int64)
+
+    def image(self, i):
+        s = int(self.shard[i])
+        if s not in self._shards:
+            self._shards[s] = np.memmap(os.path.join(self.shard_dir, 'shard_%05d.bin' % s), dtype=np.uint8, mode='r')
+        h, w = self.shape[i]
+        start = int(self.offset[i])
+        return Image.fromarray(np.array(self._shards[s][start:start + h*w*3].reshape(h, w, 3)))
+
+def read_filelist(path, num_class, prefix=''):
+    '''
+    paths (prefix + path) of the file list entries with a label below num_class, packed into a uint8 blob with
+    int64 offsets, and their labels as int16 aligned with the paths; workers index these arrays instead of
+    forking dicts of path strings
+    '''
+    paths, labels = [], []
+    with open(path) as f:
+        for line in f:
+            img, target = line.split()
+            if int(target) < num_class:
+                paths.append((prefix + img).encode())
+                labels.append(int(target))
+    blob = np.frombuffer(b''.join(paths), dtype=np.uint8)
+    offsets = np.concatenate([[0], np.cumsum([len(p) for p in paths])]).astype(np.int64)
+    return blob, offsets, np.array(labels, dtype=np.int16)
+
+def unpack_path(blob, offsets, i):
+    return blob[offsets[i]:offsets[i+1]].tobytes().decode()
+
 class imagenet_dataset(torch.utils.data.Dataset):
-    def __init__(self, root_dir, transform, num_class):
+    def __init__(self, root_dir, transform, num_class, draft=None):
         self.root = '/home/hynix/imagenet/'
         self.transform = transform
+        self.draft = draft
 
-        with open(self.root+'imagenet_val.txt') as f:
-            lines=f.readlines()
-            self.val_imgs = []
-            self.val_labels = {}
-            for line in lines:
-                img, target = line.split()
-                target = int(target)
-                if target<num_class:
-                    self.val_imgs.append(img)
-                    self.val_labels[img]=target               
+        self.path_blob, self.path_offsets, self.val_labels = read_filelist(self.root+'imagenet_val.txt', num_class, prefix='val/')
                 
     def __getitem__(self, index):
 
-        img_path = self.val_imgs[index]
-        target = self.val_labels[img_path]     
-        image = Image.open(self.root+'val/'+img_path).convert('RGB')   
+        target = int(self.val_labels[index])
+        image = open_rgb(self.root+unpack_path(self.path_blob, self.path_offsets, index), self.draft)
         img = self.transform(image) 
 
         return img, target # index, target
         
     
     def __len__(self):
-        return len(self.val_imgs)    
+        return len(self.val_labels)    
 
 
 class webvision_dataset(Dataset): 
-    def __init__(self, root_dir, transform, mode, num_class, pred=[], probability=[], log=''): 
+    def __init__(self, root_dir, transform, mode, num_class, pred=[], probability=[], log='', shards=None): 
         self.root = root_dir
         self.transform = transform
         self.mode = mode  
+        self.shards = shards
      
+        # paths packed into one array, labels int16 aligned with it; *_imgs are positions in these arrays
         if self.mode=='test':
-            with open(self.root+'info/val_filelist.txt') as f:
-                lines=f.readlines()
-            self.val_imgs = []
-            self.val_labels = {}
-            for line in lines:
-                img, target = line.split()
-                target = int(target)
-                if target<num_class:
-                    self.val_imgs.append(img)
-                    self.val_labels[img]=target                             
+            self.path_blob, self.path_offsets, self.val_labels = read_filelist(self.root+'info/val_filelist.txt', num_class, prefix='val_images_256/')
+            self.val_imgs = np.arange(len(self.val_labels))
         else:    
-            with open(self.root+'info/train_filelist_google.txt') as f:
-                lines=f.readlines()    
-            train_imgs = []
-            self.train_labels = {}
-            for line in lines:
-                img, target = line.split()
-                target = int(target)
-                if target<num_class:
-                    train_imgs.append(img)
-                    self.train_labels[img]=target            
+            self.path_blob, self.path_offsets, self.train_labels = read_filelist(self.root+'info/train_filelist_google.txt', num_class)
+            train_imgs = np.arange(len(self.train_labels))
             if self.mode == 'all':
                 self.train_imgs = train_imgs
             else:                   
                 if self.mode == "labeled":
                     pred_idx = pred.nonzero()[0]
-                    self.train_imgs = [train_imgs[i] for i in pred_idx]                
-                    self.probability = [probability[i] for i in pred_idx]            
+                    self.train_imgs = train_imgs[pred_idx]
+                    self.probability = np.asarray(probability)[pred_idx]
                     print("%s data has a size of %d"%(self.mode,len(self.train_imgs)))            
                     log.write('Numer of labeled samples:%d \n'%(pred.sum()))
                     log.flush()                          
                 elif self.mode == "unlabeled":
                     pred_idx = (1-pred).nonzero()[0]                                               
-                    self.train_imgs = [train_imgs[i] for i in pred_idx]                           
+                    self.train_imgs = train_imgs[pred_idx]
                     print("%s data has a size of %d"%(self.mode,len(self.train_imgs)))            
+        if self.shards is not None:
+            # store position of every packed path, looked up once here instead of by key in the workers
+            self.shard_pos = self.shards.positions(unpack_path(self.path_blob, self.path_offsets, i) for i in range(len(self.path_offsets) - 1))
                     
+    def image_key(self, index):
+        imgs = self.val_imgs if self.mode=='test' else self.train_imgs
+        return unpack_path(self.path_blob, self.path_offsets, imgs[index])
+
     def __getitem__(self, index):
+        if self.shards is not None:
+            imgs = self.val_imgs if self.mode=='test' else self.train_imgs
+            image = self.shards.image(self.shard_pos[imgs[index]])
+        else:
+            image = Image.open(self.root+self.image_key(index)).convert('RGB')
+        return self.sample(index, image)
+
+    def sample(self, index, image):
+        # the sample of index for its decoded image, shared with TarStream
         if self.mode=='labeled':
-            img_path = self.train_imgs[index]
-            target = self.train_labels[img_path] 
+            target = int(self.train_labels[self.train_imgs[index]])
             prob = self.probability[index]
-            image = Image.open(self.root+img_path).convert('RGB')    
             img1 = self.transform(image) 
             img2 = self.transform(image) 
             return img1, img2, target, prob              
         elif self.mode=='unlabeled':
-            img_path = self.train_imgs[index]
-            image = Image.open(self.root+img_path).convert('RGB')    
             img1 = self.transform(image) 
             img2 = self.transform(image) 
             return img1, img2  
         elif self.mode=='all':
-            img_path = self.train_imgs[index]
-            target = self.train_labels[img_path]     
-            image = Image.open(self.root+img_path).convert('RGB')   
+            target = int(self.train_labels[self.train_imgs[index]])
             img = self.transform(image)
             return img, target, index        
         elif self.mode=='test':
-            img_path = self.val_imgs[index]
-            target = self.val_labels[img_path]     
-            image = Image.open(self.root+'val_images_256/'+img_path).convert('RGB')   
+            target = int(self.val_labels[self.val_imgs[index]])
             img = self.transform(image) 
             return img, target
+
+    def stream_keys(self):
+        return [self.image_key(i) for i in range(len(self))]
            
     def __len__(self):
         if self.mode!='test':
@@ -140,13 +260,19 @@ class webvision_dataset(Dataset):
 
 
 class webvision_dataloader():  
-    def __init__(self, batch_size, num_class, num_workers, root_dir, log):
+    def __init__(self, batch_size, num_class, num_workers, root_dir, log, shard_dir=None, jpeg_draft=False, tar_dir=None):
 
         self.batch_size = batch_size
         self.num_class = num_class
         self.num_workers = num_workers
         self.root_dir = root_dir
         self.log = log
+        # pre-decoded images instead of the JPEGs when given
+        self.shards = ShardStore(shard_dir) if shard_dir is not None else None
+        # ImageNet JPEGs decoded at the smallest DCT scale that still covers the Resize(320) below
+        self.draft = 320 if jpeg_draft else None
+        # train-side modes stream their images from tar shards when given
+        self.tar_dir = tar_dir
 
         self.transform_train = transforms.Compose([
                 transforms.Resize(320),
@@ -168,37 +294,40 @@ class webvision_dataloader():
                 transforms.Normalize((0.485, 0.456, 0.406),(0.229, 0.224, 0.225)),
             ])         
 
+    def stream(self, dataset):
+        return TarStream(dataset, self.tar_dir) if self.tar_dir is not None else dataset
+
     def run(self,mode,pred=[],prob=[]):
         if mode=='warmup':
-            all_dataset = webvision_dataset(root_dir=self.root_dir, transform=self.transform_train, mode="all", num_class=self.num_class)                
+            all_dataset = webvision_dataset(root_dir=self.root_dir, transform=self.transform_train, mode="all", num_class=self.num_class, shards=self.shards)                
             trainloader = DataLoader(
-                dataset=all_dataset, 
+                dataset=self.stream(all_dataset), 
                 batch_size=self.batch_size*2,
-                shuffle=True,
+                shuffle=self.tar_dir is None,
                 num_workers=self.num_workers,
                 pin_memory=True)                 
             return trainloader
                                      
         elif mode=='train':
-            labeled_dataset = webvision_dataset(root_dir=self.root_dir, transform=self.transform_train, mode="labeled",num_class=self.num_class,pred=pred,probability=prob,log=self.log)              
+            labeled_dataset = webvision_dataset(root_dir=self.root_dir, transform=self.transform_train, mode="labeled",num_class=self.num_class,pred=pred,probability=prob,log=self.log, shards=self.shards)              
             labeled_trainloader = DataLoader(
-                dataset=labeled_dataset, 
+                dataset=self.stream(labeled_dataset), 
                 batch_size=self.batch_size,
-                shuffle=True,
+                shuffle=self.tar_dir is None,
                 num_workers=self.num_workers,
                 pin_memory=True)        
             
-            unlabeled_dataset = webvision_dataset(root_dir=self.root_dir, transform=self.transform_train, mode="unlabeled",num_class=self.num_class,pred=pred,log=self.log)                    
+            unlabeled_dataset = webvision_dataset(root_dir=self.root_dir, transform=self.transform_train, mode="unlabeled",num_class=self.num_class,pred=pred,log=self.log, shards=self.shards)                    
             unlabeled_trainloader = DataLoader(
-                dataset=unlabeled_dataset, 
+                dataset=self.stream(unlabeled_dataset), 
                 batch_size=self.batch_size,
-                shuffle=True,
+                shuffle=self.tar_dir is None,
                 num_workers=self.num_workers,
                 pin_memory=True)     
             return labeled_trainloader, unlabeled_trainloader
         
         elif mode=='test':
-            test_dataset = webvision_dataset(root_dir=self.root_dir, transform=self.transform_test, mode='test', num_class=self.num_class)      
+            test_dataset = webvision_dataset(root_dir=self.root_dir, transform=self.transform_test, mode='test', num_class=self.num_class, shards=self.shards)      
             test_loader = DataLoader(
                 dataset=test_dataset, 
                 batch_size=self.batch_size*20,
@@ -208,9 +337,9 @@ class webvision_dataloader():
             return test_loader
         
         elif mode=='eval_train':
-            eval_dataset = webvision_dataset(root_dir=self.root_dir, transform=self.transform_test, mode='all', num_class=self.num_class)      
+            eval_dataset = webvision_dataset(root_dir=self.root_dir, transform=self.transform_test, mode='all', num_class=self.num_class, shards=self.shards)      
             eval_loader = DataLoader(
-                dataset=eval_dataset, 
+                dataset=self.stream(eval_dataset), 
                 batch_size=self.batch_size*20,
                 shuffle=False,
                 num_workers=self.num_workers,
@@ -218,7 +347,7 @@ class webvision_dataloader():
             return eval_loader     
         
         elif mode=='imagenet':
-            imagenet_val = imagenet_dataset(root_dir=self.root_dir, transform=self.transform_imagenet, num_class=self.num_class)      
+            imagenet_val = imagenet_dataset(root_dir=self.root_dir, transform=self.transform_imagenet, num_class=self.num_class, draft=self.draft)      
             imagenet_loader = DataLoader(
                 dataset=imagenet_val, 
                 batch_size=self.batch_size,
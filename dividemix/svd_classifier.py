@@ -1,7 +1,6 @@
 import torch
 import numpy as np
 from tqdm import tqdm
-from sklearn import cluster
 import torch.nn.functional as F
 
 def get_loss_list(model, data_loader):
@@ -17,21 +16,54 @@ def get_loss_list(model, data_loader):
 
             loss_list = np.concatenate((loss_list, loss.detach().cpu()))
     
-    kmeans = cluster.KMeans(n_clusters=2, random_state=0).fit(loss_list.reshape(-1,1))
+    noisy = split_two_means(loss_list, np.array([0, len(loss_list)]))
     
-    if np.mean(loss_list[kmeans.labels_==0]) > np.mean(loss_list[kmeans.labels_==1]):
-        clean_label = 1
-    else:
-        clean_label = 0
-    
-    output=[]
-    for idx, value in enumerate(kmeans.labels_):
-        if value==clean_label:
-            output.append(idx)
+    output = np.flatnonzero(~noisy).tolist()
     
     return output
 
 
+def split_two_means(x, offsets):
+    '''
+    Exact two-means clustering of one-dimensional values, for every segment at once
+    x: values sorted by segment (class), segment c is x[offsets[c]:offsets[c+1]] and is not empty
+    offsets: segment boundaries
+    
+    return boolean mask of the samples in the cluster with the larger mean
+    In 1-D the optimal split is a threshold on the sorted values, so every split point
+    is scored from prefix sums and the best one is taken per segment.
+    A copy of dynamic_selection/selection/util.py:split_two_means, keep the two in sync.
+    '''
+    x = np.asarray(x, dtype=np.float64)
+    if len(x) == 0:
+        return np.zeros(0, dtype=bool)
+    counts, starts = np.diff(offsets), offsets[:-1]
+    seg = np.repeat(np.arange(len(counts)), counts)
+    
+    # sort inside every segment and center it for numerical stability
+    sorted_x = x[np.lexsort((x, seg))]
+    centered = sorted_x - (np.add.reduceat(sorted_x, starts) / counts)[seg]
+    
+    # prefix sums restarted at every segment; a split after position i keeps [start, i] on the left
+    csum = np.cumsum(centered)
+    left_sum = csum - np.concatenate(([0.], csum))[starts][seg]
+    total = left_sum[offsets[1:] - 1][seg]
+    n_left = np.arange(len(x)) - starts[seg] + 1
+    n_right = counts[seg] - n_left
+    
+    # between-cluster term to maximize, only defined between two distinct values
+    valid = np.append(sorted_x[1:] > sorted_x[:-1], False) & (n_right > 0)
+    gain = np.where(valid, left_sum ** 2 / n_left + (total - left_sum) ** 2 / np.maximum(n_right, 1), -np.inf)
+    best = np.flatnonzero(valid & (gain == np.maximum.reduceat(gain, starts)[seg]))
+    _, first = np.unique(seg[best], return_index=True)
+    best = best[first]
+    
+    # segments without two distinct values stay in one cluster
+    threshold = np.full(len(counts), np.inf)
+    threshold[seg[best]] = sorted_x[best]
+    return x > threshold[seg]
+
+
 def singular_label(v_ortho_dict, model_represents, label):
     
     sing_lbl = torch.zeros(model_represents.shape[0]) == 0.
@@ -1,21 +1,55 @@
 from typing import Tuple, Union, Optional
 
+import copy
 import numpy as np
-from torch.utils.data import DataLoader
+import torch
+from torch.utils.data import DataLoader, IterableDataset
 from torch.utils.data.dataloader import default_collate
-from torch.utils.data.sampler import SubsetRandomSampler
+from torch.utils.data.sampler import Sampler, SubsetRandomSampler
+from data_loader.tensor_cache import is_deterministic, TensorCache
+from data_loader.tar_stream import TarStream
+
+
+class IndexSampler(Sampler):
+    """
+    Samples from an index set that can be replaced between epochs (e.g. by a new teacher_idx).
+    The sampler lives in the main process, so persistent workers pick up the new set at the next epoch.
+    """
+    def __init__(self, indices, shuffle=True):
+        self.indices = np.asarray(indices)
+        self.shuffle = shuffle
+
+    def set_indices(self, indices):
+        self.indices = np.asarray(indices)
+
+    def __iter__(self):
+        if self.shuffle:
+            return iter(self.indices[torch.randperm(len(self.indices)).numpy()].tolist())
+        return iter(self.indices.tolist())
+
+    def __len__(self):
+        return len(self.indices)
 
 
 class BaseDataLoader(DataLoader):
     """
     Base class for all data loaders
+
+    The index of every train sample is its position in the full train set, whether the loader is restricted
+    to a subset by set_active_indices (persistent, streaming) or built on a truncated dataset (teacher_idx),
+    so index-keyed state (e.g. the targets of ELRLoss) means the same in every mode.
     """
     valid_sampler: Optional[SubsetRandomSampler]
     sampler: Optional[SubsetRandomSampler]
 
     def __init__(self, train_dataset, batch_size, shuffle, validation_split: float, num_workers, pin_memory,
-                 collate_fn=default_collate, val_dataset=None):
+                 collate_fn=default_collate, val_dataset=None, persistent=False, val_collate_fn=None,
+                 tensor_cache=None, tensor_cache_dtype='float16'):
         self.collate_fn = collate_fn
+        # directory of the memory-mapped store of deterministic validation/test transforms (None: no cache)
+        self.tensor_cache = tensor_cache
+        self.tensor_cache_dtype = tensor_cache_dtype
+        self.val_collate_fn = collate_fn if val_collate_fn is None else val_collate_fn
         self.validation_split = validation_split
         self.shuffle = shuffle
         self.val_dataset = val_dataset
@@ -30,9 +64,17 @@ class BaseDataLoader(DataLoader):
             'num_workers': num_workers,
             'pin_memory': pin_memory
         }
-        if val_dataset is None:
+        if isinstance(train_dataset, IterableDataset):
+            # a stream shuffles itself, subsets are set through its membership (workers are forked every pass to see it)
+            super().__init__(**dict(self.init_kwargs, shuffle=False))
+        elif val_dataset is None:
             self.sampler, self.valid_sampler = self._split_sampler(self.validation_split)
             super().__init__(sampler=self.sampler, **self.init_kwargs)
+        elif persistent:
+            # workers are forked once; re-selection only swaps the index set of the sampler
+            self.sampler = IndexSampler(np.arange(len(train_dataset)), shuffle=self.shuffle)
+            super().__init__(sampler=self.sampler, persistent_workers=num_workers > 0,
+                             **dict(self.init_kwargs, shuffle=False))
         else:
             super().__init__(**self.init_kwargs)
 
@@ -65,13 +107,63 @@ class BaseDataLoader(DataLoader):
 
         return train_sampler, valid_sampler
 
+    def set_active_indices(self, teacher_idx):
+        '''
+        restrict a persistent loader to teacher_idx (every sample when None) without restarting its workers,
+        or a streaming loader through the membership bitmaps of its TarStream
+        '''
+        if isinstance(self.dataset, TarStream):
+            self.dataset.set_members(teacher_idx)
+            return
+        assert isinstance(self.sampler, IndexSampler), 'set_active_indices needs a loader built with persistent=True'
+        self.sampler.set_indices(np.arange(len(self.dataset)) if teacher_idx is None else teacher_idx)
+
+    def persistent_copy(self):
+        '''
+        a loader with persistent workers over the train dataset of this loader, with its pipeline (batch size, shuffle,
+        collate_fn, workers, caches), to be restricted by set_active_indices; the stream of a streaming loader is
+        copied, so restricting the copy leaves this loader alone
+        '''
+        dataset = self.init_kwargs['dataset']
+        if isinstance(dataset, TarStream):
+            dataset = copy.copy(dataset)
+        else:
+            assert self.val_dataset is not None, 'a persistent loader needs a loader built with a val_dataset'
+        loader = BaseDataLoader(dataset, self.init_kwargs['batch_size'], self.init_kwargs['shuffle'], self.validation_split,
+                                self.init_kwargs['num_workers'], self.init_kwargs['pin_memory'], collate_fn=self.collate_fn,
+                                val_dataset=self.val_dataset, persistent=True, val_collate_fn=self.val_collate_fn,
+                                tensor_cache=self.tensor_cache, tensor_cache_dtype=self.tensor_cache_dtype)
+        loader.train_dataset, loader.val_dataset = dataset, self.val_dataset
+        return loader
+
+    def active_labels(self):
+        '''
+        noisy and ground-truth labels of the samples the loader currently iterates
+        '''
+        # aligned with the dataset positions, i.e. with the selected subset of a truncated dataset
+        labels, labels_gt = (np.asarray(labels) for labels in self.dataset.get_labels())
+        if isinstance(self.sampler, IndexSampler):
+            return labels[self.sampler.indices], labels_gt[self.sampler.indices]
+        if isinstance(self.dataset, TarStream):
+            return labels[self.dataset.rows], labels_gt[self.dataset.rows]
+        return labels, labels_gt
+
+    def num_active(self):
+        '''
+        number of samples the loader currently iterates
+        '''
+        return len(self.dataset) if isinstance(self.dataset, IterableDataset) else len(self.sampler)
+
     def split_validation(self, bs = 100):
         if self.val_dataset is not None:
+            val_dataset = self.val_dataset
+            if self.tensor_cache and is_deterministic(val_dataset.transform):
+                val_dataset = TensorCache(val_dataset, self.tensor_cache, dtype=self.tensor_cache_dtype, num_workers=self.num_workers)
             kwargs = {
-                'dataset': self.val_dataset,
+                'dataset': val_dataset,
                 'batch_size': bs,
                 'shuffle': False,
-                'collate_fn': self.collate_fn,
+                'collate_fn': self.val_collate_fn,
                 'num_workers': self.num_workers
             }
             return DataLoader(**kwargs)
@@ -0,0 +1,60 @@
+import numpy as np
+import torch
+from torch.utils.data.dataloader import default_collate
+
+__all__ = ['to_uint8_tensor', 'BatchAugment', 'BatchAugmentCollate']
+
+
+def to_uint8_tensor(img):
+    '''
+    per-sample transform of the batch pipeline: the HWC uint8 image as a tensor, augmentation is left to the collate_fn
+    '''
+    return torch.from_numpy(np.array(img, dtype=np.uint8))
+
+class BatchAugment(object):
+    '''
+    RandomCrop(padding) + RandomHorizontalFlip + ToTensor + Normalize on a whole uint8 batch (N, H, W, C).
+    Crop offsets and flips are drawn per sample and applied in one gather, the scaling to [0, 1] is fused
+    into the normalization. Returns a float (N, C, H, W) batch, or a list of views independently augmented batches.
+    dividemix/dataloader_cifar.py keeps a copy of this class and BatchAugmentCollate, keep them in sync.
+    '''
+    def __init__(self, mean, std, padding=0, flip=False, views=1):
+        self.scale = 1. / (255. * torch.tensor(std, dtype=torch.float32).view(1, -1, 1, 1))
+        self.shift = (torch.tensor(mean, dtype=torch.float32) / torch.tensor(std, dtype=torch.float32)).view(1, -1, 1, 1)
+        self.padding = padding
+        self.flip = flip
+        self.views = views
+
+    def __call__(self, images):
+        n, h, w, _ = images.shape
+        images = images.permute(0, 3, 1, 2)
+        if self.padding:
+            images = torch.nn.functional.pad(images, (self.padding,) * 4)
+
+        outputs = []
+        for _ in range(self.views):
+            rows = torch.arange(h).expand(n, h)
+            cols = torch.arange(w).expand(n, w)
+            if self.padding:
+                rows = rows + torch.randint(0, 2 * self.padding + 1, (n, 1))
+                cols = cols + torch.randint(0, 2 * self.padding + 1, (n, 1))
+            if self.flip:
+                cols = torch.where(torch.rand(n, 1) < 0.5, cols.flip(1), cols)
+            out = images[torch.arange(n)[:, None, None], :, rows[:, :, None], cols[:, None, :]]
+            out = out.permute(0, 3, 1, 2).float().mul_(self.scale).sub_(self.shift)
+            outputs.append(out.contiguous())
+
+        return outputs[0] if self.views == 1 else outputs
+
+class BatchAugmentCollate(object):
+    '''
+    collate_fn that augments the uint8 images (first field of every sample) after collation,
+    the views of a multi-view augment replace the image field in order
+    '''
+    def __init__(self, augment):
+        self.augment = augment
+
+    def __call__(self, samples):
+        batch = list(default_collate(samples))
+        views = self.augment(batch[0])
+        return (views if isinstance(views, list) else [views]) + batch[1:]
@@ -11,6 +11,8 @@ import random
 import json
 import os
 import copy
+from data_loader.noise import *
+from data_loader.registry import get_shared, shared_view
 
 def fix_seed(seed=888):
     np.random.seed(seed)
@@ -24,42 +26,50 @@ def get_cifar10(root, cfg_trainer, train=True,
                 transform_train=None, transform_val=None,
                 download=True, noise_file = '', teacher_idx=None, seed=888):
     
+    # loaded, split and noisified once per process; every loader gets views of the shared arrays
+    key = ('cifar10', root, train, seed, cfg_trainer['percent'], cfg_trainer['asym'], cfg_trainer['instance'])
+    train_dataset, val_dataset = get_shared(key, lambda: build_cifar10(root, cfg_trainer, train=train, download=download, noise_file=noise_file, seed=seed))
+    
+    if train:
+        if teacher_idx is not None:
+            print(len(teacher_idx))
+        train_dataset = shared_view(train_dataset, teacher_idx, transform=transform_train)
+        val_dataset = shared_view(val_dataset, transform=transform_val)
+        print(f"Train: {len(train_dataset)} Val: {len(val_dataset)}")  # Train: 45000 Val: 5000
+    else:
+        val_dataset = shared_view(val_dataset, transform=transform_val)
+        print(f"Test: {len(val_dataset)}")
+    
+    if len(val_dataset) == 0:
+        return train_dataset, None
+    else:
+        return train_dataset, val_dataset
+
+def build_cifar10(root, cfg_trainer, train=True, download=True, noise_file='', seed=888):
+    '''
+    load, split and noisify CIFAR10, without transforms
+    '''
     base_dataset = torchvision.datasets.CIFAR10(root, train=train, download=download)
     if train:
         fix_seed(seed)
         train_idxs, val_idxs = train_val_split(base_dataset.targets, seed)
 
-        train_dataset = CIFAR10_train(root, cfg_trainer, train_idxs, train=True, transform=transform_train, seed=seed)
-        val_dataset = CIFAR10_val(root, cfg_trainer, val_idxs, train=train, transform=transform_val)
-        if cfg_trainer['instance']:
-            train_dataset.instance_noise()
-            val_dataset.instance_noise()
-        elif cfg_trainer['asym']:
-            train_dataset.asymmetric_noise()
-            val_dataset.asymmetric_noise()
-        else:
-            train_dataset.symmetric_noise()
-            val_dataset.symmetric_noise()
+        train_dataset = CIFAR10_train(root, cfg_trainer, train_idxs, train=True, seed=seed)
+        val_dataset = CIFAR10_val(root, cfg_trainer, val_idxs, train=train)
+        mode = 'instance' if cfg_trainer['instance'] else ('asym' if cfg_trainer['asym'] else 'sym')
+        # the train noise reseeds np.random, the validation noise continues its stream
+        load_or_add_noise(train_dataset, mode, noise_file and noise_file + '_train.npz', seed=seed)
+        load_or_add_noise(val_dataset, mode, noise_file and noise_file + '_val.npz', seed=seed)
             
         print ('##############')
         print (train_dataset.train_labels[:10])
         print (train_dataset.train_labels_gt[:10])
-              
-        if teacher_idx is not None:
-            print(len(teacher_idx))
-            train_dataset.truncate(teacher_idx)
-            
-        print(f"Train: {len(train_dataset)} Val: {len(val_dataset)}")  # Train: 45000 Val: 5000
     else:
         fix_seed(seed)
         train_dataset = []
-        val_dataset = CIFAR10_val(root, cfg_trainer, None, train=train, transform=transform_val)
-        print(f"Test: {len(val_dataset)}")
-    
-    if len(val_dataset) == 0:
-        return train_dataset, None
-    else:
-        return train_dataset, val_dataset
+        val_dataset = CIFAR10_val(root, cfg_trainer, None, train=train)
+
+    return train_dataset, val_dataset
 
 def train_val_split(base_dataset: torchvision.datasets.CIFAR10, seed):
     fix_seed(seed)
@@ -91,6 +101,7 @@ class CIFAR10_train(torchvision.datasets.CIFAR10):
         self.cfg_trainer = cfg_trainer
         self.train_data = self.data[indexs] # self.train_data[indexs]
         self.train_labels = np.array(self.targets)[indexs] # np.array(self.train_labels)[indexs]
+        self.data_index = np.arange(len(self.train_data))
         self.indexs = indexs
         self.prediction = np.zeros((len(self.train_data), self.num_classes, self.num_classes), dtype=np.float32)
         self.noise_indx = []
@@ -99,37 +110,14 @@ class CIFAR10_train(torchvision.datasets.CIFAR10):
     def symmetric_noise(self):
         self.train_labels_gt = self.train_labels.copy()
         fix_seed(self.seed)
-        indices = np.random.permutation(len(self.train_data))
-        for i, idx in enumerate(indices):
-            if i < self.cfg_trainer['percent'] * len(self.train_data):
-                self.noise_indx.append(idx)
-                self.train_labels[idx] = np.random.randint(self.num_classes, dtype=np.int32)
+        self.train_labels, noise_indx = symmetric_flip(self.train_labels_gt, self.num_classes, self.cfg_trainer['percent'])
+        self.noise_indx = noise_indx.tolist()
 
     def asymmetric_noise(self):
         self.train_labels_gt = copy.deepcopy(self.train_labels)
         fix_seed(self.seed)
-
-        for i in range(self.num_classes):
-            indices = np.where(self.train_labels == i)[0]
-            np.random.shuffle(indices)
-            for j, idx in enumerate(indices):
-                if j < self.cfg_trainer['percent'] * len(indices):
-                    self.noise_indx.append(idx)
-                    # truck -> automobile
-                    if i == 9:
-                        self.train_labels[idx] = 1
-                    # bird -> airplane
-                    elif i == 2:
-                        self.train_labels[idx] = 0
-                    # cat -> dog
-                    elif i == 3:
-                        self.train_labels[idx] = 5
-                    # dog -> cat
-                    elif i == 5:
-                        self.train_labels[idx] = 3
-                    # deer -> horse
-                    elif i == 4:
-                        self.train_labels[idx] = 7
+        self.train_labels, noise_indx = pair_flip(self.train_labels_gt, self.num_classes, self.cfg_trainer['percent'], CIFAR10_PAIRS)
+        self.noise_indx = noise_indx.tolist()
                         
     def instance_noise(self):
         '''
@@ -140,25 +128,13 @@ class CIFAR10_train(torchvision.datasets.CIFAR10):
         self.train_labels_gt = copy.deepcopy(self.train_labels)
         fix_seed(self.seed)
         
-        q_ = np.random.normal(loc=self.cfg_trainer['percent'], scale=0.1, size=int(1e6))
-        q = []
-        for pro in q_:
-            if 0 < pro < 1:
-                q.append(pro)
-            if len(q)==50000:
-                break
-                
-        w = np.random.normal(loc=0, scale=1, size=(32*32*3, 10))
-        for i, sample in enumerate(self.train_data):
-            sample = sample.flatten()
-            p_all = np.matmul(sample, w)
-            p_all[self.train_labels_gt[i]] = -int(1e6)
-            p_all = q[i] * F.softmax(torch.tensor(p_all), dim=0).numpy()
-            p_all[self.train_labels_gt[i]] = 1 - q[i]
-            self.train_labels[i] = np.random.choice(np.arange(10), p=p_all/sum(p_all))
+        self.train_labels = instance_noisify(self.train_data, self.train_labels_gt, self.cfg_trainer['percent'], self.num_classes)
         
     def truncate(self, teacher_idx):
-        self.train_data = self.train_data[teacher_idx]
+        '''
+        keep only the teacher_idx samples; the images stay shared, only their positions are indexed
+        '''
+        self.data_index = self.data_index[teacher_idx]
         self.train_labels = self.train_labels[teacher_idx]
         self.train_labels_gt = self.train_labels_gt[teacher_idx]       
         
@@ -170,7 +146,7 @@ class CIFAR10_train(torchvision.datasets.CIFAR10):
         Returns:
             tuple: (image, target) where target is index of the target class.
         """
-        img, target, target_gt = self.train_data[index], self.train_labels[index], self.train_labels_gt[index]
+        img, target, target_gt = self.train_data[self.data_index[index]], self.train_labels[index], self.train_labels_gt[index]
 
 
         # doing this so that it is consistent with all other datasets
@@ -184,10 +160,17 @@ class CIFAR10_train(torchvision.datasets.CIFAR10):
         if self.target_transform is not None:
             target = self.target_transform(target)
 
-        return img, target, index, target_gt
+        # the position in the full train split, also after truncate
+        return img, target, int(self.data_index[index]), target_gt
 
     def __len__(self):
-        return len(self.train_data)
+        return len(self.data_index)
+
+    def get_labels(self):
+        '''
+        noisy and ground-truth labels of the current samples, aligned with the dataset positions (row i is the sample of self[i])
+        '''
+        return self.train_labels, self.train_labels_gt
 
 class CIFAR10_val(torchvision.datasets.CIFAR10):
 
@@ -211,33 +194,10 @@ class CIFAR10_val(torchvision.datasets.CIFAR10):
         self.train_labels_gt = self.train_labels.copy()
         
     def symmetric_noise(self):
-        
-        indices = np.random.permutation(len(self.train_data))
-        for i, idx in enumerate(indices):
-            if i < self.cfg_trainer['percent'] * len(self.train_data):
-                self.train_labels[idx] = np.random.randint(self.num_classes, dtype=np.int32)
+        self.train_labels, _ = symmetric_flip(self.train_labels_gt, self.num_classes, self.cfg_trainer['percent'])
 
     def asymmetric_noise(self):
-        for i in range(self.num_classes):
-            indices = np.where(self.train_labels == i)[0]
-            np.random.shuffle(indices)
-            for j, idx in enumerate(indices):
-                if j < self.cfg_trainer['percent'] * len(indices):
-                    # truck -> automobile
-                    if i == 9:
-                        self.train_labels[idx] = 1
-                    # bird -> airplane
-                    elif i == 2:
-                        self.train_labels[idx] = 0
-                    # cat -> dog
-                    elif i == 3:
-                        self.train_labels[idx] = 5
-                    # dog -> cat
-                    elif i == 5:
-                        self.train_labels[idx] = 3
-                    # deer -> horse
-                    elif i == 4:
-                        self.train_labels[idx] = 7
+        self.train_labels, _ = pair_flip(self.train_labels_gt, self.num_classes, self.cfg_trainer['percent'], CIFAR10_PAIRS)
                         
                         
     def instance_noise(self):
@@ -245,27 +205,18 @@ class CIFAR10_val(torchvision.datasets.CIFAR10):
         Instance-dependent noise
         https://github.com/haochenglouis/cores/blob/main/data/utils.py
         '''
-        q_ = np.random.normal(loc=self.cfg_trainer['percent'], scale=0.1, size=int(1e6))
-        q = []
-        for pro in q_:
-            if 0 < pro < 1:
-                q.append(pro)
-            if len(q)==50000:
-                break
-                
-        w = np.random.normal(loc=0, scale=1, size=(32*32*3, 10))
-        for i, sample in enumerate(self.train_data):
-            sample = sample.flatten()
-            p_all = np.matmul(sample, w)
-            p_all[self.train_labels_gt[i]] = -int(1e6)
-            p_all = q[i] * F.softmax(torch.tensor(p_all), dim=0).numpy()
-            p_all[self.train_labels_gt[i]] = 1 - q[i]
-            self.train_labels[i] = np.random.choice(np.arange(10), p=p_all/sum(p_all))
+        self.train_labels = instance_noisify(self.train_data, self.train_labels_gt, self.cfg_trainer['percent'], self.num_classes)
                         
                         
     def __len__(self):
         return len(self.train_data)
 
+    def get_labels(self):
+        '''
+        noisy and ground-truth labels of the current samples, aligned with the returned indices
+        '''
+        return self.train_labels, self.train_labels_gt
+
 
     def __getitem__(self, index):
         """
@@ -11,6 +11,8 @@ import random
 import os
 import json
 from numpy.testing import assert_array_almost_equal
+from data_loader.noise import *
+from data_loader.registry import get_shared, shared_view
 
 def fix_seed(seed=888):
     np.random.seed(seed)
@@ -23,44 +25,52 @@ def fix_seed(seed=888):
 def get_cifar100(root, cfg_trainer, train=True,
                 transform_train=None, transform_val=None,
                 download=True, noise_file = '', teacher_idx=None, seed=888):
-    base_dataset = torchvision.datasets.CIFAR100(root, train=train, download=download)
     
-    print (seed)
+    # loaded, split and noisified once per process; every loader gets views of the shared arrays
+    key = ('cifar100', root, train, seed, cfg_trainer['percent'], cfg_trainer['asym'])
+    train_dataset, val_dataset = get_shared(key, lambda: build_cifar100(root, cfg_trainer, train=train, download=download, noise_file=noise_file, seed=seed))
     
     if train:
-        fix_seed(seed)
-        train_idxs, val_idxs = train_val_split(base_dataset.targets, seed)
-        
-        train_dataset = CIFAR100_train(root, cfg_trainer, train_idxs, train=True, transform=transform_train)
-        val_dataset = CIFAR100_val(root, cfg_trainer, val_idxs, train=train, transform=transform_val)
-        if cfg_trainer['asym']:
-            train_dataset.asymmetric_noise()
-            if len(val_dataset) > 0:
-                val_dataset.asymmetric_noise()
-        else:
-            train_dataset.symmetric_noise()
-            if len(val_dataset) > 0:
-                val_dataset.symmetric_noise()
-        
         if teacher_idx is not None:
             print(len(teacher_idx))
-            train_dataset.truncate(teacher_idx)
-        
+        train_dataset = shared_view(train_dataset, teacher_idx, transform=transform_train)
+        val_dataset = shared_view(val_dataset, transform=transform_val)
         print(f"Train: {len(train_dataset)} Val: {len(val_dataset)}")  # Train: 45000 Val: 5000
     else:
-        fix_seed(seed)
-        train_dataset = []
-        val_dataset = CIFAR100_val(root, cfg_trainer, None, train=train, transform=transform_val)
+        val_dataset = shared_view(val_dataset, transform=transform_val)
         print(f"Test: {len(val_dataset)}")
-
+    
     if len(val_dataset) == 0:
         return train_dataset, None
     else:
         return train_dataset, val_dataset
 
-#     return train_dataset, val_dataset
-
+def build_cifar100(root, cfg_trainer, train=True, download=True, noise_file='', seed=888):
+    '''
+    load, split and noisify CIFAR100, without transforms
+    '''
+    base_dataset = torchvision.datasets.CIFAR100(root, train=train, download=download)
+    
+    print (seed)
+    
+    if train:
+        fix_seed(seed)
+        train_idxs, val_idxs = train_val_split(base_dataset.targets, seed)
+        
+        # the noise of the train split is drawn with the default seed of CIFAR100_train, whatever the split seed
+        train_dataset = CIFAR100_train(root, cfg_trainer, train_idxs, train=True)
+        val_dataset = CIFAR100_val(root, cfg_trainer, val_idxs, train=train)
+        mode = 'asym' if cfg_trainer['asym'] else 'sym'
+        # the train noise reseeds np.random, the validation noise continues its stream
+        load_or_add_noise(train_dataset, mode, noise_file and noise_file + '_train.npz', seed=seed)
+        if len(val_dataset) > 0:
+            load_or_add_noise(val_dataset, mode, noise_file and noise_file + '_val.npz', seed=seed)
+    else:
+        fix_seed(seed)
+        train_dataset = []
+        val_dataset = CIFAR100_val(root, cfg_trainer, None, train=train)
 
+    return train_dataset, val_dataset
 
 def train_val_split(base_dataset: torchvision.datasets.CIFAR10, seed=888):
     fix_seed(seed)
@@ -92,6 +102,7 @@ class CIFAR100_train(torchvision.datasets.CIFAR100):
         self.cfg_trainer = cfg_trainer
         self.train_data = self.data[indexs]
         self.train_labels = np.array(self.targets)[indexs]
+        self.data_index = np.arange(len(self.train_data))
         self.indexs = indexs
         self.prediction = np.zeros((len(self.train_data), self.num_classes, self.num_classes), dtype=np.float32)
         self.noise_indx = []
@@ -103,87 +114,26 @@ class CIFAR100_train(torchvision.datasets.CIFAR100):
     def symmetric_noise(self):
         self.train_labels_gt = self.train_labels.copy()
         fix_seed(self.seed)
-        indices = np.random.permutation(len(self.train_data))
-        for i, idx in enumerate(indices):
-            if i < self.cfg_trainer['percent'] * len(self.train_data):
-                self.noise_indx.append(idx)
-                self.train_labels[idx] = np.random.randint(self.num_classes, dtype=np.int32)
-
-    def multiclass_noisify(self, y, P, random_state=0):
-        """ Flip classes according to transition probability matrix T.
-        It expects a number between 0 and the number of classes - 1.
-        """
-        fix_seed(self.seed)
-        assert P.shape[0] == P.shape[1]
-        assert np.max(y) < P.shape[0]
-
-        # row stochastic matrix
-        assert_array_almost_equal(P.sum(axis=1), np.ones(P.shape[1]))
-        assert (P >= 0.0).all()
-
-        m = y.shape[0]
-        new_y = y.copy()
-        flipper = np.random.RandomState(random_state)
-
-        for idx in np.arange(m):
-            i = y[idx]
-            # draw a vector with only an 1
-            flipped = flipper.multinomial(1, P[i, :], 1)[0]
-            new_y[idx] = np.where(flipped == 1)[0]
-
-        return new_y
-
-#     def build_for_cifar100(self, size, noise):
-#         """ random flip between two random classes.
-#         """
-#         assert(noise >= 0.) and (noise <= 1.)
-
-#         P = np.eye(size)
-#         cls1, cls2 = np.random.choice(range(size), size=2, replace=False)
-#         P[cls1, cls2] = noise
-#         P[cls2, cls1] = noise
-#         P[cls1, cls1] = 1.0 - noise
-#         P[cls2, cls2] = 1.0 - noise
-
-#         assert_array_almost_equal(P.sum(axis=1), 1, 1)
-#         return P
-    def build_for_cifar100(self, size, noise):
-        """ The noise matrix flips to the "next" class with probability 'noise'.
-        """
-
-        assert(noise >= 0.) and (noise <= 1.)
-
-        P = (1. - noise) * np.eye(size)
-        for i in np.arange(size - 1):
-            P[i, i + 1] = noise
-
-        # adjust last row
-        P[size - 1, 0] = noise
-
-        assert_array_almost_equal(P.sum(axis=1), 1, 1)
-        return P
-
+        self.train_labels, noise_indx = symmetric_flip(self.train_labels_gt, self.num_classes, self.cfg_trainer['percent'])
+        self.noise_indx = noise_indx.tolist()
 
     def asymmetric_noise(self, asym=False, random_shuffle=False):
         self.train_labels_gt = self.train_labels.copy()
-        P = np.eye(self.num_classes)
         n = self.cfg_trainer['percent']
-        nb_superclasses = 20
-        nb_subclasses = 5
         fix_seed(self.seed)
         if n > 0.0:
-            for i in np.arange(nb_superclasses):
-                init, end = i * nb_subclasses, (i+1) * nb_subclasses
-                P[init:end, init:end] = self.build_for_cifar100(nb_subclasses, n)
-
-            y_train_noisy = self.multiclass_noisify(self.train_labels, P=P,
-                                               random_state=0)
+            # flips to the next class inside each of the 20 superclasses
+            P = superclass_transition(self.num_classes, n, nb_subclasses=5)
+            y_train_noisy = noisify(self.train_labels, P, random_state=0)
             actual_noise = (y_train_noisy != self.train_labels).mean()
             assert actual_noise > 0.0
             self.train_labels = y_train_noisy
             
     def truncate(self, teacher_idx):
-        self.train_data = self.train_data[teacher_idx]
+        '''
+        keep only the teacher_idx samples; the images stay shared, only their positions are indexed
+        '''
+        self.data_index = self.data_index[teacher_idx]
         self.train_labels = self.train_labels[teacher_idx]
         self.train_labels_gt = self.train_labels_gt[teacher_idx]    
         
@@ -196,7 +146,7 @@ class CIFAR100_train(torchvision.datasets.CIFAR100):
         Returns:
             tuple: (image, target) where target is index of the target class.
         """
-        img, target, target_gt = self.train_data[index], self.train_labels[index],  self.train_labels_gt[index]
+        img, target, target_gt = self.train_data[self.data_index[index]], self.train_labels[index],  self.train_labels_gt[index]
 
 
         # doing this so that it is consistent with all other datasets
@@ -210,10 +160,17 @@ class CIFAR100_train(torchvision.datasets.CIFAR100):
         if self.target_transform is not None:
             target = self.target_transform(target)
 
-        return img, target, index, target_gt
+        # the position in the full train split, also after truncate
+        return img, target, int(self.data_index[index]), target_gt
 
     def __len__(self):
-        return len(self.train_data)
+        return len(self.data_index)
+
+    def get_labels(self):
+        '''
+        noisy and ground-truth labels of the current samples, aligned with the dataset positions (row i is the sample of self[i])
+        '''
+        return self.train_labels, self.train_labels_gt
 
 
 class CIFAR100_val(torchvision.datasets.CIFAR100):
@@ -236,74 +193,26 @@ class CIFAR100_val(torchvision.datasets.CIFAR100):
             self.train_data = self.data
             self.train_labels = np.array(self.targets)
         self.train_labels_gt = self.train_labels.copy()
-    def symmetric_noise(self):
-        indices = np.random.permutation(len(self.train_data))
-        for i, idx in enumerate(indices):
-            if i < self.cfg_trainer['percent'] * len(self.train_data):
-                self.train_labels[idx] = np.random.randint(self.num_classes, dtype=np.int32)
-
-    def multiclass_noisify(self, y, P, random_state=0):
-        """ Flip classes according to transition probability matrix T.
-        It expects a number between 0 and the number of classes - 1.
-        """
-        
-        print (P.shape[0] == P.shape[1])
-        print (max(y) < P.shape[0])
         
-        assert P.shape[0] == P.shape[1]
-        assert np.max(y) < P.shape[0]
-
-        # row stochastic matrix
-        assert_array_almost_equal(P.sum(axis=1), np.ones(P.shape[1]))
-        assert (P >= 0.0).all()
-
-        m = y.shape[0]
-        new_y = y.copy()
-        flipper = np.random.RandomState(random_state)
-
-        for idx in np.arange(m):
-            i = y[idx]
-            # draw a vector with only an 1
-            flipped = flipper.multinomial(1, P[i, :], 1)[0]
-            new_y[idx] = np.where(flipped == 1)[0]
-
-        return new_y
-
-    def build_for_cifar100(self, size, noise):
-        """ random flip between two random classes.
-        """
-        assert(noise >= 0.) and (noise <= 1.)
-
-        P = np.eye(size)
-        cls1, cls2 = np.random.choice(range(size), size=2, replace=False)
-        P[cls1, cls2] = noise
-        P[cls2, cls1] = noise
-        P[cls1, cls1] = 1.0 - noise
-        P[cls2, cls2] = 1.0 - noise
-
-        assert_array_almost_equal(P.sum(axis=1), 1, 1)
-        return P
-
+    def symmetric_noise(self):
+        self.train_labels, _ = symmetric_flip(self.train_labels_gt, self.num_classes, self.cfg_trainer['percent'])
 
     def asymmetric_noise(self, asym=False, random_shuffle=False):
-        P = np.eye(self.num_classes)
         n = self.cfg_trainer['percent']
-        nb_superclasses = 20
-        nb_subclasses = 5
-        
         if n > 0.0:
-            for i in np.arange(nb_superclasses):
-                init, end = i * nb_subclasses, (i+1) * nb_subclasses
-                P[init:end, init:end] = self.build_for_cifar100(nb_subclasses, n)
-
-            y_train_noisy = self.multiclass_noisify(self.train_labels, P=P,
-                                               random_state=0)
-            actual_noise = (y_train_noisy != self.train_labels).mean()
-            assert actual_noise > 0.0
-            self.train_labels = y_train_noisy
+            # swaps two random classes inside each of the 20 superclasses
+            P = random_pair_transition(self.num_classes, n, nb_subclasses=5)
+            self.train_labels = noisify(self.train_labels_gt, P, random_state=0)
+            
     def __len__(self):
         return len(self.train_data)
 
+    def get_labels(self):
+        '''
+        noisy and ground-truth labels of the current samples, aligned with the returned indices
+        '''
+        return self.train_labels, self.train_labels_gt
+
 
     def __getitem__(self, index):
         """
@@ -8,6 +8,11 @@ from sklearn.metrics.pairwise import cosine_similarity, euclidean_distances
 import torch
 import torch.nn.functional as F
 import random
+from data_loader.registry import get_shared, shared_view
+from selection.util import ClassIndex
+from data_loader.shards import ShardStore
+from data_loader.jpeg import open_rgb
+from data_loader.tar_stream import store_shards
 
 def fix_seed(seed=777):
     np.random.seed(seed)
@@ -18,113 +23,212 @@ def fix_seed(seed=777):
     np.random.seed(seed)
 
 def get_clothing1m(root, cfg_trainer, num_samples=0, train=True,
-                transform_train=None, transform_val=None, teacher_idx=None, seed=8888):
+                transform_train=None, transform_val=None, teacher_idx=None, seed=8888, shard_dir=None, draft=None, tar_dir=None):
+
+    # the annotations are parsed once per process; every loader gets views of the shared datasets
+    key = ('clothing1m', root, num_samples, train, seed, shard_dir, tar_dir)
+    train_dataset, val_dataset = get_shared(key, lambda: build_clothing1m(root, cfg_trainer, num_samples=num_samples, train=train, seed=seed, shard_dir=shard_dir, tar_dir=tar_dir))
 
     if train:
-        fix_seed(seed)
-        train_dataset = Clothing1M_Dataset(root, cfg_trainer, num_samples=num_samples, train=train, transform=transform_train, seed=seed)
-        val_dataset = Clothing1M_Dataset(root, cfg_trainer, val=train, transform=transform_val)
+        if teacher_idx is not None:
+            print (len(teacher_idx))
+        train_dataset = shared_view(train_dataset, teacher_idx, transform=transform_train, draft=draft)
+        val_dataset = shared_view(val_dataset, transform=transform_val, draft=draft)
         print(f"Train: {len(train_dataset)} Val: {len(val_dataset)}")
+    else:
+        val_dataset = shared_view(val_dataset, transform=transform_val, draft=draft)
+        print(f"Test: {len(val_dataset)}")
 
+    return train_dataset, val_dataset
+
+def build_clothing1m(root, cfg_trainer, num_samples=0, train=True, seed=8888, shard_dir=None, tar_dir=None):
+    '''
+    parse the Clothing1M annotations and sample the train subset, without transforms;
+    with tar_dir, the train subset is drawn from few shards of that tar store
+    '''
+    if train:
+        fix_seed(seed)
+        train_dataset = Clothing1M_Dataset(root, cfg_trainer, num_samples=num_samples, train=train, seed=seed, shard_dir=shard_dir, tar_dir=tar_dir)
+        val_dataset = Clothing1M_Dataset(root, cfg_trainer, val=train, shard_dir=shard_dir)
     else:
         fix_seed(seed)
         train_dataset = []
-        val_dataset = Clothing1M_Dataset(root, cfg_trainer, test= (not train), transform=transform_val)
-        print(f"Test: {len(val_dataset)}")
-        
-    if teacher_idx is not None and train is True:
-        print (len(teacher_idx))
-        train_dataset.truncate(teacher_idx)
+        val_dataset = Clothing1M_Dataset(root, cfg_trainer, test= (not train), shard_dir=shard_dir)
 
     return train_dataset, val_dataset
 
+def balanced_subset(class_index, num_samples, rng, num_class=14, blocks=None):
+    '''
+    Class-balanced random subset of the samples of class_index (a selection.util.ClassIndex): a uniform draw of
+    ceil(num_samples / num_class) samples of every class (all of a smaller class), at most num_samples in total, in
+    random order. The same distribution as scanning a shuffled list with per-class quotas, in O(num_samples) numpy draws.
+    blocks: block (tar shard) of every sample; the samples of a class are then taken block by block, the blocks
+    in random order and the samples of the last block at random, so a draw reads as few blocks as possible.
+    In a store packed class by class in random order (tar_stream.class_grouped_keys) every block is itself a
+    random sample of its class
+    '''
+    quota = int(np.ceil(num_samples / num_class))
+    if blocks is None:
+        picked = [idx[rng.choice(len(idx), min(quota, len(idx)), replace=False)] for _, idx in class_index.items()]
+    else:
+        picked = []
+        for _, idx in class_index.items():
+            idx_blocks = blocks[idx]
+            names = np.unique(idx_blocks)
+            rank = rng.permutation(len(names))[np.searchsorted(names, idx_blocks)]
+            picked.append(idx[np.lexsort((rng.random(len(idx)), rank))[:quota]])
+    picked = np.concatenate(picked) if picked else np.empty(0, dtype=np.int64)
+    return rng.permutation(picked)[:num_samples]
+
+INDEX_FILES = ('paths', 'path_offsets', 'noisy_labels', 'clean_labels', 'train_ids', 'val_ids', 'test_ids')
+
+def build_annotation_index(root, index_dir=None):
+    '''
+    One-time conversion of the Clothing1M annotation text files into a binary index (index_dir, default
+    <root>/annotations/index) of .npy files that can be memory-mapped:
+    paths (uint8 blob of every image path relative to root) and path_offsets (int64, n + 1) give path i as
+    paths[path_offsets[i]:path_offsets[i+1]]; noisy_labels and clean_labels (int16, -1 when the image has none)
+    are indexed by path id; train_ids, val_ids and test_ids (int32) are the key lists in file order.
+    Returns the arrays as a dict.
+    '''
+    if index_dir is None:
+        index_dir = os.path.join(root, 'annotations', 'index')
+    path_ids = {}
+    def read_kv(name):
+        ids, labels = [], []
+        with open('%s/annotations/%s'%(root, name),'r') as f:
+            for l in f.read().splitlines():
+                entry = l.split()
+                ids.append(path_ids.setdefault(entry[0][7:], len(path_ids)))
+                labels.append(int(entry[1]))
+        return ids, labels
+    def read_keys(name):
+        with open('%s/annotations/%s'%(root, name),'r') as f:
+            return np.array([path_ids.setdefault(l[7:], len(path_ids)) for l in f.read().splitlines()], dtype=np.int32)
+
+    noisy_ids, noisy = read_kv('noisy_label_kv.txt')
+    clean_ids, clean = read_kv('clean_label_kv.txt')
+    index = {'train_ids': read_keys('noisy_train_key_list.txt'),
+             'val_ids': read_keys('clean_val_key_list.txt'),
+             'test_ids': read_keys('clean_test_key_list.txt')}
+
+    encoded = [path.encode() for path in path_ids]
+    index['paths'] = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+    index['path_offsets'] = np.concatenate([[0], np.cumsum([len(p) for p in encoded])]).astype(np.int64)
+    for name, ids, labels in (('noisy_labels', noisy_ids, noisy), ('clean_labels', clean_ids, clean)):
+        index[name] = np.full(len(path_ids), -1, dtype=np.int16)
+        index[name][ids] = labels
+
+    # write a temporary directory then rename it, so concurrent runs never read a partial index
+    tmp_dir = '%s.%d.tmp' % (index_dir, os.getpid())
+    try:
+        os.makedirs(tmp_dir, exist_ok=True)
+        for name in INDEX_FILES:
+            np.save(os.path.join(tmp_dir, name + '.npy'), index[name])
+        os.replace(tmp_dir, index_dir)
+    except OSError:
+        print('could not save the annotation index to %s' % index_dir)
+    return index
+
+def get_annotation_index(root, index_dir=None):
+    '''
+    the memory-mapped annotation index of root, built by build_annotation_index when missing
+    '''
+    if index_dir is None:
+        index_dir = os.path.join(root, 'annotations', 'index')
+    if not os.path.isdir(index_dir):
+        return build_annotation_index(root, index_dir)
+    return {name: np.load(os.path.join(index_dir, name + '.npy'), mmap_mode='r') for name in INDEX_FILES}
+
 class Clothing1M_Dataset(torch.utils.data.Dataset):
 
-    def __init__(self, root, cfg_trainer, num_samples=0, train=False, val=False, test=False, transform=None, num_class=14, seed=8888):
+    def __init__(self, root, cfg_trainer, num_samples=0, train=False, val=False, test=False, transform=None, num_class=14, seed=8888, shard_dir=None, tar_dir=None):
         
         fix_seed(seed)
         self.cfg_trainer = cfg_trainer
         self.root = root
         self.transform = transform
-        self.train_labels = {}
-        self.test_labels = {}
-        self.val_labels = {}  
 
         self.train  = train
         self.val = val
         self.test = test
 
-        with open('%s/annotations/noisy_label_kv.txt'%self.root,'r') as f:
-            lines = f.read().splitlines()
-            for l in lines:
-                entry = l.split()           
-                img_path = '%s/'%self.root+entry[0][7:]
-                self.train_labels[img_path] = int(entry[1])                         
-        with open('%s/annotations/clean_label_kv.txt'%self.root,'r') as f:
-            lines = f.read().splitlines()
-            for l in lines:
-                entry = l.split()           
-                img_path = '%s/'%self.root+entry[0][7:]
-                self.test_labels[img_path] = int(entry[1])  
-
-        if train:          
-            train_imgs=[]
-            with open('%s/annotations/noisy_train_key_list.txt'%self.root,'r') as f:
-                lines = f.read().splitlines()
-                for i , l in enumerate(lines):
-                    img_path = '%s/'%self.root+l[7:]
-                    train_imgs.append((i,img_path)) 
-            self.num_raw_example = len(train_imgs)                              
-            random.shuffle(train_imgs)
-            class_num = torch.zeros(num_class)
-            self.train_imgs = []
-            self.train_labels_ = []
-            for id_raw, impath in train_imgs:
-                label = self.train_labels[impath]
-                if class_num[label] < (num_samples/14) and len(self.train_imgs)<num_samples:
-                    self.train_imgs.append((id_raw,impath))
-                    self.train_labels_.append(int(label))
-                    class_num[label]+=1
-#                 else:
-#                     print (label, class_num[label], (num_samples/14))
-            random.shuffle(self.train_imgs)
-            self.train_imgs = np.array(self.train_imgs)
-            self.train_labels_ = np.array(self.train_labels_)
+        # memory-mapped binary index of the annotations, converted from the text files on the first use
+        index = get_annotation_index(self.root)
+        self.path_blob, self.path_offsets = index['paths'], index['path_offsets']
+        self.noisy_labels, self.clean_labels = index['noisy_labels'], index['clean_labels']
+        # pre-decoded images packed in path-id order (data_loader/shards.py), read instead of the JPEGs
+        self.shards = None
+        if shard_dir is not None:
+            self.shards = ShardStore(shard_dir)
+            assert len(self.shards) == len(self.path_offsets) - 1, 'the shard store does not match the annotation index'
+        # shorter side of the JPEG draft decode (data_loader/jpeg.py), full resolution when None
+        self.draft = None
+
+        if train:
+            # train_imgs holds positions in noisy_train_key_list.txt (the raw ids); the returned indices are
+            # positions in the drawn subset (data_index, kept through truncate), as for the other datasets
+            self.train_ids = index['train_ids']
+            self.num_samples, self.num_class = num_samples, num_class
+            # per-class table of the raw ids, built once for every later draw
+            self.class_index = ClassIndex(self.noisy_labels[self.train_ids])
+            # tar shard of every raw id when the images are streamed from tar_dir, the draws then read few shards
+            self.train_shards = None
+            if tar_dir is not None:
+                self.train_shards = store_shards(tar_dir, [self.path_key(i) for i in self.train_ids])
+            self.rng = np.random.default_rng(seed)
+            self.resample()
 
         elif test:
-            self.test_imgs = []
-            with open('%s/annotations/clean_test_key_list.txt'%self.root,'r') as f:
-                lines = f.read().splitlines()
-                for l in lines:
-                    img_path = '%s/'%self.root+l[7:]
-                    self.test_imgs.append(img_path)            
+            self.test_imgs = index['test_ids']
         elif val:
-            self.val_imgs = []
-            with open('%s/annotations/clean_val_key_list.txt'%self.root,'r') as f:
-                lines = f.read().splitlines()
-                for l in lines:
-                    img_path = '%s/'%self.root+l[7:]
-                    self.val_imgs.append(img_path)
+            self.val_imgs = index['val_ids']
 
-    def __getitem__(self, index):
+    def resample(self, seed=None):
+        '''
+        draw a fresh class-balanced subset of num_samples train images (e.g. once per epoch);
+        seed restarts the generator of the draws
+        '''
+        if seed is not None:
+            self.rng = np.random.default_rng(seed)
+        self.train_imgs = balanced_subset(self.class_index, self.num_samples, self.rng, self.num_class, blocks=self.train_shards)
+        self.train_labels_ = np.asarray(self.noisy_labels[self.train_ids[self.train_imgs]], dtype=np.int64)
+        self.data_index = np.arange(len(self.train_imgs))
+        self.num_raw_example = len(self.train_imgs)
+
+    def path_key(self, path_id):
+        return self.path_blob[self.path_offsets[path_id]:self.path_offsets[path_id+1]].tobytes().decode()
+
+    def image_path(self, path_id):
+        return '%s/%s' % (self.root, self.path_key(path_id))
+
+    def path_id(self, index):
         if self.train:
-            id_raw, img_path = self.train_imgs[index]
-            target = self.train_labels[img_path]     
+            return self.train_ids[self.train_imgs[index]]
         elif self.val:
-            img_path = self.val_imgs[index]
-            target = self.test_labels[img_path]   
-        elif self.test:
-            img_path = self.test_imgs[index]
-            target = self.test_labels[img_path] 
-        image = Image.open(img_path).convert('RGB')
-        if self.train:
-            img0 = self.transform(image)
-        
-        if self.test or self.val:
-            img = self.transform(image)
-            return img, target, index, target
+            return self.val_imgs[index]
+        return self.test_imgs[index]
+
+    def __getitem__(self, index):
+        path_id = self.path_id(index)
+        if self.shards is not None:
+            image = self.shards.image(path_id)
         else:
-            return img0, target, id_raw, target
+            image = open_rgb(self.image_path(path_id), self.draft)
+        return self.sample(index, image)
+
+    def sample(self, index, image):
+        '''
+        the sample of index for its decoded image (shared with the tar stream of data_loader/tar_stream.py)
+        '''
+        if self.train:
+            target = int(self.train_labels_[index])
+            return self.transform(image), target, int(self.data_index[index]), target
+        target = int(self.clean_labels[self.path_id(index)])
+        return self.transform(image), target, index, target
+
+    def stream_keys(self):
+        return [self.path_key(self.path_id(i)) for i in range(len(self))]
 
     def __len__(self):
         if self.test:
@@ -144,6 +248,18 @@ class Clothing1M_Dataset(torch.utils.data.Dataset):
                 imlist.append((impath, int(imlabel)))
         return imlist
     
+    def get_labels(self):
+        '''
+        noisy and ground-truth labels aligned with the sample positions; there are no clean labels
+        for the train split, so both are the noisy ones, as returned by __getitem__
+        '''
+        if self.train:
+            return self.train_labels_, self.train_labels_
+        imgs = self.val_imgs if self.val else self.test_imgs
+        labels = np.asarray(self.clean_labels[imgs], dtype=np.int64)
+        return labels, labels
+    
     def truncate(self, teacher_idx):
         self.train_imgs = self.train_imgs[teacher_idx]
+        self.data_index = self.data_index[teacher_idx]
         self.train_labels_ = self.train_labels_[teacher_idx]
\ No newline at end of file
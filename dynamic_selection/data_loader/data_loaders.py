@@ -1,4 +1,5 @@
 import sys
+import os
 
 from torchvision import datasets, transforms
 from base import BaseDataLoader
@@ -6,11 +7,20 @@ from data_loader.cifar10 import get_cifar10
 from data_loader.cifar100 import get_cifar100
 from data_loader.clothing1m import get_clothing1m
 from data_loader.webvision import get_webvision
+from data_loader.augment import *
+from data_loader.tar_stream import TarStream
 from utils.parse_config import ConfigParser
 from PIL import Image
+from torch.utils.data.dataloader import default_collate
+
+def loader_option(config, name, value, default=None):
+    '''
+    an explicit loader argument, else the entry of the data_loader args in the config
+    '''
+    return value if value is not None else config['data_loader']['args'].get(name, default)
 
 class CIFAR10DataLoader(BaseDataLoader):
-    def __init__(self, data_dir, batch_size, shuffle=True, validation_split=0.0, num_batches=0,  training=True, num_workers=4,  pin_memory=True, config=None, teacher_idx=None, seed=888):
+    def __init__(self, data_dir, batch_size, shuffle=True, validation_split=0.0, num_batches=0,  training=True, num_workers=4,  pin_memory=True, config=None, teacher_idx=None, seed=888, persistent=False, batch_augment=False, tensor_cache=None, tensor_cache_dtype=None):
         if config == None:
             config = ConfigParser.get_instance()
         cfg_trainer = config['trainer']
@@ -25,15 +35,24 @@ class CIFAR10DataLoader(BaseDataLoader):
             transforms.ToTensor(),
             transforms.Normalize((0.4914, 0.4822, 0.4465), (0.2023, 0.1994, 0.2010)),
         ])
+        # batch_augment: crop, flip and normalize whole uint8 batches in the collate_fn instead of per-sample PIL transforms
+        collate_fn = val_collate_fn = default_collate
+        if batch_augment or config['data_loader']['args'].get('batch_augment', False):
+            transform_train = transform_val = to_uint8_tensor
+            collate_fn = BatchAugmentCollate(BatchAugment((0.4914, 0.4822, 0.4465), (0.2023, 0.1994, 0.2010), padding=4, flip=True))
+            val_collate_fn = BatchAugmentCollate(BatchAugment((0.4914, 0.4822, 0.4465), (0.2023, 0.1994, 0.2010)))
         self.data_dir = data_dir
 
-        noise_file='%sCIFAR10_%.1f_Asym_%s.json'%(config['data_loader']['args']['data_dir'],cfg_trainer['percent'],cfg_trainer['asym'])
+        # prefix of the noisy-label cache, get_cifar10 appends the split
+        noise_mode = 'instance' if cfg_trainer['instance'] else ('asym' if cfg_trainer['asym'] else 'sym')
+        noise_file=os.path.join(config['data_loader']['args']['data_dir'], 'CIFAR10_%.2f_%s_seed%d'%(cfg_trainer['percent'],noise_mode,seed))
         
         self.train_dataset, self.val_dataset = get_cifar10(config['data_loader']['args']['data_dir'], cfg_trainer, train=training, transform_train=transform_train, 
                                                            transform_val=transform_val, noise_file=noise_file, teacher_idx=teacher_idx, seed=seed)
 
         super().__init__(self.train_dataset, batch_size, shuffle, validation_split, num_workers, pin_memory,
-                         val_dataset = self.val_dataset)
+                         collate_fn=collate_fn, val_dataset = self.val_dataset, persistent=persistent, val_collate_fn=val_collate_fn,
+                         tensor_cache=loader_option(config, 'tensor_cache', tensor_cache), tensor_cache_dtype=loader_option(config, 'tensor_cache_dtype', tensor_cache_dtype, 'float16'))
         
     def run_loader(self, batch_size, shuffle, validation_split, num_workers, pin_memory):
         super().__init__(self.train_dataset, batch_size, shuffle, validation_split, num_workers, pin_memory,
@@ -42,7 +61,7 @@ class CIFAR10DataLoader(BaseDataLoader):
 
 
 class CIFAR100DataLoader(BaseDataLoader):
-    def __init__(self, data_dir, batch_size, shuffle=True, validation_split=0.0, num_batches=0, training=True, num_workers=4,  pin_memory=True, config=None, teacher_idx=None, seed=888):
+    def __init__(self, data_dir, batch_size, shuffle=True, validation_split=0.0, num_batches=0, training=True, num_workers=4,  pin_memory=True, config=None, teacher_idx=None, seed=888, persistent=False, batch_augment=False, tensor_cache=None, tensor_cache_dtype=None):
         
         if config is None:
             config = ConfigParser.get_instance()
@@ -59,22 +78,31 @@ class CIFAR100DataLoader(BaseDataLoader):
             transforms.ToTensor(),
             transforms.Normalize((0.5071, 0.4867, 0.4408), (0.2675, 0.2565, 0.2761)),
         ])
+        # batch_augment: crop, flip and normalize whole uint8 batches in the collate_fn instead of per-sample PIL transforms
+        collate_fn = val_collate_fn = default_collate
+        if batch_augment or config['data_loader']['args'].get('batch_augment', False):
+            transform_train = transform_val = to_uint8_tensor
+            collate_fn = BatchAugmentCollate(BatchAugment((0.5071, 0.4867, 0.4408), (0.2675, 0.2565, 0.2761), padding=4, flip=True))
+            val_collate_fn = BatchAugmentCollate(BatchAugment((0.5071, 0.4867, 0.4408), (0.2675, 0.2565, 0.2761)))
         self.data_dir = data_dir
 #         cfg_trainer = config['trainer']
 
-        noise_file='%sCIFAR100_%.1f_Asym_%s.json'%(config['data_loader']['args']['data_dir'],cfg_trainer['percent'],cfg_trainer['asym'])
+        # prefix of the noisy-label cache, get_cifar100 appends the split
+        noise_mode = 'asym' if cfg_trainer['asym'] else 'sym'
+        noise_file=os.path.join(config['data_loader']['args']['data_dir'], 'CIFAR100_%.2f_%s_seed%d'%(cfg_trainer['percent'],noise_mode,seed))
 
         self.train_dataset, self.val_dataset = get_cifar100(config['data_loader']['args']['data_dir'], cfg_trainer, train=training, transform_train=transform_train, 
                                                             transform_val=transform_val, noise_file = noise_file, teacher_idx=teacher_idx, seed=seed)
 
         super().__init__(self.train_dataset, batch_size, shuffle, validation_split, num_workers, pin_memory,
-                         val_dataset = self.val_dataset)
+                         collate_fn=collate_fn, val_dataset = self.val_dataset, persistent=persistent, val_collate_fn=val_collate_fn,
+                         tensor_cache=loader_option(config, 'tensor_cache', tensor_cache), tensor_cache_dtype=loader_option(config, 'tensor_cache_dtype', tensor_cache_dtype, 'float16'))
     def run_loader(self, batch_size, shuffle, validation_split, num_workers, pin_memory):
         super().__init__(self.train_dataset, batch_size, shuffle, validation_split, num_workers, pin_memory,
                          val_dataset = self.val_dataset)
         
 class Clothing1MDataLoader(BaseDataLoader):
-    def __init__(self, data_dir, batch_size, shuffle=True, validation_split=0.0, num_batches=0, training=True, num_workers=4, pin_memory=True, config=None, teacher_idx=None, seed=8888):
+    def __init__(self, data_dir, batch_size, shuffle=True, validation_split=0.0, num_batches=0, training=True, num_workers=4, pin_memory=True, config=None, teacher_idx=None, seed=8888, persistent=False, tensor_cache=None, tensor_cache_dtype=None, shard_dir=None, jpeg_draft=None, tar_dir=None):
 
         self.batch_size = batch_size
         self.num_workers = num_workers
@@ -99,16 +127,26 @@ class Clothing1MDataLoader(BaseDataLoader):
         if config == None:
             config = ConfigParser.get_instance()
         cfg_trainer = config['trainer']
+        # train images streamed from tar shards with sequential reads (data_loader/tar_stream.py)
+        tar_dir = loader_option(config, 'tar_dir', tar_dir) if training else None
         self.train_dataset, self.val_dataset = get_clothing1m(config['data_loader']['args']['data_dir'], cfg_trainer, num_samples=self.num_batches*self.batch_size, train=training,
 #         self.train_dataset, self.val_dataset = get_clothing1m(config['data_loader']['args']['data_dir'], cfg_trainer, num_samples=260000, train=training,
-                transform_train=self.transform_train, transform_val=self.transform_val, teacher_idx=teacher_idx, seed=seed)
+                transform_train=self.transform_train, transform_val=self.transform_val, teacher_idx=teacher_idx, seed=seed,
+                shard_dir=loader_option(config, 'shard_dir', shard_dir),
+                # JPEGs decoded at the smallest DCT scale that still covers the Resize(256) above
+                draft=256 if loader_option(config, 'jpeg_draft', jpeg_draft) else None,
+                # the train subset is drawn from few shards of the tar store
+                tar_dir=tar_dir)
+        if tar_dir is not None:
+            self.train_dataset = TarStream(self.train_dataset, tar_dir)
 
         super().__init__(self.train_dataset, batch_size, shuffle, validation_split, num_workers, pin_memory,
-                         val_dataset = self.val_dataset)
+                         val_dataset = self.val_dataset, persistent=persistent,
+                         tensor_cache=loader_option(config, 'tensor_cache', tensor_cache), tensor_cache_dtype=loader_option(config, 'tensor_cache_dtype', tensor_cache_dtype, 'float16'))
         
         
 class WebvisionDataLoader(BaseDataLoader):
-    def __init__(self, data_dir, batch_size, shuffle=True, validation_split=0.0, num_batches=0, training=True, num_workers=4, pin_memory=True, num_class=50, teacher_idx=None):
+    def __init__(self, data_dir, batch_size, shuffle=True, validation_split=0.0, num_batches=0, training=True, num_workers=4, pin_memory=True, num_class=50, teacher_idx=None, persistent=False, tensor_cache=None, tensor_cache_dtype=None, shard_dir=None, tar_dir=None):
 
         self.batch_size = batch_size
         self.num_workers = num_workers
@@ -137,8 +175,14 @@ class WebvisionDataLoader(BaseDataLoader):
         config = ConfigParser.get_instance()
         cfg_trainer = config['trainer']
         self.train_dataset, self.val_dataset = get_webvision(config['data_loader']['args']['data_dir'], cfg_trainer, num_samples=self.num_batches*self.batch_size, train=training,
-                transform_train=self.transform_train, transform_val=self.transform_val, num_class=num_class, teacher_idx=teacher_idx)
+                transform_train=self.transform_train, transform_val=self.transform_val, num_class=num_class, teacher_idx=teacher_idx,
+                shard_dir=loader_option(config, 'shard_dir', shard_dir))
+        # train images streamed from tar shards with sequential reads (data_loader/tar_stream.py)
+        tar_dir = loader_option(config, 'tar_dir', tar_dir)
+        if training and tar_dir is not None:
+            self.train_dataset = TarStream(self.train_dataset, tar_dir)
 
         super().__init__(self.train_dataset, batch_size, shuffle, validation_split, num_workers, pin_memory,
-                         val_dataset = self.val_dataset)
+                         val_dataset = self.val_dataset, persistent=persistent,
+                         tensor_cache=loader_option(config, 'tensor_cache', tensor_cache), tensor_cache_dtype=loader_option(config, 'tensor_cache_dtype', tensor_cache_dtype, 'float16'))
 
@@ -0,0 +1,75 @@
+import argparse
+import os
+import time
+import numpy as np
+import torch
+from PIL import Image
+from torch.utils.data import DataLoader
+
+__all__ = ['open_rgb', 'draft_agreement']
+
+
+def open_rgb(path, draft=None):
+    '''
+    open path as an RGB image. With draft (the shorter side the transforms resize to), a JPEG is decoded
+    at the smallest DCT scale (1/2, 1/4 or 1/8) whose output still covers draft x draft, instead of at full
+    resolution; other formats and images already below that size are decoded as usual
+    '''
+    image = Image.open(path)
+    if draft is not None and image.format == 'JPEG':
+        image.draft('RGB', (draft, draft))
+    return image.convert('RGB')
+
+def _predict(model, dataset, device, batch_size, num_workers):
+    loader = DataLoader(dataset, batch_size=batch_size, shuffle=False, num_workers=num_workers)
+    preds, targets = [], []
+    with torch.no_grad():
+        for data, target, *_ in loader:
+            # the models of the repo return (features, logits)
+            _, logits = model(data.to(device))
+            preds.append(logits.argmax(dim=1).cpu())
+            targets.append(target)
+    return torch.cat(preds), torch.cat(targets)
+
+def draft_agreement(model, dataset, n, draft, batch_size=128, num_workers=4):
+    '''
+    Check of the draft decode on held-out data: top-1 accuracy of model on the first n samples of dataset
+    decoded at full resolution and with draft, and the fraction of samples whose prediction is the same
+    '''
+    model.eval()
+    device = next(model.parameters()).device
+    subset = torch.utils.data.Subset(dataset, range(min(n, len(dataset))))
+    results = []
+    for d in (None, draft):
+        dataset.draft = d
+        results.append(_predict(model, subset, device, batch_size, num_workers))
+    dataset.draft = None
+    (full, target), (drafted, _) = results
+    return {'acc_full': (full == target).float().mean().item(),
+            'acc_draft': (drafted == target).float().mean().item(),
+            'agreement': (full == drafted).float().mean().item()}
+
+def _paths(dataset, root, n):
+    if dataset == 'clothing1m':
+        from data_loader.clothing1m import get_annotation_index
+        index = get_annotation_index(root)
+        blob, offsets = index['paths'], index['path_offsets']
+        ids = index['test_ids'][:n]
+        return ['%s/%s' % (root, blob[offsets[i]:offsets[i+1]].tobytes().decode()) for i in ids]
+    with open(os.path.join(root, 'imagenet', 'imagenet_val.txt')) as f:
+        return [os.path.join(root, 'imagenet', 'val', line.split()[0]) for line in f.readlines()[:n]]
+
+if __name__ == '__main__':
+    args = argparse.ArgumentParser(description='decode time of JPEGs at full resolution and in draft mode')
+    args.add_argument('dataset', choices=['clothing1m', 'imagenet'])
+    args.add_argument('root', type=str, help='dataset root (the data_dir of the config)')
+    args.add_argument('--draft', type=int, default=256, help='shorter side the transforms resize to')
+    args.add_argument('-n', type=int, default=1000, help='number of held-out images')
+    args = args.parse_args()
+
+    paths = _paths(args.dataset, args.root, args.n)
+    for draft in (None, args.draft):
+        start = time.time()
+        sizes = [open_rgb(path, draft).size for path in paths]
+        elapsed = time.time() - start
+        print('draft %s: %.2f ms/image, mean size %s' % (draft, 1000. * elapsed / len(paths), tuple(np.mean(sizes, axis=0).astype(int))))
@@ -0,0 +1,147 @@
+import os
+import numpy as np
+from numpy.testing import assert_array_almost_equal
+
+# asymmetric CIFAR-10 noise: truck -> automobile, bird -> airplane, cat <-> dog, deer -> horse
+CIFAR10_PAIRS = {9: 1, 2: 0, 3: 5, 5: 3, 4: 7}
+
+NOISE_METHODS = {'sym': 'symmetric_noise', 'asym': 'asymmetric_noise', 'instance': 'instance_noise'}
+
+
+def _flip_count(percent, n):
+    # the first ceil(percent * n) of n shuffled samples, as the per-sample loops counted them (i < percent * n)
+    return min(n, int(np.ceil(percent * n)))
+
+def symmetric_flip(labels, num_classes, percent, rng=np.random):
+    '''
+    Relabel exactly ceil(percent * n) samples, the head of a random permutation, with uniformly drawn classes
+    (possibly the same one). rng is consumed as by the per-sample loop: the permutation, then one draw per sample.
+    Returns the noisy labels and the relabelled samples
+    '''
+    labels = np.array(labels)
+    flipped = rng.permutation(len(labels))[:_flip_count(percent, len(labels))]
+    labels[flipped] = rng.randint(num_classes, size=len(flipped), dtype=np.int32)
+    return labels, flipped
+
+def pair_flip(labels, num_classes, percent, pairs, rng=np.random):
+    '''
+    Class by class, shuffle the samples of the class and flip exactly ceil(percent * n_class) of them to pairs[class];
+    classes without a pair are shuffled too but keep their labels. As in the per-sample loop, a class is read after
+    the flips of the classes before it (dog -> cat also sees the samples cat -> dog just moved).
+    Returns the noisy labels and the picked samples
+    '''
+    labels = np.array(labels)
+    picked = []
+    for cls in range(num_classes):
+        indices = np.flatnonzero(labels == cls)
+        rng.shuffle(indices)
+        indices = indices[:_flip_count(percent, len(indices))]
+        if cls in pairs:
+            labels[indices] = pairs[cls]
+        picked.append(indices)
+    return labels, np.concatenate(picked)
+
+def superclass_transition(num_classes, noise, nb_subclasses=5):
+    '''
+    flips to the "next" class inside every superclass of nb_subclasses consecutive classes with probability noise
+    '''
+    block = (1. - noise) * np.eye(nb_subclasses) + noise * np.roll(np.eye(nb_subclasses), 1, axis=1)
+    return np.kron(np.eye(num_classes // nb_subclasses), block)
+
+def random_pair_transition(num_classes, noise, nb_subclasses=5, rng=np.random):
+    '''
+    swaps two randomly drawn classes of every superclass of nb_subclasses consecutive classes with probability noise
+    '''
+    P = np.eye(num_classes)
+    for init in range(0, num_classes, nb_subclasses):
+        cls1, cls2 = init + rng.choice(range(nb_subclasses), size=2, replace=False)
+        P[cls1, cls2], P[cls2, cls1] = noise, noise
+        P[cls1, cls1], P[cls2, cls2] = 1. - noise, 1. - noise
+    return P
+
+def noisify(labels, P, random_state=0):
+    '''
+    Flip every label according to its row of the transition probability matrix P, with one multinomial draw
+    per sample in order, as the original multiclass_noisify: the same random_state gives the same noisy labels
+    (the published CIFAR-100 asym label sets)
+    '''
+    labels = np.asarray(labels)
+    assert P.shape[0] == P.shape[1]
+    assert np.max(labels) < P.shape[0]
+
+    # row stochastic matrix
+    assert_array_almost_equal(P.sum(axis=1), np.ones(P.shape[1]))
+    assert (P >= 0.0).all()
+
+    flipper = np.random.RandomState(random_state)
+    noisy = np.array([flipper.multinomial(1, P[label]).argmax() for label in labels])
+    return noisy.astype(labels.dtype)
+
+def instance_noisify(data, labels, percent, num_classes=10, random_state=None, chunk_size=4096):
+    '''
+    Instance-dependent noise, batched over the whole dataset
+    https://github.com/haochenglouis/cores/blob/main/data/utils.py
+
+    The flip rate of every sample is drawn from N(percent, 0.1) truncated to (0, 1), the flip is spread over
+    the other classes by the softmax of a random projection of the image, and the new label is sampled by
+    inverse CDF. np.random is consumed in the same order as the per-sample version, so a fixed seed gives the same labels.
+    random_state: seed of a private RandomState, the global np.random is used when None
+    '''
+    rng = np.random if random_state is None else np.random.RandomState(random_state)
+    n = len(labels)
+    q_ = rng.normal(loc=percent, scale=0.1, size=int(1e6))
+    q = q_[(q_ > 0) & (q_ < 1)][:n]
+    w = rng.normal(loc=0, scale=1, size=(32*32*3, num_classes))
+
+    p_all = np.empty((n, num_classes))
+    for start in range(0, n, chunk_size):
+        p_all[start:start+chunk_size] = data[start:start+chunk_size].reshape(-1, w.shape[0]) @ w
+
+    rows = np.arange(n)
+    p_all[rows, labels] = -np.inf
+    p_all = np.exp(p_all - p_all.max(axis=1, keepdims=True))
+    p_all = q[:, None] * p_all / p_all.sum(axis=1, keepdims=True)
+    p_all[rows, labels] = 1 - q
+    p_all /= p_all.sum(axis=1, keepdims=True)
+
+    cdf = np.cumsum(p_all, axis=1)
+    cdf /= cdf[:, -1:]
+    uniform = rng.random_sample(n)
+    return np.minimum((cdf <= uniform[:, None]).sum(axis=1), num_classes - 1)
+
+def load_or_add_noise(dataset, mode, noise_file='', seed=None):
+    '''
+    Make the labels of dataset noisy with its noise method of the given mode (sym, asym, instance),
+    or load them from noise_file (.npz) when an earlier build cached them there. The ground-truth labels are kept
+    in train_labels_gt.
+    The cache records seed, mode, percent and the clean labels, and is only used when they all match. It also
+    records the state of np.random after the noise and a hit restores it, so the noise drawn next from the global
+    stream (the validation split continues it) is the same with and without the cache.
+    '''
+    percent = dataset.cfg_trainer['percent']
+    if noise_file and os.path.exists(noise_file):
+        cache = np.load(noise_file)
+        if (int(cache['seed']) == seed and str(cache['mode']) == mode and float(cache['percent']) == percent
+                and np.array_equal(cache['labels_gt'], dataset.train_labels)):
+            dataset.train_labels_gt = dataset.train_labels.copy()
+            dataset.train_labels = cache['labels']
+            dataset.noise_indx = cache['noise_indx'].tolist()
+            np.random.set_state(('MT19937', cache['rng_keys'], int(cache['rng_pos']),
+                                 int(cache['rng_has_gauss']), float(cache['rng_gauss'])))
+            return
+
+    getattr(dataset, NOISE_METHODS[mode])()
+
+    if noise_file:
+        _, keys, pos, has_gauss, gauss = np.random.get_state()
+        # write then rename, so concurrent builds never read a partial file
+        tmp_file = '%s.%d.tmp' % (noise_file, os.getpid())
+        try:
+            with open(tmp_file, 'wb') as f:
+                np.savez(f, labels=dataset.train_labels, labels_gt=dataset.train_labels_gt,
+                         noise_indx=np.asarray(getattr(dataset, 'noise_indx', []), dtype=np.int64),
+                         seed=-1 if seed is None else seed, mode=mode, percent=percent,
+                         rng_keys=keys, rng_pos=pos, rng_has_gauss=has_gauss, rng_gauss=gauss)
+            os.replace(tmp_file, noise_file)
+        except OSError:
+            print('could not cache the noisy labels to %s' % noise_file)
@@ -0,0 +1,59 @@
+import copy
+import random
+import numpy as np
+import torch
+
+# datasets loaded (and noisified) once per process, shared by every loader built afterwards,
+# with the RNG state their build left behind
+_shared_datasets = {}
+
+
+def _rng_state():
+    state = {'numpy': np.random.get_state(), 'random': random.getstate(),
+             'torch': torch.get_rng_state(), 'torch_seed': torch.initial_seed()}
+    if torch.cuda.is_initialized():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+def _set_rng_state(state):
+    np.random.set_state(state['numpy'])
+    random.setstate(state['random'])
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state:
+        torch.cuda.set_rng_state_all(state['cuda'])
+    else:
+        # the build seeded CUDA before it was initialized; seeding again is applied the same way
+        torch.cuda.manual_seed_all(state['torch_seed'])
+
+def get_shared(key, build):
+    '''
+    return the datasets registered under key, calling build() only the first time.
+    The RNG states (numpy, random, torch) right after the build are kept with the datasets and restored on every
+    later call, so the random streams after a call are the same as after a fresh build
+    '''
+    if key not in _shared_datasets:
+        datasets = build()
+        _shared_datasets[key] = (datasets, _rng_state())
+    else:
+        _set_rng_state(_shared_datasets[key][1])
+    return _shared_datasets[key][0]
+
+def shared_view(dataset, teacher_idx=None, **attrs):
+    '''
+    A shallow copy of a shared dataset: the image and label arrays stay shared,
+    attrs (e.g. transform) are set on the copy only and teacher_idx truncates the copy only.
+    A truncated copy still returns the positions of its samples in the full dataset as their indices;
+    num_raw_example keeps the size of the full dataset for the losses indexed by them
+    '''
+    if dataset is None or isinstance(dataset, list):
+        return dataset
+    dataset = copy.copy(dataset)
+    for name, value in attrs.items():
+        setattr(dataset, name, value)
+    if teacher_idx is not None:
+        dataset.num_raw_example = getattr(dataset, 'num_raw_example', len(dataset))
+        dataset.truncate(teacher_idx)
+    return dataset
+
+def clear_shared():
+    _shared_datasets.clear()
@@ -0,0 +1,159 @@
+import argparse
+import multiprocessing
+import os
+import time
+import numpy as np
+from PIL import Image
+from tqdm import tqdm
+
+__all__ = ['ShardStore', 'pack_shards', 'benchmark']
+
+# size of one shard file of raw uint8 pixels
+SHARD_BYTES = 1 << 30
+INDEX_FILES = ('shard', 'offset', 'shape', 'keys', 'key_offsets')
+
+
+def _decode(job):
+    path, size = job
+    image = Image.open(path).convert('RGB')
+    if size is not None:
+        # the output size of transforms.Resize(size): the shorter side becomes size
+        w, h = image.size
+        if min(w, h) != size:
+            if w < h:
+                w, h = size, int(size * h / w)
+            else:
+                w, h = int(size * w / h), size
+            image = image.resize((w, h), Image.BILINEAR)
+    return np.asarray(image, dtype=np.uint8)
+
+def pack_shards(root, keys, out_dir, size=None, shard_bytes=SHARD_BYTES, workers=4):
+    '''
+    Decode the images root/key of keys once (resized to a shorter side of size when given) and write them as raw
+    uint8 HWC pixels into shard_*.bin files of about shard_bytes each, with an index of .npy files:
+    shard (int32), offset (int64) and shape (int32 height, width) per image, and the keys (uint8 blob and int64
+    offsets) in order, so that image i of the store is the image of keys[i].
+    '''
+    tmp_dir = '%s.%d.tmp' % (out_dir, os.getpid())
+    os.makedirs(tmp_dir)
+    n = len(keys)
+    shard = np.zeros(n, dtype=np.int32)
+    offset = np.zeros(n, dtype=np.int64)
+    shape = np.zeros((n, 2), dtype=np.int32)
+
+    f, written = None, 0
+    jobs = [(os.path.join(root, key), size) for key in keys]
+    with multiprocessing.Pool(workers) as pool:
+        for i, pixels in enumerate(tqdm(pool.imap(_decode, jobs, chunksize=64), total=n)):
+            if f is None or (written > 0 and written + pixels.nbytes > shard_bytes):
+                if f is not None:
+                    f.close()
+                    shard[i] = shard[i-1] + 1
+                f, written = open(os.path.join(tmp_dir, 'shard_%05d.bin' % shard[i]), 'wb'), 0
+            else:
+                shard[i] = shard[i-1]
+            f.write(pixels.tobytes())
+            offset[i], shape[i] = written, pixels.shape[:2]
+            written += pixels.nbytes
+    if f is not None:
+        f.close()
+
+    encoded = [key.encode() for key in keys]
+    index = {'shard': shard, 'offset': offset, 'shape': shape,
+             'keys': np.frombuffer(b''.join(encoded), dtype=np.uint8),
+             'key_offsets': np.concatenate([[0], np.cumsum([len(k) for k in encoded])]).astype(np.int64)}
+    for name in INDEX_FILES:
+        np.save(os.path.join(tmp_dir, name + '.npy'), index[name])
+    # rename at the end, so readers never see a partial store
+    os.replace(tmp_dir, out_dir)
+
+class ShardStore(object):
+    '''
+    Reader of a store written by pack_shards. The shards are memory-mapped on first use in every process
+    (never pickled to the workers), image(i) is the i-th packed image. Datasets map their keys to store positions
+    once with positions(keys) when they are built, and read by position only.
+    '''
+    def __init__(self, shard_dir):
+        self.shard_dir = shard_dir
+        for name in INDEX_FILES:
+            setattr(self, name, np.load(os.path.join(shard_dir, name + '.npy'), mmap_mode='r'))
+        self._shards = {}
+
+    def __len__(self):
+        return len(self.offset)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_shards'] = {}
+        return state
+
+    def key(self, i):
+        return self.keys[self.key_offsets[i]:self.key_offsets[i+1]].tobytes().decode()
+
+    def positions(self, keys):
+        '''
+        the store positions (int64) of keys, through a key table that only lives during the call
+        '''
+        table = {self.key(i): i for i in range(len(self))}
+        return np.array([table[key] for key in keys], dtype=np.int64)
+
+    def array(self, i):
+        s = int(self.shard[i])
+        if s not in self._shards:
+            self._shards[s] = np.memmap(os.path.join(self.shard_dir, 'shard_%05d.bin' % s), dtype=np.uint8, mode='r')
+        h, w = self.shape[i]
+        start = int(self.offset[i])
+        return self._shards[s][start:start + h*w*3].reshape(h, w, 3)
+
+    def image(self, i):
+        return Image.fromarray(np.array(self.array(i)))
+
+def benchmark(load, n, transform=None):
+    '''
+    images per second of this process for load(i) followed by transform, over the first n samples
+    '''
+    start = time.time()
+    for i in range(n):
+        image = load(i)
+        if transform is not None:
+            transform(image)
+    return n / (time.time() - start)
+
+def _keys(dataset, root, num_class):
+    if dataset == 'clothing1m':
+        # every path of the annotation index in path-id order, so the store position is the path id
+        from data_loader.clothing1m import get_annotation_index
+        index = get_annotation_index(root)
+        blob, offsets = index['paths'], index['path_offsets']
+        return [blob[offsets[i]:offsets[i+1]].tobytes().decode() for i in range(len(offsets) - 1)]
+    keys = []
+    for flist, prefix in (('info/train_filelist_google.txt', ''), ('info/val_filelist.txt', 'val_images_256/')):
+        with open(os.path.join(root, flist)) as f:
+            for line in f:
+                img, target = line.split()
+                if int(target) < num_class:
+                    keys.append(prefix + img)
+    return keys
+
+if __name__ == '__main__':
+    args = argparse.ArgumentParser(description='pack decoded images into memory-mapped uint8 shards')
+    args.add_argument('dataset', choices=['clothing1m', 'webvision'])
+    args.add_argument('root', type=str, help='dataset root (the data_dir of the config)')
+    args.add_argument('out_dir', type=str, help='directory of the shard store')
+    args.add_argument('--size', type=int, default=None, help='shorter side of the stored images (clothing1m: 256, webvision: as is)')
+    args.add_argument('--num_class', type=int, default=50, help='webvision classes to pack')
+    args.add_argument('--workers', type=int, default=4)
+    args.add_argument('--benchmark', type=int, default=0, help='images per second per worker from JPEG and from the shards, on the first n images')
+    args = args.parse_args()
+
+    keys = _keys(args.dataset, args.root, args.num_class)
+    if not os.path.isdir(args.out_dir):
+        pack_shards(args.root, keys, args.out_dir, size=args.size, workers=args.workers)
+    if args.benchmark:
+        from torchvision import transforms
+        size = 224 if args.dataset == 'clothing1m' else 227
+        transform = transforms.Compose([transforms.Resize(256), transforms.RandomCrop(size), transforms.RandomHorizontalFlip(), transforms.ToTensor()])
+        store = ShardStore(args.out_dir)
+        jpeg = benchmark(lambda i: Image.open(os.path.join(args.root, keys[i])).convert('RGB'), args.benchmark, transform)
+        shards = benchmark(store.image, args.benchmark, transform)
+        print('images/s per worker: jpeg %.1f, shards %.1f (x%.1f)' % (jpeg, shards, shards / jpeg))
@@ -0,0 +1,174 @@
+import argparse
+import io
+import os
+import tarfile
+import numpy as np
+import torch
+from torch.utils.data import IterableDataset, get_worker_info
+from tqdm import tqdm
+from data_loader.jpeg import open_rgb
+
+__all__ = ['TarStream', 'pack_tars', 'store_positions', 'store_shards']
+
+# samples per tar shard, ~1GB of Clothing1M / WebVision JPEGs
+SHARD_SAMPLES = 10000
+INDEX_FILES = ('keys', 'key_offsets', 'shard_starts')
+
+
+def pack_tars(root, keys, out_dir, shard_samples=SHARD_SAMPLES, groups=None):
+    '''
+    Copy the files root/key of keys, as they are, into shard_*.tar files of shard_samples consecutive keys each.
+    groups: sizes of consecutive runs of keys (e.g. the images of one class) that start a new shard, so no shard
+    mixes two runs; one run when None.
+    Member i of the store is named by its position ('%09d' + extension of the key); the index holds the keys
+    (uint8 blob and int64 offsets) and the first position of every shard.
+    '''
+    tmp_dir = '%s.%d.tmp' % (out_dir, os.getpid())
+    os.makedirs(tmp_dir)
+    if groups is None:
+        groups = [len(keys)]
+    assert sum(groups) == len(keys)
+    group_starts = np.concatenate([[0], np.cumsum(groups)[:-1]]).astype(np.int64)
+    shard_starts = np.unique(np.concatenate([np.arange(start, start + size, shard_samples)
+                                             for start, size in zip(group_starts, groups)] + [[len(keys)]]))
+    for s in tqdm(range(len(shard_starts) - 1)):
+        with tarfile.open(os.path.join(tmp_dir, 'shard_%05d.tar' % s), 'w') as tar:
+            for i in range(shard_starts[s], shard_starts[s+1]):
+                tar.add(os.path.join(root, keys[i]), arcname='%09d%s' % (i, os.path.splitext(keys[i])[1]))
+
+    encoded = [key.encode() for key in keys]
+    index = {'keys': np.frombuffer(b''.join(encoded), dtype=np.uint8),
+             'key_offsets': np.concatenate([[0], np.cumsum([len(k) for k in encoded])]).astype(np.int64),
+             'shard_starts': shard_starts.astype(np.int64)}
+    for name in INDEX_FILES:
+        np.save(os.path.join(tmp_dir, name + '.npy'), index[name])
+    os.replace(tmp_dir, out_dir)
+
+def store_positions(tar_dir, keys):
+    '''
+    the positions (int64) of keys in the tar store of tar_dir
+    '''
+    index = {name: np.load(os.path.join(tar_dir, name + '.npy'), mmap_mode='r') for name in INDEX_FILES}
+    blob, offsets = index['keys'], index['key_offsets']
+    store = {blob[offsets[i]:offsets[i+1]].tobytes().decode(): i for i in range(len(offsets) - 1)}
+    return np.array([store[key] for key in keys], dtype=np.int64)
+
+def store_shards(tar_dir, keys):
+    '''
+    the shard of every key in the tar store of tar_dir, e.g. for subset draws that read few shards
+    '''
+    shard_starts = np.load(os.path.join(tar_dir, 'shard_starts.npy'))
+    return np.searchsorted(shard_starts, store_positions(tar_dir, keys), side='right') - 1
+
+def class_grouped_keys(keys, labels, members, seed=0):
+    '''
+    Packing order of a store whose subsets are drawn class by class: keys[members] grouped by labels (of the members),
+    each class in a random order, then the other keys in their order. Returns the keys and the group sizes
+    (the classes, then the rest) for pack_tars
+    '''
+    labels = np.asarray(labels)
+    rng = np.random.RandomState(seed)
+    groups = [np.asarray(members)[rng.permutation(np.flatnonzero(labels == cls))] for cls in np.unique(labels)]
+    rest = np.setdiff1d(np.arange(len(keys)), members)
+    order = np.concatenate(groups + [rest]).astype(np.int64)
+    sizes = [len(group) for group in groups] + ([len(rest)] if len(rest) else [])
+    return [keys[i] for i in order], sizes
+
+class TarStream(IterableDataset):
+    '''
+    Streams the samples of a map-style dataset from the tar shards of pack_tars with sequential reads only.
+
+    dataset provides stream_keys() (the store key of every sample, in index order) and sample(index, image)
+    (what __getitem__ returns for the decoded image). Every pass visits the shards holding members in a fresh order,
+    split over the loader workers, and shuffles the samples within a buffer of buffer_size encoded images.
+    Membership is a bitmap per shard; set_members(indices) restricts the stream to a subset of the samples
+    (e.g. teacher_idx) and shards without members are not read at all.
+    A pass reads every shard holding a member in full: a small subset spread over the whole store (e.g. a
+    class-balanced draw) reads the whole store. Clothing1M stores are therefore packed class by class and its train
+    subsets are drawn shard by shard (clothing1m.balanced_subset with blocks).
+    '''
+    def __init__(self, dataset, tar_dir, buffer_size=1000):
+        self.dataset = dataset
+        self.tar_dir = tar_dir
+        self.buffer_size = buffer_size
+        self.shard_starts = np.load(os.path.join(tar_dir, 'shard_starts.npy'))
+        # store position of every sample of dataset
+        self.positions = store_positions(tar_dir, dataset.stream_keys())
+        assert len(np.unique(self.positions)) == len(self.positions), 'a sample is listed twice'
+        self.order = np.argsort(self.positions)
+        self.set_members(None)
+
+    def __getattr__(self, name):
+        # labels, transform, num_raw_example, ... of the wrapped dataset
+        if name == 'dataset':
+            raise AttributeError(name)
+        return getattr(self.dataset, name)
+
+    def set_members(self, indices):
+        '''
+        stream the samples of indices (dataset indices) only, every sample when None
+        '''
+        self.rows = np.arange(len(self.positions)) if indices is None else np.asarray(indices)
+        member = np.zeros(self.shard_starts[-1], dtype=bool)
+        member[self.positions[self.rows]] = True
+        self.bitmaps = [np.packbits(member[self.shard_starts[s]:self.shard_starts[s+1]])
+                        for s in range(len(self.shard_starts) - 1)]
+
+    def index_of(self, position):
+        return int(self.order[np.searchsorted(self.positions, position, sorter=self.order)])
+
+    def _shards(self):
+        # the same permutation in every worker of one pass, a new one every pass (the loader draws a new base seed)
+        info = get_worker_info()
+        seed = torch.randint(2**31, (1,)).item() if info is None else info.seed - info.id
+        shards = [s for s in np.random.default_rng(seed).permutation(len(self.bitmaps)) if self.bitmaps[s].any()]
+        if info is not None:
+            shards = shards[info.id::info.num_workers]
+        return shards, np.random.default_rng(seed if info is None else info.seed)
+
+    def _read(self, shards):
+        for s in shards:
+            bitmap, start = self.bitmaps[s], self.shard_starts[s]
+            with tarfile.open(os.path.join(self.tar_dir, 'shard_%05d.tar' % s), 'r|') as tar:
+                for member in tar:
+                    position = int(member.name[:9])
+                    i = position - start
+                    if bitmap[i >> 3] & (0x80 >> (i & 7)):
+                        yield self.index_of(position), tar.extractfile(member).read()
+
+    def __iter__(self):
+        shards, rng = self._shards()
+        buffer = []
+        for item in self._read(shards):
+            if len(buffer) < self.buffer_size:
+                buffer.append(item)
+                continue
+            i = rng.integers(len(buffer))
+            item, buffer[i] = buffer[i], item
+            yield self._sample(*item)
+        for i in rng.permutation(len(buffer)):
+            yield self._sample(*buffer[i])
+
+    def _sample(self, index, data):
+        return self.dataset.sample(index, open_rgb(io.BytesIO(data), getattr(self.dataset, 'draft', None)))
+
+    def __len__(self):
+        return len(self.rows)
+
+if __name__ == '__main__':
+    from data_loader.shards import _keys
+    args = argparse.ArgumentParser(description='pack dataset images into tar shards for sequential reads')
+    args.add_argument('dataset', choices=['clothing1m', 'webvision'])
+    args.add_argument('root', type=str, help='dataset root (the data_dir of the config)')
+    args.add_argument('out_dir', type=str, help='directory of the tar shards')
+    args.add_argument('--num_class', type=int, default=50, help='webvision classes to pack')
+    args.add_argument('--shard_samples', type=int, default=SHARD_SAMPLES)
+    args = args.parse_args()
+    keys, groups = _keys(args.dataset, args.root, args.num_class), None
+    if args.dataset == 'clothing1m':
+        # the train images class by class (path ids are the key positions), so a balanced draw reads few shards
+        from data_loader.clothing1m import get_annotation_index
+        index = get_annotation_index(args.root)
+        train_ids = np.asarray(index['train_ids'])
+        keys, groups = class_grouped_keys(keys, index['noisy_labels'][train_ids], train_ids)
+    pack_tars(args.root, keys, args.out_dir, args.shard_samples, groups)
@@ -0,0 +1,90 @@
+import copy
+import hashlib
+import os
+import numpy as np
+import torch
+from torch.utils.data import Dataset, DataLoader
+from torchvision import transforms
+from data_loader.augment import to_uint8_tensor
+
+__all__ = ['is_deterministic', 'TensorCache']
+
+# transforms whose output depends on the input only
+DETERMINISTIC_TRANSFORMS = (transforms.ToTensor, transforms.Normalize, transforms.Resize, transforms.CenterCrop)
+
+
+def _steps(transform):
+    return list(transform.transforms) if isinstance(transform, transforms.Compose) else [transform]
+
+def _describe(transform):
+    # plain functions are named, their repr holds a per-process address
+    return ', '.join(t.__name__ if callable(t) and hasattr(t, '__name__') else repr(t) for t in _steps(transform))
+
+def is_deterministic(transform):
+    '''
+    whether every step of transform is deterministic, so that its outputs can be cached once
+    '''
+    return all(isinstance(t, DETERMINISTIC_TRANSFORMS) or t is to_uint8_tensor for t in _steps(transform))
+
+class TensorCache(Dataset):
+    '''
+    Serves the outputs of the deterministic transform of dataset from a memory-mapped .npy store,
+    materialized by one pass over dataset the first time and reused by every later loader and run.
+
+    dtype 'float16' stores the transform outputs; 'uint8' stores the image before a trailing Normalize
+    (ToTensor outputs times 255), which is applied again at load time. The store is keyed by the dataset class,
+    its labels, the transform, the JPEG draft size and the dtype. Samples are (img, target, index, target_gt) as in the wrapped datasets,
+    the labels are taken from dataset.get_labels().
+    '''
+    def __init__(self, dataset, cache_dir, dtype='float16', batch_size=256, num_workers=4):
+        assert dtype in ('float16', 'uint8')
+        assert is_deterministic(dataset.transform), 'only deterministic transforms can be cached'
+        self.labels, self.labels_gt = dataset.get_labels()
+
+        steps = _steps(dataset.transform)
+        self.normalize = None
+        if dtype == 'uint8' and isinstance(steps[-1], transforms.Normalize):
+            self.normalize, steps = steps[-1], steps[:-1]
+        self.dtype = dtype
+
+        key = hashlib.md5('|'.join([type(dataset).__name__, str(len(dataset)), _describe(dataset.transform), dtype,
+                                    str(getattr(dataset, 'draft', None))]).encode())
+        key.update(np.ascontiguousarray(self.labels).tobytes())
+        self.path = os.path.join(cache_dir, '%s_%s.npy' % (type(dataset).__name__, key.hexdigest()[:16]))
+
+        if not os.path.exists(self.path):
+            os.makedirs(cache_dir, exist_ok=True)
+            dataset = copy.copy(dataset)
+            dataset.transform = transforms.Compose(steps)
+            self._materialize(dataset, batch_size, num_workers)
+        self.store = np.load(self.path, mmap_mode='r')
+        assert len(self.store) == len(self.labels)
+
+    def _materialize(self, dataset, batch_size, num_workers):
+        print('caching %d transformed samples to %s' % (len(dataset), self.path))
+        loader = DataLoader(dataset, batch_size=batch_size, shuffle=False, num_workers=num_workers)
+        # write then rename, so concurrent runs never read a partial store
+        tmp_path = '%s.%d.tmp' % (self.path, os.getpid())
+        store, start = None, 0
+        for img, *_ in loader:
+            if img.dtype != torch.uint8 and self.dtype == 'uint8':
+                img = (img * 255.).round_()
+            img = img.numpy().astype(self.dtype)
+            if store is None:
+                store = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=self.dtype, shape=(len(dataset),) + img.shape[1:])
+            store[start:start+len(img)] = img
+            start += len(img)
+        store.flush()
+        del store
+        os.replace(tmp_path, self.path)
+
+    def __getitem__(self, index):
+        img = torch.from_numpy(np.array(self.store[index]))
+        if self.normalize is not None:
+            img = self.normalize(img.float().div_(255.))
+        elif self.dtype == 'float16':
+            img = img.float()
+        return img, self.labels[index], index, self.labels_gt[index]
+
+    def __len__(self):
+        return len(self.labels)
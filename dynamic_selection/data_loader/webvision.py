@@ -6,6 +6,9 @@ import torchvision
 import torch
 import torch.nn.functional as F
 import random
+from data_loader.registry import get_shared, shared_view
+from data_loader.shards import ShardStore
+from data_loader.jpeg import open_rgb
 import numpy as np
 
 def fix_seed(seed=777):
@@ -17,139 +20,153 @@ def fix_seed(seed=777):
     np.random.seed(seed)
 
 def get_webvision(root, cfg_trainer, num_samples=0, train=True,
-                transform_train=None, transform_val=None, num_class=50, teacher_idx=None):
+                transform_train=None, transform_val=None, num_class=50, teacher_idx=None, shard_dir=None):
+
+    # the file lists are parsed once per process; every loader gets views of the shared datasets
+    key = ('webvision', root, num_samples, train, num_class, shard_dir)
+    train_dataset, val_dataset = get_shared(key, lambda: build_webvision(root, cfg_trainer, num_samples=num_samples, train=train, num_class=num_class, shard_dir=shard_dir))
 
     if train:
-        fix_seed()
-        train_dataset = Webvision(root, cfg_trainer, num_samples=num_samples, train=train, transform=transform_train, num_class=num_class)
-        val_dataset = Webvision(root, cfg_trainer, num_samples=num_samples, val=train, transform=transform_val, num_class=num_class)
+        if teacher_idx is not None:
+            print (len(teacher_idx))
+        train_dataset = shared_view(train_dataset, teacher_idx, transform=transform_train)
+        val_dataset = shared_view(val_dataset, transform=transform_val)
         print(f"Train: {len(train_dataset)} WebVision Val: {len(val_dataset)}")
+    else:
+        val_dataset = shared_view(val_dataset, transform=transform_val)
+        print(f"Imagnet Val: {len(val_dataset)}")
 
+    return train_dataset, val_dataset
+
+def build_webvision(root, cfg_trainer, num_samples=0, train=True, num_class=50, shard_dir=None):
+    '''
+    parse the WebVision file lists, without transforms
+    '''
+    if train:
+        fix_seed()
+        train_dataset = Webvision(root, cfg_trainer, num_samples=num_samples, train=train, num_class=num_class, shard_dir=shard_dir)
+        val_dataset = Webvision(root, cfg_trainer, num_samples=num_samples, val=train, num_class=num_class, shard_dir=shard_dir)
     else:
         train_dataset = []
 #         val_dataset = ImagenetVal(root, transform=transform_val, num_class = num_class)
-        val_dataset = Webvision(root, cfg_trainer, num_samples=num_samples, test=(not train), transform=transform_val, num_class=num_class)
-        print(f"Imagnet Val: {len(val_dataset)}")
-        
-    if teacher_idx is not None:
-        print (len(teacher_idx))
-        train_dataset.truncate(teacher_idx)
+        val_dataset = Webvision(root, cfg_trainer, num_samples=num_samples, test=(not train), num_class=num_class, shard_dir=shard_dir)
 
     return train_dataset, val_dataset
 
+def read_filelist(path, num_class, prefix=''):
+    '''
+    the entries of a WebVision / ImageNet file list with a label below num_class: their paths (prefix + path)
+    packed into a uint8 blob with int64 offsets, and their labels as int16 aligned with the paths.
+    Workers index these arrays instead of forking dicts of path strings, so their pages stay shared.
+    '''
+    paths, labels = [], []
+    with open(path) as f:
+        for line in f:
+            img, target = line.split()
+            if int(target) < num_class:
+                paths.append((prefix + img).encode())
+                labels.append(int(target))
+    blob = np.frombuffer(b''.join(paths), dtype=np.uint8)
+    offsets = np.concatenate([[0], np.cumsum([len(p) for p in paths])]).astype(np.int64)
+    return blob, offsets, np.array(labels, dtype=np.int16)
+
+def unpack_path(blob, offsets, i):
+    return blob[offsets[i]:offsets[i+1]].tobytes().decode()
+
 class ImagenetVal(torch.utils.data.Dataset):
-    def __init__(self, root, transform, num_class):
+    def __init__(self, root, transform, num_class, draft=None):
         self.root = root+'imagenet/'
         self.transform = transform
+        # shorter side of the JPEG draft decode (data_loader/jpeg.py), full resolution when None
+        self.draft = draft
 
-        with open(self.root+'imagenet_val.txt') as f:
-            lines=f.readlines()
-            self.val_imgs = []
-            self.val_labels = {}
-            for line in lines:
-                img, target = line.split()
-                target = int(target)
-                if target<num_class:
-                    self.val_imgs.append(img)
-                    self.val_labels[img]=target               
+        self.path_blob, self.path_offsets, self.val_labels = read_filelist(self.root+'imagenet_val.txt', num_class, prefix='val/')
                 
     def __getitem__(self, index):
 
-        img_path = self.val_imgs[index]
-        target = self.val_labels[img_path]     
-        image = Image.open(self.root+'val/'+img_path).convert('RGB')   
+        target = int(self.val_labels[index])
+        image = open_rgb(self.root+unpack_path(self.path_blob, self.path_offsets, index), self.draft)
         img = self.transform(image) 
 
         return img, target, index, target
         
     
     def __len__(self):
-        return len(self.val_imgs)
+        return len(self.val_labels)
 
 
 class Webvision(torch.utils.data.Dataset):
 
-    def __init__(self, root, cfg_trainer, num_samples=0, train=False, val=False, test=False, transform=None, num_class = 50):
+    def __init__(self, root, cfg_trainer, num_samples=0, train=False, val=False, test=False, transform=None, num_class = 50, shard_dir=None):
         
         fix_seed()
         self.cfg_trainer = cfg_trainer
         self.root = root
         self.transform = transform
-        self.train_labels = {}
-        self.test_labels = {}
-        self.val_labels = {}  
+        # pre-decoded images keyed by their path under root (data_loader/shards.py), read instead of the JPEGs
+        self.shards = ShardStore(shard_dir) if shard_dir is not None else None
 
         self.train  = train
         self.val = val
         self.test = test
 
+        # paths packed into one array, labels int16 aligned with it; *_imgs are positions in these arrays
+        if self.val or self.test:
+            self.path_blob, self.path_offsets, labels = read_filelist(self.root+'info/val_filelist.txt', num_class, prefix='val_images_256/')
+        else:
+            self.path_blob, self.path_offsets, labels = read_filelist(self.root+'info/train_filelist_google.txt', num_class)
+        imgs = np.arange(len(labels))
         if self.val:
-            with open(self.root+'info/val_filelist.txt') as f:
-                lines=f.readlines()
-            self.val_imgs = []
-            self.val_labels = {}
-            for line in lines:
-                img, target = line.split()
-                target = int(target)
-                if target<num_class:
-                    self.val_imgs.append(img)
-                    self.val_labels[img]=target 
+            self.val_imgs, self.val_labels = imgs, labels
         elif self.test:
-            with open(self.root+'info/val_filelist.txt') as f:
-                lines=f.readlines()
-            self.test_imgs = []
-            self.test_labels = {}
-            for line in lines:
-                img, target = line.split()
-                target = int(target)
-                if target<num_class and target is not None:
-                    self.test_imgs.append(img)
-                    self.test_labels[img]=target   
+            self.test_imgs, self.test_labels = imgs, labels
         else:
-            with open(self.root+'info/train_filelist_google.txt') as f:
-                lines=f.readlines()
-            train_imgs = []
-            self.train_labels = {}
-            for line in lines:
-                img, target = line.split()
-                target = int(target)
-                if target<num_class:
-                    train_imgs.append(img)
-                    self.train_labels[img]=target 
-
-            self.train_imgs = np.array(train_imgs)
+            self.train_imgs, self.train_labels = imgs, labels
             print ('########################')
             print (len(self.train_imgs))
+        if self.shards is not None:
+            # store position of every packed path, looked up once here instead of by key in the workers
+            self.shard_pos = self.shards.positions(unpack_path(self.path_blob, self.path_offsets, i) for i in range(len(labels)))
+
+    def split(self):
+        if self.val:
+            return self.val_imgs, self.val_labels
+        elif self.test:
+            return self.test_imgs, self.test_labels
+        return self.train_imgs, self.train_labels
             
+    def image_key(self, index):
+        return unpack_path(self.path_blob, self.path_offsets, self.split()[0][index])
+
     def __getitem__(self, index):
-        
-        if self.train:
-            img_path = self.train_imgs[index]
-            target = self.train_labels[img_path]   
-            image = Image.open(self.root+img_path)
-            img0 = image.convert('RGB')
-            img0 = self.transform(img0)
-            return img0, target, index, target
-        elif self.val:
-            img_path = self.val_imgs[index]
-            target = self.val_labels[img_path]     
-            image = Image.open(self.root+'val_images_256/'+img_path).convert('RGB')   
-            img = self.transform(image)
-            return img, target, index, target
-        elif self.test:
-            img_path = self.test_imgs[index]
-            target = self.test_labels[img_path]     
-            image = Image.open(self.root+'val_images_256/'+img_path).convert('RGB')   
-            img = self.transform(image)
-            return img, target, index, target
+        if self.shards is not None:
+            image = self.shards.image(self.shard_pos[self.split()[0][index]])
+        else:
+            image = Image.open(self.root+self.image_key(index)).convert('RGB')
+        return self.sample(index, image)
+
+    def sample(self, index, image):
+        '''
+        the sample of index for its decoded image (shared with the tar stream of data_loader/tar_stream.py)
+        '''
+        imgs, labels = self.split()
+        # imgs[index] is the position in the full file list, also after truncate
+        target = int(labels[imgs[index]])
+        return self.transform(image), target, int(imgs[index]), target
+
+    def stream_keys(self):
+        return [self.image_key(i) for i in range(len(self))]
         
     def __len__(self):
-        if self.test:
-            return len(self.test_imgs)
-        if self.val:
-            return len(self.val_imgs)
-        else:
-            return len(self.train_imgs)
+        return len(self.split()[0])
         
+    def get_labels(self):
+        '''
+        noisy and ground-truth labels aligned with the dataset positions (the same array, as in __getitem__)
+        '''
+        imgs, labels = self.split()
+        labels = labels[imgs].astype(np.int64)
+        return labels, labels
+    
     def truncate(self, teacher_idx):
         self.train_imgs = self.train_imgs[teacher_idx]
\ No newline at end of file
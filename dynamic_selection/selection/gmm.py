@@ -4,70 +4,170 @@
 import numpy as np
 import math
 import scipy.stats as stats
+from scipy.special import betaln
 import torch
 
 from sklearn.mixture import GaussianMixture as GMM
 # from .svd_classifier import get_singular_vector, cleansing, get_score
-from .util import estimate_purity
+from .util import ClassIndex, estimate_purity, split_two_means
 
 __all__=['fit_mixture', 'fit_mixture_bmm']
 
 
-def fit_mixture(scores, labels, p_threshold=0.5):
+def fit_mixture(scores, labels, p_threshold=0.5, return_prob=False):
     '''
     Assume the distribution of scores: bimodal gaussian mixture model
     
     return clean labels
     that belongs to the clean cluster by fitting the score distribution to GMM
+    All classes are fitted together on the class-sorted scores.
+    labels: label array or its ClassIndex
+    return_prob: if true, also return the dense per-sample probability of the clean component
     '''
     
-    clean_labels = []
-    indexes = np.array(range(len(scores)))
-    for cls in np.unique(labels):
-        cls_index = indexes[labels==cls]
-        feats = scores[labels==cls]
-        feats_ = np.ravel(feats).astype(np.float).reshape(-1, 1)
-        gmm = GMM(n_components=2, covariance_type='full', tol=1e-6, max_iter=100)
-        
-        gmm.fit(feats_)
-        prob = gmm.predict_proba(feats_)
-        prob = prob[:,gmm.means_.argmax()]
-        clean_labels += [cls_index[clean_idx] for clean_idx in range(len(cls_index)) if prob[clean_idx] > p_threshold] 
+    class_index = ClassIndex.of(labels)
+    
+    prob_sorted = fit_gmm_1d(class_index.sort(np.ravel(scores)).astype(np.float64), class_index.offsets, tol=1e-6, max_iter=100)
+    clean_labels = class_index.order[prob_sorted > p_threshold]
+    prob = class_index.unsort(prob_sorted)
     
+    if return_prob:
+        return np.array(clean_labels, dtype=np.int64), prob
     return np.array(clean_labels, dtype=np.int64)
 
-def fit_mixture_bmm(scores, labels, p_threshold=0.5):
+def fit_gmm_1d(x, offsets, max_iter=100, tol=1e-3, reg_covar=1e-6):
+    '''
+    EM for one-dimensional two-component gaussian mixtures, fitted for every segment at once
+    x: scores sorted by segment (class)
+    offsets: segment boundaries, segment c is x[offsets[c]:offsets[c+1]]
+    
+    return the posterior probability of the component with the larger mean for every sample
+    '''
+    n_seg = len(offsets) - 1
+    seg = np.repeat(np.arange(n_seg), np.diff(offsets))
+    n = np.diff(offsets).astype(np.float64)
+    segsum = lambda v: np.add.reduceat(v, offsets[:-1], axis=0)
+    
+    # k-means initialization, solved exactly in 1-D
+    upper = split_two_means(x, offsets)
+    resp = np.stack([~upper, upper], axis=1).astype(np.float64)
+    
+    def m_step(resp):
+        nk = segsum(resp) + 10 * np.finfo(np.float64).eps
+        means = segsum(resp * x[:, None]) / nk
+        variances = segsum(resp * (x[:, None] - means[seg]) ** 2) / nk + reg_covar
+        return nk / n[:, None], means, variances
+    
+    def e_step(weights, means, variances):
+        log_prob = np.log(weights[seg]) - 0.5 * (np.log(2 * np.pi * variances[seg]) + (x[:, None] - means[seg]) ** 2 / variances[seg])
+        log_norm = np.logaddexp(log_prob[:, 0], log_prob[:, 1])
+        return log_prob - log_norm[:, None], segsum(log_norm) / n
+    
+    weights, means, variances = m_step(resp)
+    lower_bound = np.full(n_seg, -np.inf)
+    active = np.ones(n_seg, dtype=bool)
+    for _ in range(max_iter):
+        log_resp, new_bound = e_step(weights, means, variances)
+        new_weights, new_means, new_variances = m_step(np.exp(log_resp))
+        # converged segments keep their parameters, as a separate fit would have stopped there
+        weights[active], means[active], variances[active] = new_weights[active], new_means[active], new_variances[active]
+        active &= np.abs(new_bound - lower_bound) >= tol
+        lower_bound = new_bound
+        if not active.any():
+            break
+    
+    log_resp, _ = e_step(weights, means, variances)
+    clean = np.argmax(means, axis=1)
+    return np.exp(log_resp[np.arange(len(x)), clean[seg]])
+
+def fit_mixture_bmm(scores, labels, p_threshold=0.5, n_grid=50, return_mask=False):
     """
     Assum the distribution of scores: bimodal beta mixture model
     
     return clean labels
     that belongs to the clean cluster by fitting the score distribution to BMM
+    All classes are fitted together on the class-sorted, min-max normalized scores and
+    the decision boundary of every class is searched on the same n_grid points at once.
+    labels: label array or its ClassIndex
+    return_mask: if true, also return the dense per-sample clean mask
     """
     
-    clean_labels = []
-    indexes = np.array(range(len(scores)))
-    for cls in np.unique(labels):
-        cls_index = indexes[labels==cls]
-        feats = scores[labels==cls]
-        feats_ = np.ravel(feats).astype(np.float).reshape(-1, 1)
-        feats_ = (feats_ - feats_.min()) / (feats_.max() - feats_.min())
-        bmm = BetaMixture(max_iters=100)
-        bmm.fit(feats_)
-        
-        mean_0 = bmm.alphas[0] / (bmm.alphas[0] + bmm.betas[0])
-        mean_1 = bmm.alphas[1] / (bmm.alphas[1] + bmm.betas[1])
-        clean = 0 if mean_0 > mean_1 else 1
-        
-        init = bmm.predict(feats_.min(), p_threshold, clean)
-        for x in np.linspace(feats_.min(), feats_.max(), 50):
-            pred = bmm.predict(x, p_threshold, clean)
-            if pred != init:
-                bound = x
-                break
+    class_index = ClassIndex.of(labels)
+    offsets, seg = class_index.offsets, class_index.segment
+    
+    feats = class_index.sort(np.ravel(scores)).astype(np.float64)
+    low, high = np.minimum.reduceat(feats, offsets[:-1]), np.maximum.reduceat(feats, offsets[:-1])
+    feats = (feats - low[seg]) / np.maximum(high - low, np.finfo(np.float64).tiny)[seg]
+    
+    alphas, betas, weights = fit_bmm_1d(feats, offsets, max_iter=100)
+    clean = np.argmax(alphas / (alphas + betas), axis=1)
+    
+    # first grid point where the prediction flips from the one at the minimum
+    grid = np.linspace(0, 1, n_grid)
+    pred = beta_posterior(grid[None, :], alphas, betas, weights)[np.arange(len(clean)), clean] > p_threshold
+    flipped = pred != pred[:, :1]
+    bound = np.where(flipped.any(axis=1), grid[np.argmax(flipped, axis=1)], np.inf)
+    
+    is_clean = np.where(np.isinf(bound)[seg], pred[:, 0][seg], feats > bound[seg])
+    clean_labels = np.array(class_index.order[is_clean], dtype=np.int64)
+    
+    if return_mask:
+        mask = np.zeros(len(is_clean), dtype=bool)
+        mask[clean_labels] = True
+        return clean_labels, mask
+    return clean_labels
+
+def beta_log_likelihood(x, alphas, betas, eps=1e-4):
+    """
+    Log-density of every beta component, x: (C, n), alphas/betas: (C, K) -> (C, K, n)
+    """
+    x = np.clip(x, eps, 1 - eps)[:, None, :]
+    a, b = alphas[:, :, None], betas[:, :, None]
+    return (a - 1) * np.log(x) + (b - 1) * np.log1p(-x) - betaln(a, b)
+
+def beta_posterior(x, alphas, betas, weights, eps_nan=1e-12):
+    """
+    Posterior probability of every beta component, x: (C, n) or (1, n) -> (C, K, n)
+    """
+    log_wl = np.log(weights)[:, :, None] + beta_log_likelihood(x, alphas, betas)
+    log_norm = np.logaddexp(np.logaddexp.reduce(log_wl, axis=1, keepdims=True), np.log(eps_nan))
+    return np.exp(log_wl - log_norm)
+
+def fit_bmm_1d(x, offsets, max_iter=100, eps=1e-4, eps_nan=1e-12,
+               alphas_init=(1, 2), betas_init=(2, 1), weights_init=(0.5, 0.5)):
+    """
+    EM for two-component beta mixtures in log space, fitted for every segment at once
+    x: values in [0, 1] sorted by segment (class)
+    offsets: segment boundaries, segment c is x[offsets[c]:offsets[c+1]]
+    
+    return alphas, betas, weights of shape (C, 2), the same updates as BetaMixture.fit
+    """
+    n_seg, counts = len(offsets) - 1, np.diff(offsets)
+    segsum = lambda v: np.add.reduceat(v, offsets[:-1], axis=-1)
+    
+    x = np.clip(x, eps, 1 - eps)
+    alphas = np.tile(np.array(alphas_init, dtype=np.float64), (n_seg, 1))
+    betas = np.tile(np.array(betas_init, dtype=np.float64), (n_seg, 1))
+    weights = np.tile(np.array(weights_init, dtype=np.float64), (n_seg, 1))
+    log_x, log_1mx = np.log(x), np.log1p(-x)
+    
+    for _ in range(max_iter):
+        # E-step, weighted likelihoods are floored at eps_nan as in BetaMixture.responsibilities
+        const = np.log(weights) - betaln(alphas, betas)
+        log_wl = [np.maximum(np.repeat(alphas[:, k] - 1, counts) * log_x + np.repeat(betas[:, k] - 1, counts) * log_1mx
+                             + np.repeat(const[:, k], counts), np.log(eps_nan)) for k in range(2)]
+        r1 = 1 / (1 + np.exp(log_wl[0] - log_wl[1]))
+        r = np.stack([1 - r1, r1])
         
-        clean_labels += [cls_index[clean_idx] for clean_idx in range(len(cls_index)) if feats[clean_idx] > bound] 
+        # M-step, weighted method of moments
+        r_sum = segsum(r)
+        x_bar = segsum(r * x) / r_sum
+        s2 = segsum(r * x ** 2) / r_sum - x_bar ** 2
+        alphas = (x_bar * ((x_bar * (1 - x_bar)) / s2 - 1)).T
+        betas = (alphas.T * (1 - x_bar) / x_bar).T
+        weights = (r_sum / r_sum.sum(axis=0)).T
     
-    return np.array(clean_labels, dtype=np.int64)
+    return alphas, betas, weights
 
 
 ################### CODE FOR THE BETA MODEL  ###################
@@ -1,51 +1,147 @@
 import torch
 import numpy as np
 import pandas as pd
-from sklearn import cluster
 from tqdm import tqdm
 from .gmm import *
 from .util import *
 
-__all__=['get_mean_vector', 'get_singular_vector', 'cleansing', 'fine', 'extract_cleanidx']
+__all__=['get_mean_vector', 'get_singular_vector', 'get_singular_vector_from_gram', 'cleansing', 'fine', 'fine_streaming', 'extract_cleanidx']
 
 
 def get_mean_vector(features, labels):
     mean_vector_dict = {}
-    with tqdm(total=len(np.unique(labels))) as pbar:
-        for index in np.unique(labels):
-            v = np.mean(features[labels==index], axis=0)
+    class_index = ClassIndex.of(labels)
+    with tqdm(total=len(class_index.classes)) as pbar:
+        for index, cls_index in class_index.items():
+            v = np.mean(features[cls_index], axis=0)
             mean_vector_dict[index] = v
             pbar.update(1)
             
     return mean_vector_dict
             
-def get_singular_vector(features, labels):
+def get_singular_vector(features, labels, solver='svd', topk=1, float32=False, n_iter=50, tol=1e-5, init_vectors=None, n_jobs=1):
     '''
     To get top1 sigular vector in class-wise manner by using SVD of hidden feature vectors
     features: hidden feature vectors of data (numpy)
-    labels: correspoding label list
+    labels: correspoding label list or its ClassIndex
+    solver: 'svd' runs a thin SVD on the class features, 'eigh', 'power' and 'lanczos'
+            extract the leading eigenvectors of the d x d Gram matrix of each class
+    topk: number of leading singular vectors to keep (a (topk, d) array is stored when topk > 1)
+    float32: run the decomposition in single precision
+    init_vectors: class-wise vectors of the previous round, the iterative solvers start from them
+    n_jobs: if larger than 1, the classes are decomposed in a pool of n_jobs processes
     '''
     
+    class_index = ClassIndex.of(labels)
+    kwargs = [dict(solver=solver, topk=topk, float32=float32, n_iter=n_iter, tol=tol,
+                   init=init_vectors.get(index) if init_vectors is not None else None) for index in class_index.classes]
+    
+    if n_jobs > 1:
+        vectors = class_parallel_map(get_class_singular_vector, features, class_index, kwargs, n_jobs=n_jobs)
+        return dict(zip(class_index.classes, vectors))
+    
     singular_vector_dict = {}
-    with tqdm(total=len(np.unique(labels))) as pbar:
-        for index in np.unique(labels):
-            _, _, v = np.linalg.svd(features[labels==index])
-            singular_vector_dict[index] = v[0]
+    with tqdm(total=len(class_index.classes)) as pbar:
+        for k, (index, cls_index) in enumerate(class_index.items()):
+            singular_vector_dict[index] = get_class_singular_vector(features[cls_index], **kwargs[k])
             pbar.update(1)
 
     return singular_vector_dict
 
 
-def get_score(singular_vector_dict, features, labels, normalization=True):
+def get_class_singular_vector(feats, solver='svd', topk=1, float32=False, n_iter=50, tol=1e-5, init=None):
     '''
-    Calculate the score providing the degree of showing whether the data is clean or not.
+    Top singular vector(s) of the hidden features of a single class, see get_singular_vector
+    '''
+    if float32:
+        feats = feats.astype(np.float32)
+    if solver == 'svd':
+        _, _, v = np.linalg.svd(feats, full_matrices=False)
+    else:
+        v = get_top_eigenvectors(feats.T @ feats, topk, solver=solver, n_iter=n_iter, tol=tol, init=init)
+    
+    return v[0] if topk == 1 else v[:topk]
+
+
+def get_top_eigenvectors(gram, k=1, solver='eigh', n_iter=50, tol=1e-5, oversample=8, init=None):
+    '''
+    Leading k eigenvectors of a symmetric PSD matrix, returned as rows of a (k, d) array
+    in descending order of eigenvalue. They equal the top right singular vectors of X when gram = X^T X.
+    init: (k, d) or (d,) starting vectors for the 'power' and 'lanczos' solvers (warm start)
     '''
-    if normalization:
-        scores = [np.abs(np.inner(singular_vector_dict[labels[indx]], feat/np.linalg.norm(feat))) for indx, feat in enumerate(tqdm(features))]
+    if solver == 'eigh':
+        _, v = np.linalg.eigh(gram)
+        return v[:, ::-1][:, :k].T
+    
+    elif solver == 'lanczos':
+        from scipy.sparse.linalg import eigsh
+        if k >= gram.shape[0] - 1:
+            return get_top_eigenvectors(gram, k, solver='eigh')
+        v0 = np.ones(gram.shape[0], dtype=gram.dtype) if init is None else np.atleast_2d(init)[0].astype(gram.dtype)
+        w, v = eigsh(gram, k=k, which='LA', tol=tol, v0=v0)
+        return v[:, np.argsort(w)[::-1]].T
+    
+    elif solver == 'power':
+        # oversampled subspace iteration; stops once the Ritz residuals of the top k vectors vanish
+        rng = np.random.RandomState(0)
+        m = min(gram.shape[0], k + oversample)
+        q = rng.standard_normal((gram.shape[0], m)).astype(gram.dtype)
+        if init is not None:
+            init = np.atleast_2d(init)[:m]
+            q[:, :len(init)] = init.T
+        q, _ = np.linalg.qr(q)
+        for _ in range(n_iter):
+            z = gram @ q
+            w, v = np.linalg.eigh(q.T @ z)
+            w, v = w[::-1][:k], v[:, ::-1][:, :k]
+            residual = np.linalg.norm(z @ v - (q @ v) * w, axis=0) / np.maximum(np.abs(w), np.finfo(gram.dtype).tiny)
+            if residual.max() < tol:
+                break
+            q, _ = np.linalg.qr(z)
+        return (q @ v).T
+    
     else:
-        scores = [np.abs(np.inner(singular_vector_dict[labels[indx]], feat)) for indx, feat in enumerate(tqdm(features))]
+        raise NotImplementedError(solver)
+
+def get_singular_vector_from_gram(gram_dict, solver='eigh', topk=1, n_iter=50, tol=1e-5, init_vectors=None):
+    '''
+    To get top1 sigular vector in class-wise manner from the accumulated Gram matrices (X^T X)
+    gram_dict: class-wise Gram matrices of the hidden feature vectors
+    init_vectors: class-wise vectors of the previous round, the iterative solvers start from them
+    '''
+    solver = 'eigh' if solver == 'svd' else solver
+    
+    singular_vector_dict = {}
+    with tqdm(total=len(gram_dict)) as pbar:
+        for index in sorted(gram_dict.keys()):
+            init = init_vectors.get(index) if init_vectors is not None else None
+            v = get_top_eigenvectors(gram_dict[index], topk, solver=solver, n_iter=n_iter, tol=tol, init=init)
+            singular_vector_dict[index] = v[0] if topk == 1 else v[:topk]
+            pbar.update(1)
+
+    return singular_vector_dict
+
+
+def get_score(singular_vector_dict, features, labels, normalization=True, chunk_size=65536):
+    '''
+    Calculate the score providing the degree of showing whether the data is clean or not.
+    The class vectors are gathered into one (C, d) matrix and the features are scored
+    chunk by chunk, so peak memory stays bounded by chunk_size * d.
+    labels: label list or its ClassIndex
+    dividemix/Train_*.py keep copies, keep them in sync.
+    '''
+    class_index = ClassIndex.of(labels)
+    vectors = np.stack([singular_vector_dict[cls] for cls in class_index.classes])
+    features, rows = np.asarray(features), class_index.rows
+
+    scores = np.empty(len(features), dtype=np.result_type(vectors, features))
+    for start in tqdm(range(0, len(features), chunk_size)):
+        feats = features[start:start+chunk_size]
+        if normalization:
+            feats = feats / np.linalg.norm(feats, axis=1, keepdims=True)
+        scores[start:start+chunk_size] = np.abs(np.einsum('ij,ij->i', vectors[rows[start:start+chunk_size]], feats))
         
-    return np.array(scores)
+    return scores
 
 def extract_topk(scores, labels, k):
     '''
@@ -56,12 +152,14 @@ def extract_topk(scores, labels, k):
     which contains top k data
     '''
     
-    indexes = torch.tensor(range(len(labels)))
-    selected_labels = []
-    for cls in np.unique(labels):
-        num = int(p * np.sum(labels==cls))
-        _, sorted_idx = torch.sort(scores[labels==cls], descending=True)
-        selected_labels += indexes[labels==cls][sorted_idx[:num]].numpy().tolist()
+    class_index = ClassIndex.of(labels)
+    seg = class_index.segment
+    
+    # descending scores inside every class segment, ties keep the sample order
+    ranked = np.lexsort((-class_index.sort(np.asarray(scores)), seg))
+    rank = np.arange(len(ranked)) - class_index.offsets[seg]
+    num = (k * class_index.counts).astype(np.int64)
+    selected_labels = class_index.order[ranked[rank < num[seg]]]
         
     return torch.tensor(selected_labels, dtype=torch.int64)
 
@@ -70,22 +168,17 @@ def cleansing(scores, labels):
     Assume the distribution of scores: bimodal spherical distribution.
     
     return clean labels 
-    that belongs to the clean cluster made by the KMeans algorithm
+    that belongs to the clean cluster made by the exact 1-D two-means split of every class
     '''
     
-    indexes = np.array(range(len(scores)))
-    clean_labels = []
-    for cls in np.unique(labels):
-        cls_index = indexes[labels==cls]
-        kmeans = cluster.KMeans(n_clusters=2, random_state=0).fit(scores[cls_index].reshape(-1, 1))
-        if np.mean(scores[cls_index][kmeans.labels_==0]) < np.mean(scores[cls_index][kmeans.labels_==1]): kmeans.labels_ = 1 - kmeans.labels_
-            
-        clean_labels += cls_index[kmeans.labels_ == 0].tolist()
-        
-    return np.array(clean_labels, dtype=np.int64)
+    class_index = ClassIndex.of(labels)
+    clean = split_two_means(class_index.sort(np.ravel(scores)), class_index.offsets)
+    
+    return np.array(class_index.order[clean], dtype=np.int64)
         
 
-def fine(current_features, current_labels, fit='kmeans', prev_features=None, prev_labels=None, p_threshold=0.5, norm=True, eigen=True):
+def fine(current_features, current_labels, fit='kmeans', prev_features=None, prev_labels=None, p_threshold=0.5, norm=True, eigen=True, solver='svd',
+         init_vectors=None, return_vectors=False, n_jobs=1):
     '''
     prev_features, prev_labels: data from the previous round
     current_features, current_labels: current round's data
@@ -94,13 +187,21 @@ def fine(current_features, current_labels, fit='kmeans', prev_features=None, pre
     
     if you insert the prev_features and prev_labels to None,
     the algorthm divides the data based on the current labels and current features
-    
+    solver: eigen solver used by get_singular_vector ('svd', 'eigh', 'power' or 'lanczos')
+    init_vectors: class-wise vectors returned by the previous round, used to warm-start the iterative solvers
+    return_vectors: if true, return the class-wise vectors of this round along with the clean labels
+    n_jobs: number of processes for the class-wise decomposition, 1 runs it serially
     '''
+    # the class index of each label set is built once and shared by every step of the round
+    current_labels = ClassIndex.of(current_labels)
+    if prev_labels is not None:
+        prev_labels = ClassIndex.of(prev_labels)
+    
     if eigen is True:
         if prev_features is not None and prev_labels is not None:
-            vector_dict = get_singular_vector(prev_features, prev_labels)
+            vector_dict = get_singular_vector(prev_features, prev_labels, solver=solver, init_vectors=init_vectors, n_jobs=n_jobs)
         else:
-            vector_dict = get_singular_vector(current_features, current_labels)
+            vector_dict = get_singular_vector(current_features, current_labels, solver=solver, init_vectors=init_vectors, n_jobs=n_jobs)
     else:
         if prev_features is not None and prev_labels is not None:
             vector_dict = get_mean_vector(prev_features, prev_labels)
@@ -108,13 +209,48 @@ def fine(current_features, current_labels, fit='kmeans', prev_features=None, pre
             vector_dict = get_mean_vector(current_features, current_labels)
 
     scores = get_score(vector_dict, features = current_features, labels = current_labels, normalization=norm)
+    clean_labels = split_scores(scores, current_labels, fit=fit, p_threshold=p_threshold)
+    
+    if return_vectors:
+        return clean_labels, vector_dict
+    return clean_labels
+
+def fine_streaming(model, dataloader, fit='kmeans', prev_mask=None, p_threshold=0.5, norm=True, eigen=True, solver='eigh',
+                   init_vectors=None, return_vectors=False):
+    '''
+    FINE without holding the hidden feature matrix.
+    The first pass accumulates the class-wise Gram matrices, the second pass only scores the samples.
     
+    prev_mask: boolean array indexed by the sample indices the dataloader returns, marking the data
+               from the previous round; the class vectors are computed from all data if None
+    init_vectors, return_vectors: warm-start state across rounds, same as fine()
+    
+    return clean labels
+    '''
+    grams, sums, counts = get_gram_statistics(model, dataloader, mask=prev_mask)
+    if eigen is True:
+        vector_dict = get_singular_vector_from_gram(grams, solver=solver, init_vectors=init_vectors)
+    else:
+        vector_dict = {cls: sums[cls] / counts[cls] for cls in sums}
+    
+    scores, labels = get_streaming_score(model, dataloader, vector_dict, normalization=norm)
+    clean_labels = split_scores(scores, ClassIndex(labels), fit=fit, p_threshold=p_threshold)
+    
+    if return_vectors:
+        return clean_labels, vector_dict
+    return clean_labels
+
+def split_scores(scores, labels, fit='kmeans', p_threshold=0.5):
+    '''
+    Divide the scores into the clean and noisy groups with the given fitting method
+    labels: label list or its ClassIndex
+    '''
     if 'kmeans' in fit:
-        clean_labels = cleansing(scores, current_labels)
+        clean_labels = cleansing(scores, labels)
     elif 'gmm' in fit:
-        clean_labels = fit_mixture(scores, current_labels, p_threshold=p_threshold)
+        clean_labels = fit_mixture(scores, labels, p_threshold=p_threshold)
     elif 'bmm' in fit:
-        clean_labels = fit_mixture_bmm(scores, current_labels)
+        clean_labels = fit_mixture_bmm(scores, labels)
     else:
         raise NotImplemented
     
@@ -132,21 +268,22 @@ def extract_cleanidx(teacher, data_loader, parse, print_statistics = True):
     if not parse.reinit: teacher.load_state_dict(torch.load('./checkpoint/' + parse.load_name)['state_dict'])
     for params in teacher.parameters(): params.requires_grad = False
     
+    census = get_census(teacher, data_loader)
     if 'fine' in parse.distill_mode:
-        features, labels = get_features(teacher, data_loader)
-        clean_labels = fine(current_features=features, current_labels=labels, fit = parse.distill_mode)
+        features, labels = get_features(teacher, data_loader, census=census)
+        clean_labels = fine(current_features=features, current_labels=labels, fit = parse.distill_mode, solver=parse.solver, n_jobs=parse.selection_jobs)
         
     elif 'loss' in parse.distill_mode:
-        clean_labels, labels = cleansing_loss(teacher, data_loader)
+        clean_labels, labels = cleansing_loss(teacher, data_loader, census=census)
     else:
         raise NotImplemented
     
-    if print_statistics and parse.TFT == False: return_statistics(data_loader, clean_labels)
+    if print_statistics and parse.TFT == False: return_statistics(data_loader, clean_labels, census=census)
     if parse.TFT:
         stat_dict = dict()
         df = pd.DataFrame()
         
-        stat_dict['Sel_samples'] ,stat_dict['Precision'], stat_dict['Recall'], stat_dict['F1_Score'], stat_dict['Specificity'], stat_dict['Accuracy'] = return_statistics(data_loader, clean_labels)    
+        stat_dict['Sel_samples'] ,stat_dict['Precision'], stat_dict['Recall'], stat_dict['F1_Score'], stat_dict['Specificity'], stat_dict['Accuracy'] = return_statistics(data_loader, clean_labels, census=census)    
         df.insert(0, 'Metric', stat_dict.keys())
         df.insert(1, parse.distill_mode, stat_dict.values())
         
@@ -1,31 +1,169 @@
+import os
+import tempfile
+import multiprocessing
 import numpy as np
 from tqdm import tqdm
 import torch
 import scipy.stats as stats
-from sklearn import cluster
+from threadpoolctl import threadpool_limits
 
-__all__=['compute_noiseratio', 'get_features', 'estimate_purity', 'return_statistics','cleansing_loss']
+__all__=['ClassIndex', 'IndexedBuffer', 'compute_noiseratio', 'get_census', 'get_features', 'get_gram_statistics', 'get_streaming_score', 'estimate_purity', 'return_statistics','cleansing_loss', 'split_two_means', 'class_parallel_map']
 
 
-def compute_noiseratio(dataloader):
+class ClassIndex(object):
     '''
-    get the noisy list in the current dataloader
+    Class-grouped (CSR-style) index of a label array, built once from a stable argsort.
+    The samples of the k-th class in self.classes are order[offsets[k]:offsets[k+1]],
+    in their original relative order.
     '''
-    isNoisy_list = np.empty((0,))
+    def __init__(self, labels):
+        labels = np.asarray(labels)
+        self.order = np.argsort(labels, kind='stable')
+        self.classes, self.counts = np.unique(labels[self.order], return_counts=True)
+        self.offsets = np.concatenate(([0], np.cumsum(self.counts)))
+        # class row of every sample, in sorted and in original order
+        self.segment = np.repeat(np.arange(len(self.classes)), self.counts)
+        self.rows = np.empty(len(labels), dtype=np.int64)
+        self.rows[self.order] = self.segment
+        
+    @classmethod
+    def of(cls, labels):
+        return labels if isinstance(labels, cls) else cls(labels)
+    
+    def __len__(self):
+        return len(self.order)
+    
+    def indices(self, k):
+        '''
+        sample indices of the k-th class
+        '''
+        return self.order[self.offsets[k]:self.offsets[k+1]]
+    
+    def items(self):
+        for k, cls in enumerate(self.classes):
+            yield cls, self.indices(k)
+    
+    def sort(self, x):
+        '''
+        gather per-sample values into class-contiguous order
+        '''
+        return np.asarray(x)[self.order]
+    
+    def unsort(self, x_sorted):
+        '''
+        scatter class-contiguous values back to the original sample order
+        '''
+        x = np.empty_like(x_sorted)
+        x[self.order] = x_sorted
+        return x
+
+def _check_index(index, size):
+    '''
+    the sample indices of a batch as an array, checked to address a dataset of size samples
+    '''
+    index = np.asarray(index)
+    if index.size and (index.min() < 0 or index.max() >= size):
+        raise IndexError('sample index %d out of range for %d samples, the dataset must return its sample positions'
+                         % (index.max() if index.max() >= size else index.min(), size))
+    return index
+
+class IndexedBuffer(object):
+    '''
+    Host arrays preallocated for the whole dataset and addressed by the sample indices the dataset returns.
+    Batches coming from the GPU are copied into pinned staging tensors with non-blocking copies,
+    and written into their slots only when the next batch arrives, so the transfer overlaps the next forward.
+    On CPU-only machines the batches are written directly.
+    '''
+    def __init__(self, size):
+        self.size = size
+        self.written = np.zeros(size, dtype=bool)
+        self.arrays = {}
+        self.staging = {}
+        self.pending = None
+        
+    def put(self, index, **tensors):
+        index = _check_index(index, self.size)
+        self.flush()
+        self.written[index] = True
+        staged = {}
+        for name, tensor in tensors.items():
+            tensor = tensor.detach()
+            if tensor.is_cuda:
+                host = self.staging.get(name)
+                if host is None or host.shape[0] < tensor.shape[0] or host.shape[1:] != tensor.shape[1:] or host.dtype != tensor.dtype:
+                    host = torch.empty(tensor.shape, dtype=tensor.dtype, pin_memory=True)
+                    self.staging[name] = host
+                host = host[:tensor.shape[0]]
+                host.copy_(tensor, non_blocking=True)
+                staged[name] = host
+            else:
+                staged[name] = tensor
+        event = None
+        if torch.cuda.is_available():
+            event = torch.cuda.Event()
+            event.record()
+        self.pending = (index, staged, event)
+        
+    def flush(self):
+        if self.pending is None:
+            return
+        index, staged, event = self.pending
+        if event is not None:
+            event.synchronize()
+        for name, host in staged.items():
+            value = host.numpy()
+            if name not in self.arrays:
+                self.arrays[name] = np.zeros((self.size,) + value.shape[1:], dtype=value.dtype)
+            self.arrays[name][index] = value
+        self.pending = None
+        
+    def get(self, name):
+        self.flush()
+        return self.arrays[name]
+
+    def check_complete(self):
+        '''
+        raise if a slot was never written, i.e. the pass did not return every sample index of the dataset once
+        '''
+        if not self.written.all():
+            raise RuntimeError('%d of %d samples were not returned by the dataloader'
+                               % ((~self.written).sum(), self.size))
+
+
+def get_device():
+    return torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+
+
+def compute_noiseratio(dataloader, census=None):
+    '''
+    get the noisy list in the current dataloader.
+    Datasets exposing get_labels are read from their label arrays directly, then the labels of a census
+    from get_census are used when given, the others fall back to a pass over the dataloader
+    '''
+    dataset = dataloader.dataset
+    if hasattr(dataset, 'get_labels'):
+        labels, labels_gt = dataset.get_labels()
+        # clean: 1, noisy 0
+        return (np.asarray(labels) == np.asarray(labels_gt)).astype(np.float64)
+    if census is not None:
+        return (census['labels'] == census['labels_gt']).astype(np.float64)
+    
+    buffer = IndexedBuffer(len(dataset))
     
     with tqdm(dataloader) as progress:
-        for _, (_, label, _, label_gt) in enumerate(progress):
+        for _, (_, label, index, label_gt) in enumerate(progress):
             isNoisy = label == label_gt
-            isNoisy_list = np.concatenate((isNoisy_list, isNoisy.cpu()))
+            buffer.put(index, isNoisy=isNoisy)
     
     # clean: 1, noisy 0
-    return isNoisy_list
+    return buffer.get('isNoisy').astype(np.float64)
     
-def return_statistics(dataloader, selected_idx):
+def return_statistics(dataloader, selected_idx, census=None):
     '''
     selected_idx: list of selected clean labels by filtering method
+    census: output of get_census over the same dataloader, if already computed
     ''' 
-    isNoisy_list = compute_noiseratio(dataloader)
+    isNoisy_list = compute_noiseratio(dataloader, census=census)
     r_stats = []
     
     tp = isNoisy_list[selected_idx].sum()
@@ -47,49 +185,211 @@ def return_statistics(dataloader, selected_idx):
     return r_stats[0], r_stats[1], r_stats[2], r_stats[3], r_stats[4], r_stats[5]
     
     
-def get_features(model, dataloader):
+def get_census(model, dataloader):
     '''
-    Concatenate the hidden features and corresponding labels 
+    One inference pass collecting everything the selection strategies and statistics read:
+    hidden features, logits, per-sample cross-entropy loss, max-softmax confidence, labels and ground-truth labels,
+    in buffers preallocated for the whole dataset and addressed by the sample indices
+    
+    return dict of arrays with the keys features, logits, loss, confidence, labels, labels_gt
     '''
-    labels = np.empty((0,))
+    buffer = IndexedBuffer(len(dataloader.dataset))
+    device = get_device()
 
     model.eval()
-    model.cuda()
-    with tqdm(dataloader) as progress:
-        for batch_idx, (data, label, _, _) in enumerate(progress):
-            data, label = data.cuda(), label.long()
-            feature, _ = model(data)
+    model.to(device)
+    with torch.no_grad(), tqdm(dataloader) as progress:
+        for batch_idx, (data, label, index, label_gt) in enumerate(progress):
+            data, label = data.to(device, non_blocking=True), label.long().to(device)
+            feature, prediction = model(data)
+            
+            loss = torch.nn.CrossEntropyLoss(reduction='none')(prediction, label)
+            confidence, _ = torch.max(torch.nn.functional.softmax(prediction, dim=1), dim=1)
+            
+            buffer.put(index, features=feature, logits=prediction, loss=loss, confidence=confidence,
+                       labels=label, labels_gt=torch.as_tensor(label_gt).long())
+    # rows never written would enter the selection and its statistics as zero features of class 0
+    buffer.check_complete()
+    
+    return {name: buffer.get(name) for name in ['features', 'logits', 'loss', 'confidence', 'labels', 'labels_gt']}
 
-            labels = np.concatenate((labels, label.cpu()))
-            if batch_idx == 0:
-                features = feature.detach().cpu()
-            else:
-                features = np.concatenate((features, feature.detach().cpu()), axis=0)
+def get_features(model, dataloader, census=None):
+    '''
+    The hidden features and corresponding labels, read from the census
+    '''
+    if census is None:
+        census = get_census(model, dataloader)
     
-    return features, labels
+    return census['features'], census['labels']
 
-def cleansing_loss(model, dataloader):
+def get_gram_statistics(model, dataloader, mask=None):
+    '''
+    Accumulate the class-wise sufficient statistics (X^T X, sum, count) of the hidden features
+    batch by batch, so the N x d feature matrix is never held in memory.
+    mask: boolean array over the sample indices, only the masked samples are accumulated
+    '''
+    grams, sums, counts = {}, {}, {}
+    device = get_device()
+
+    model.eval()
+    model.to(device)
+    with tqdm(dataloader) as progress:
+        for batch_idx, (data, label, index, _) in enumerate(progress):
+            data, label = data.to(device, non_blocking=True), label.long().to(device)
+            feature, _ = model(data)
+            feature = feature.detach().double()
+            
+            if mask is not None:
+                keep = torch.from_numpy(mask[_check_index(index, len(mask))]).to(device)
+                feature, label = feature[keep], label[keep]
+            
+            for cls in label.unique().tolist():
+                feat = feature[label==cls]
+                if cls not in grams:
+                    grams[cls] = torch.zeros(feat.shape[1], feat.shape[1], dtype=feat.dtype, device=feat.device)
+                    sums[cls] = torch.zeros(feat.shape[1], dtype=feat.dtype, device=feat.device)
+                    counts[cls] = 0
+                grams[cls] += feat.T @ feat
+                sums[cls] += feat.sum(dim=0)
+                counts[cls] += len(feat)
     
-    loss_list = np.empty((0,))
-    labels = np.empty((0,))
+    grams = {cls: gram.cpu().numpy() for cls, gram in grams.items()}
+    sums = {cls: s.cpu().numpy() for cls, s in sums.items()}
+    return grams, sums, counts
+
+def get_streaming_score(model, dataloader, vector_dict, normalization=True):
+    '''
+    Score every sample against its class vector while the dataloader runs,
+    keeping only one score per sample instead of the hidden features.
+    Every label must have a vector in vector_dict
+    '''
+    device = get_device()
+    classes = np.array(sorted(vector_dict.keys()))
+    vectors = torch.from_numpy(np.stack([vector_dict[cls] for cls in classes])).float().to(device)
+    # row of every class in vectors, -1 for the classes without a vector
+    class_rows = np.full(classes.max() + 1, -1, dtype=np.int64)
+    class_rows[classes] = np.arange(len(classes))
+    buffer = IndexedBuffer(len(dataloader.dataset))
+
     model.eval()
-    model.cuda()
+    model.to(device)
     with tqdm(dataloader) as progress:
-        for batch_idx, (data, label, _, _) in enumerate(progress):
-            data, label = data.cuda(), label.long().cuda()
-            _, prediction = model(data)
+        for batch_idx, (data, label, index, _) in enumerate(progress):
+            data, label = data.to(device, non_blocking=True), label.long()
+            feature, _ = model(data)
+            feature = feature.detach().float()
+            if normalization:
+                feature = feature / feature.norm(dim=1, keepdim=True)
             
-            loss = torch.nn.CrossEntropyLoss(reduction='none')(prediction, label)
+            rows = class_rows[np.minimum(label.numpy(), len(class_rows) - 1)]
+            missing = (rows < 0) | (label.numpy() >= len(class_rows))
+            if missing.any():
+                raise KeyError('no class vector for the labels %s' % np.unique(label.numpy()[missing]).tolist())
+            rows = torch.from_numpy(rows).to(device)
+            score = (vectors[rows] * feature).sum(dim=1).abs()
             
-            loss_list = np.concatenate((loss_list, loss.detach().cpu()))
-            labels = np.concatenate((labels, label.detach().cpu()))
+            buffer.put(index, scores=score, labels=label)
+    buffer.check_complete()
+    
+    return buffer.get('scores'), buffer.get('labels')
 
-    kmeans = cluster.KMeans(n_clusters=2, random_state=0).fit(loss_list.reshape(-1, 1))
-    if np.mean(loss_list[kmeans.labels_==0]) > np.mean(loss_list[kmeans.labels_==1]): kmeans.labels_ = 1 - kmeans.labels_
-        
+def cleansing_loss(model, dataloader, census=None):
+    '''
+    Divide the samples by the two-means split of their per-sample loss, read from the census
+    '''
+    if census is None:
+        census = get_census(model, dataloader)
+
+    loss_list, labels = census['loss'], census['labels']
+    noisy = split_two_means(loss_list, np.array([0, len(loss_list)]))
     indexes = np.array(range(len(labels)))
 
-    return np.array(indexes[kmeans.labels_ == 0], dtype=np.int64), labels
+    return np.array(indexes[~noisy], dtype=np.int64), labels
+
+def split_two_means(x, offsets):
+    '''
+    Exact two-means clustering of one-dimensional values, for every segment at once
+    x: values sorted by segment (class), segment c is x[offsets[c]:offsets[c+1]] and is not empty
+    offsets: segment boundaries
+    
+    return boolean mask of the samples in the cluster with the larger mean
+    In 1-D the optimal split is a threshold on the sorted values, so every split point
+    is scored from prefix sums and the best one is taken per segment.
+    dividemix/svd_classifier.py keeps a copy, keep the two in sync.
+    '''
+    x = np.asarray(x, dtype=np.float64)
+    if len(x) == 0:
+        return np.zeros(0, dtype=bool)
+    counts, starts = np.diff(offsets), offsets[:-1]
+    seg = np.repeat(np.arange(len(counts)), counts)
+    
+    # sort inside every segment and center it for numerical stability
+    sorted_x = x[np.lexsort((x, seg))]
+    centered = sorted_x - (np.add.reduceat(sorted_x, starts) / counts)[seg]
+    
+    # prefix sums restarted at every segment; a split after position i keeps [start, i] on the left
+    csum = np.cumsum(centered)
+    left_sum = csum - np.concatenate(([0.], csum))[starts][seg]
+    total = left_sum[offsets[1:] - 1][seg]
+    n_left = np.arange(len(x)) - starts[seg] + 1
+    n_right = counts[seg] - n_left
+    
+    # between-cluster term to maximize, only defined between two distinct values
+    valid = np.append(sorted_x[1:] > sorted_x[:-1], False) & (n_right > 0)
+    gain = np.where(valid, left_sum ** 2 / n_left + (total - left_sum) ** 2 / np.maximum(n_right, 1), -np.inf)
+    best = np.flatnonzero(valid & (gain == np.maximum.reduceat(gain, starts)[seg]))
+    _, first = np.unique(seg[best], return_index=True)
+    best = best[first]
+    
+    # segments without two distinct values stay in one cluster
+    threshold = np.full(len(counts), np.inf)
+    threshold[seg[best]] = sorted_x[best]
+    return x > threshold[seg]
+
+def class_parallel_map(func, features, class_index, kwargs_list, n_jobs, blas_threads=1, chunk_size=65536):
+    '''
+    Apply func(class_features, **kwargs) to every class of class_index in a pool of n_jobs processes.
+    The features are written once, class-sorted, into a memory-mapped .npy file (in /dev/shm when available)
+    that every worker maps read-only, so the feature matrix is never pickled.
+    The workers are forked from a fork server, never from this process: forking a process that already runs CUDA
+    or OpenMP threads can hang the child. func must be importable (a module-level function).
+    The BLAS and torch threads of every worker are capped at blas_threads by its initializer (threadpoolctl),
+    to avoid oversubscription; the environment of this process is left alone, other threads keep running in it.
+    
+    return the results in the order of class_index.classes
+    '''
+    features = np.asarray(features)
+    tmp_dir = '/dev/shm' if os.path.isdir('/dev/shm') else None
+    fd, path = tempfile.mkstemp(suffix='.npy', dir=tmp_dir)
+    os.close(fd)
+    try:
+        shared = np.lib.format.open_memmap(path, mode='w+', dtype=features.dtype, shape=features.shape)
+        for start in range(0, len(features), chunk_size):
+            shared[start:start+chunk_size] = features[class_index.order[start:start+chunk_size]]
+        shared.flush()
+        del shared
+        
+        tasks = [(func, class_index.offsets[k], class_index.offsets[k+1], kwargs_list[k]) for k in range(len(class_index.classes))]
+        context = multiprocessing.get_context('forkserver')
+        # imported once by the fork server (started by the first pool of the process), not by every worker
+        context.set_forkserver_preload(['__main__', func.__module__])
+        with context.Pool(n_jobs, initializer=_init_class_worker, initargs=(path, blas_threads)) as pool:
+            return pool.map(_run_class_task, tasks, chunksize=1)
+    finally:
+        os.remove(path)
+
+_shared_features = None
+_blas_limits = None
+
+def _init_class_worker(path, blas_threads):
+    global _shared_features, _blas_limits
+    _blas_limits = threadpool_limits(limits=blas_threads)
+    torch.set_num_threads(blas_threads)
+    _shared_features = np.load(path, mmap_mode='r')
+
+def _run_class_task(task):
+    func, start, end, kwargs = task
+    return func(np.asarray(_shared_features[start:end]), **kwargs)
 
 def estimate_purity(f, means, covars, weights):
     '''
@@ -0,0 +1,91 @@
+# Regression tests of the batched label noise against the per-sample loops it replaced
+# run from dynamic_selection: python -m pytest -q tests
+
+import numpy as np
+import pytest
+import torch
+import torch.nn.functional as F
+
+from data_loader.noise import (CIFAR10_PAIRS, instance_noisify, noisify, pair_flip, random_pair_transition,
+                               superclass_transition, symmetric_flip)
+
+
+def multiclass_noisify(y, P, random_state=0):
+    '''
+    the original per-sample transition noise of the CIFAR-100 asym labels
+    '''
+    new_y = y.copy()
+    flipper = np.random.RandomState(random_state)
+    for idx in np.arange(y.shape[0]):
+        flipped = flipper.multinomial(1, P[y[idx], :], 1)[0]
+        new_y[idx] = np.where(flipped == 1)[0][0]
+    return new_y
+
+def symmetric_loop(labels, num_classes, percent):
+    labels, noise_indx = labels.copy(), []
+    indices = np.random.permutation(len(labels))
+    for i, idx in enumerate(indices):
+        if i < percent * len(labels):
+            noise_indx.append(idx)
+            labels[idx] = np.random.randint(num_classes, dtype=np.int32)
+    return labels, noise_indx
+
+def asymmetric_loop(labels, num_classes, percent):
+    labels, noise_indx = labels.copy(), []
+    for i in range(num_classes):
+        indices = np.where(labels == i)[0]
+        np.random.shuffle(indices)
+        for j, idx in enumerate(indices):
+            if j < percent * len(indices):
+                noise_indx.append(idx)
+                if i in CIFAR10_PAIRS:
+                    labels[idx] = CIFAR10_PAIRS[i]
+    return labels, noise_indx
+
+def instance_loop(data, labels, percent, num_classes=10):
+    labels_gt, labels = labels, labels.copy()
+    q_ = np.random.normal(loc=percent, scale=0.1, size=int(1e6))
+    q = [pro for pro in q_ if 0 < pro < 1][:len(labels)]
+    w = np.random.normal(loc=0, scale=1, size=(32*32*3, num_classes))
+    for i, sample in enumerate(data):
+        p_all = np.matmul(sample.flatten(), w)
+        p_all[labels_gt[i]] = -int(1e6)
+        p_all = q[i] * F.softmax(torch.tensor(p_all), dim=0).numpy()
+        p_all[labels_gt[i]] = 1 - q[i]
+        labels[i] = np.random.choice(np.arange(num_classes), p=p_all/sum(p_all))
+    return labels
+
+
+@pytest.mark.parametrize('num_classes, noise', [(10, 0.4), (100, 0.2), (100, 0.4)])
+def test_noisify_matches_multiclass_noisify(num_classes, noise):
+    labels = np.random.RandomState(0).randint(num_classes, size=5000)
+    for P in (superclass_transition(num_classes, noise), random_pair_transition(num_classes, noise, rng=np.random.RandomState(1))):
+        assert np.array_equal(noisify(labels, P, random_state=0), multiclass_noisify(labels, P, random_state=0))
+
+@pytest.mark.parametrize('percent', [0.2, 0.37, 0.8])
+def test_symmetric_flip_matches_loop(percent):
+    labels = np.random.RandomState(0).randint(10, size=3001)
+    np.random.seed(888)
+    expected, expected_indx = symmetric_loop(labels, 10, percent)
+    noisy, flipped = symmetric_flip(labels, 10, percent, rng=np.random.RandomState(888))
+    assert np.array_equal(noisy, expected)
+    assert flipped.tolist() == expected_indx
+
+@pytest.mark.parametrize('percent', [0.2, 0.37, 0.8])
+def test_pair_flip_matches_loop(percent):
+    labels = np.random.RandomState(0).randint(10, size=3001)
+    np.random.seed(888)
+    expected, expected_indx = asymmetric_loop(labels, 10, percent)
+    noisy, picked = pair_flip(labels, 10, percent, CIFAR10_PAIRS, rng=np.random.RandomState(888))
+    assert np.array_equal(noisy, expected)
+    assert picked.tolist() == expected_indx
+
+def test_instance_noisify_matches_loop():
+    rng = np.random.RandomState(0)
+    data = rng.randint(0, 255, size=(300, 32, 32, 3), dtype=np.uint8)
+    labels = rng.randint(10, size=300)
+    np.random.seed(888)
+    expected = instance_loop(data, labels, 0.4)
+    noisy = instance_noisify(data, labels, 0.4, random_state=888, chunk_size=64)
+    assert (noisy != labels).mean() > 0.2
+    assert np.array_equal(noisy, expected)
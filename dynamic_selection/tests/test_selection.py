@@ -0,0 +1,131 @@
+# Regression tests of the batched selection kernels against the per-class reference implementations
+# run from dynamic_selection: python -m pytest -q tests
+
+import numpy as np
+import pytest
+import torch
+from sklearn.mixture import GaussianMixture as GMM
+
+from selection.gmm import BetaMixture, fit_bmm_1d, fit_gmm_1d, fit_mixture
+from selection.util import ClassIndex, IndexedBuffer, split_two_means
+
+
+def make_segments(seed, sizes, n_classes=None):
+    '''
+    bimodal scores of classes with the given sizes, shuffled, with the labels
+    '''
+    rng = np.random.RandomState(seed)
+    scores, labels = [], []
+    for cls, n in enumerate(sizes):
+        n_clean = rng.randint(1, n) if n > 1 else n
+        scores.append(np.concatenate((rng.normal(0.8, 0.05, n_clean), rng.normal(0.3, 0.1, n - n_clean))))
+        labels.append(np.full(n, cls))
+    order = rng.permutation(sum(sizes))
+    return np.concatenate(scores)[order], np.concatenate(labels)[order]
+
+def brute_two_means(x):
+    '''
+    upper cluster of the best of all threshold splits, the first one on ties
+    '''
+    values = np.unique(x)
+    best, best_cost = np.inf, np.inf
+    for threshold in values[:-1]:
+        left, right = x[x <= threshold], x[x > threshold]
+        cost = ((left - left.mean()) ** 2).sum() + ((right - right.mean()) ** 2).sum()
+        if cost < best_cost - 1e-9:
+            best, best_cost = threshold, cost
+    return x > best
+
+
+################### ClassIndex / IndexedBuffer ###################
+
+def test_class_index_matches_per_class_loop():
+    labels = np.random.RandomState(0).choice([3, 7, 8, 11], size=500)
+    class_index = ClassIndex(labels)
+    indexes = np.arange(len(labels))
+    assert np.array_equal(class_index.classes, np.unique(labels))
+    for k, (cls, cls_index) in enumerate(class_index.items()):
+        assert np.array_equal(cls_index, indexes[labels == cls])
+        assert (class_index.rows[cls_index] == k).all()
+    x = np.random.RandomState(1).rand(len(labels))
+    assert np.array_equal(class_index.unsort(class_index.sort(x)), x)
+    assert ClassIndex.of(class_index) is class_index
+
+def test_indexed_buffer_matches_indexed_assignment():
+    size, dim = 103, 5
+    features = torch.randn(size, dim)
+    buffer = IndexedBuffer(size)
+    order = torch.randperm(size)
+    for batch in order.split(16):
+        buffer.put(batch.numpy(), features=features[batch], labels=batch)
+    buffer.check_complete()
+    assert np.array_equal(buffer.get('features'), features.numpy())
+    assert np.array_equal(buffer.get('labels'), np.arange(size))
+
+def test_indexed_buffer_rejects_missing_and_invalid_indices():
+    buffer = IndexedBuffer(10)
+    buffer.put(np.arange(9), x=torch.zeros(9))
+    with pytest.raises(RuntimeError):
+        buffer.check_complete()
+    with pytest.raises(IndexError):
+        buffer.put(np.array([10]), x=torch.zeros(1))
+
+
+################### split_two_means ###################
+
+@pytest.mark.parametrize('seed', range(5))
+def test_split_two_means_matches_brute_force(seed):
+    rng = np.random.RandomState(seed)
+    sizes = [1, 2, 3, 17, 40]
+    # continuous values, ties, and a constant segment
+    segments = [rng.rand(n) if i % 2 else np.round(rng.rand(n), 1) for i, n in enumerate(sizes)] + [np.full(6, 0.5)]
+    x = np.concatenate(segments)
+    offsets = np.concatenate(([0], np.cumsum([len(s) for s in segments])))
+    upper = split_two_means(x, offsets)
+    for c, s in enumerate(segments):
+        assert np.array_equal(upper[offsets[c]:offsets[c+1]], brute_two_means(s)), c
+
+
+################### Gaussian mixture ###################
+
+# sklearn initializes from Lloyd's k-means, which finds the exact 1-D split on these separated segments;
+# the EM that follows is the same, so the posteriors agree to rounding
+@pytest.mark.parametrize('seed', range(3))
+def test_fit_gmm_1d_matches_sklearn(seed):
+    scores, labels = make_segments(seed, [12, 30, 57, 200])
+    class_index = ClassIndex(labels)
+    x = class_index.sort(scores)
+    prob = fit_gmm_1d(x, class_index.offsets, tol=1e-6, max_iter=100)
+    for k in range(len(class_index.classes)):
+        segment = x[class_index.offsets[k]:class_index.offsets[k+1]].reshape(-1, 1)
+        gmm = GMM(n_components=2, covariance_type='full', tol=1e-6, max_iter=100, random_state=0).fit(segment)
+        expected = gmm.predict_proba(segment)[:, gmm.means_.argmax()]
+        np.testing.assert_allclose(prob[class_index.offsets[k]:class_index.offsets[k+1]], expected, atol=1e-8)
+
+def test_fit_mixture_matches_per_class_loop():
+    scores, labels = make_segments(3, [25, 60, 80])
+    clean_labels, prob = fit_mixture(scores, labels, p_threshold=0.5, return_prob=True)
+    expected, indexes = [], np.arange(len(scores))
+    for cls in np.unique(labels):
+        feats = scores[labels == cls].reshape(-1, 1)
+        gmm = GMM(n_components=2, covariance_type='full', tol=1e-6, max_iter=100, random_state=0).fit(feats)
+        p = gmm.predict_proba(feats)[:, gmm.means_.argmax()]
+        np.testing.assert_allclose(prob[labels == cls], p, atol=1e-8)
+        expected += list(indexes[labels == cls][p > 0.5])
+    assert np.array_equal(np.sort(clean_labels), np.sort(expected))
+
+
+################### Beta mixture ###################
+
+def test_fit_bmm_1d_matches_beta_mixture():
+    scores, labels = make_segments(4, [15, 40, 120])
+    class_index = ClassIndex(labels)
+    x = class_index.sort(scores)
+    low, high = np.minimum.reduceat(x, class_index.offsets[:-1]), np.maximum.reduceat(x, class_index.offsets[:-1])
+    x = (x - low[class_index.segment]) / (high - low)[class_index.segment]
+    alphas, betas, weights = fit_bmm_1d(x, class_index.offsets, max_iter=100)
+    for k in range(len(class_index.classes)):
+        bmm = BetaMixture(max_iters=100).fit(x[class_index.offsets[k]:class_index.offsets[k+1]])
+        np.testing.assert_allclose(alphas[k], bmm.alphas, rtol=1e-6)
+        np.testing.assert_allclose(betas[k], bmm.betas, rtol=1e-6)
+        np.testing.assert_allclose(weights[k], bmm.weight, rtol=1e-6)
@@ -8,6 +8,7 @@ from selection.util import *
 import data_loader.data_loaders as module_data
 
 import copy
+import time
 import numpy as np
 import torch
 import torch.nn as nn
@@ -77,8 +78,16 @@ class FCoteachingTrainer(BaseTrainer):
             self.data_loader = inf_loop(data_loader)
             self.len_epoch = len_epoch
             self.len_epoch_1 = self.len_epoch_2 = self.len_epoch
-        self.dynamic_train_data_loader_1 = copy.deepcopy(data_loader)
-        self.dynamic_train_data_loader_2 = copy.deepcopy(data_loader)
+        if parse.persistent_loader:
+            # one loader with persistent workers per model for the whole run, re-selection swaps their sampler indices;
+            # copies of data_loader, so the epochs before the first selection see the same split and pipeline
+            self.dynamic_train_data_loader_1, self.dynamic_train_data_loader_2 = [data_loader.persistent_copy() for _ in range(2)]
+        else:
+            # update_dataloader rebinds fresh loaders and never mutates this one
+            self.dynamic_train_data_loader_1 = self.dynamic_train_data_loader_2 = data_loader
+        # end of the last selection round, for the latency to the first batch of the next epoch
+        self.selection_end = None
+        self.swap_latency = None
         self.valid_data_loader = valid_data_loader
         
         self.orig_data_loader = getattr(module_data, self.config['data_loader']['type'])(
@@ -111,8 +120,10 @@ class FCoteachingTrainer(BaseTrainer):
     def update_dataloader(self, epoch):
         
         with torch.no_grad():
-            current_features_1, current_labels_1 = get_features(self.model_1, self.orig_data_loader)
-            current_features_2, current_labels_2 = get_features(self.model_2, self.orig_data_loader)
+            census_1 = get_census(self.model_1, self.orig_data_loader)
+            census_2 = get_census(self.model_2, self.orig_data_loader)
+            current_features_1, current_labels_1 = get_features(self.model_1, self.orig_data_loader, census=census_1)
+            current_features_2, current_labels_2 = get_features(self.model_2, self.orig_data_loader, census=census_2)
             datanum = len(current_labels_1)
             
             if self.teacher_idx_1 is not None:
@@ -122,33 +133,40 @@ class FCoteachingTrainer(BaseTrainer):
                 prev_features_1, prev_labels_1 = current_features_1, current_labels_1
                 prev_features_2, prev_labels_2 = current_features_2, current_labels_2
                 
-            self.teacher_idx_1 = fine(current_features_2, current_labels_2, fit=self.parse.distill_mode, prev_features=prev_features_2, prev_labels=prev_labels_2)
-            self.teacher_idx_2 = fine(current_features_1, current_labels_1, fit=self.parse.distill_mode, prev_features=prev_features_1, prev_labels=prev_labels_1)
+            self.teacher_idx_1 = fine(current_features_2, current_labels_2, fit=self.parse.distill_mode, prev_features=prev_features_2, prev_labels=prev_labels_2, solver=self.parse.solver, n_jobs=self.parse.selection_jobs)
+            self.teacher_idx_2 = fine(current_features_1, current_labels_1, fit=self.parse.distill_mode, prev_features=prev_features_1, prev_labels=prev_labels_1, solver=self.parse.solver, n_jobs=self.parse.selection_jobs)
             
-        curr_data_loader_1 = getattr(module_data, self.config['data_loader']['type'])(
-            self.config['data_loader']['args']['data_dir'],
-            batch_size=self.config['data_loader']['args']['batch_size'],
-            shuffle=self.config['data_loader']['args']['shuffle'],
-            validation_split=0.1,
-            num_batches=self.config['data_loader']['args']['num_batches'],
-            training=True,
-            num_workers=self.config['data_loader']['args']['num_workers'],
-            pin_memory=self.config['data_loader']['args']['pin_memory'],
-            teacher_idx=self.teacher_idx_1)
-        
-        curr_data_loader_2 = getattr(module_data, self.config['data_loader']['type'])(
-            self.config['data_loader']['args']['data_dir'],
-            batch_size=self.config['data_loader']['args']['batch_size'],
-            shuffle=self.config['data_loader']['args']['shuffle'],
-            validation_split=0.1,
-            num_batches=self.config['data_loader']['args']['num_batches'],
-            training=True,
-            num_workers=self.config['data_loader']['args']['num_workers'],
-            pin_memory=self.config['data_loader']['args']['pin_memory'],
-            teacher_idx=self.teacher_idx_2)
+        self.selected, self.precision, self.recall, self.f1, self.specificity, self.accuracy = return_statistics(self.orig_data_loader, self.teacher_idx_1, census=census_1)
+        self.selected, self.precision, self.recall, self.f1, self.specificity, self.accuracy = return_statistics(self.orig_data_loader, self.teacher_idx_2, census=census_2)
         
-        self.selected, self.precision, self.recall, self.f1, self.specificity, self.accuracy = return_statistics(self.orig_data_loader, self.teacher_idx_1)
-        self.selected, self.precision, self.recall, self.f1, self.specificity, self.accuracy = return_statistics(self.orig_data_loader, self.teacher_idx_2)
+        # the loader swaps (or rebuilds) below count towards the latency to the next first batch
+        self.selection_end = time.time()
+        if self.parse.persistent_loader:
+            curr_data_loader_1, curr_data_loader_2 = self.dynamic_train_data_loader_1, self.dynamic_train_data_loader_2
+            curr_data_loader_1.set_active_indices(self.teacher_idx_1)
+            curr_data_loader_2.set_active_indices(self.teacher_idx_2)
+        else:
+            curr_data_loader_1 = getattr(module_data, self.config['data_loader']['type'])(
+                self.config['data_loader']['args']['data_dir'],
+                batch_size=self.config['data_loader']['args']['batch_size'],
+                shuffle=self.config['data_loader']['args']['shuffle'],
+                validation_split=0.1,
+                num_batches=self.config['data_loader']['args']['num_batches'],
+                training=True,
+                num_workers=self.config['data_loader']['args']['num_workers'],
+                pin_memory=self.config['data_loader']['args']['pin_memory'],
+                teacher_idx=self.teacher_idx_1)
+            
+            curr_data_loader_2 = getattr(module_data, self.config['data_loader']['type'])(
+                self.config['data_loader']['args']['data_dir'],
+                batch_size=self.config['data_loader']['args']['batch_size'],
+                shuffle=self.config['data_loader']['args']['shuffle'],
+                validation_split=0.1,
+                num_batches=self.config['data_loader']['args']['num_batches'],
+                training=True,
+                num_workers=self.config['data_loader']['args']['num_workers'],
+                pin_memory=self.config['data_loader']['args']['pin_memory'],
+                teacher_idx=self.teacher_idx_2)
         
         return curr_data_loader_1, curr_data_loader_2
         
@@ -179,12 +197,10 @@ class FCoteachingTrainer(BaseTrainer):
             self.dynamic_train_data_loader_1, self.dynamic_train_data_loader_2 = self.update_dataloader(epoch)
             self.len_epoch_1 = len(self.dynamic_train_data_loader_1)
             self.len_epoch_2 = len(self.dynamic_train_data_loader_2)
-            self.purity_1 = (self.dynamic_train_data_loader_1.train_dataset.train_labels == \
-                             self.dynamic_train_data_loader_1.train_dataset.train_labels_gt).sum() / \
-                            len(self.dynamic_train_data_loader_1.train_dataset)
-            self.purity_2 = (self.dynamic_train_data_loader_2.train_dataset.train_labels == \
-                             self.dynamic_train_data_loader_2.train_dataset.train_labels_gt).sum() / \
-                            len(self.dynamic_train_data_loader_2.train_dataset)
+            labels_1, labels_gt_1 = self.dynamic_train_data_loader_1.active_labels()
+            labels_2, labels_gt_2 = self.dynamic_train_data_loader_2.active_labels()
+            self.purity_1 = (labels_1 == labels_gt_1).sum() / len(labels_1)
+            self.purity_2 = (labels_2 == labels_gt_2).sum() / len(labels_2)
             
 #         if epoch > 30:
 #             self.train_criterion = CCELoss()
@@ -198,6 +214,9 @@ class FCoteachingTrainer(BaseTrainer):
         with tqdm(self.dynamic_train_data_loader_1) as progress:
             for batch_idx, (data, label, indexs, gt) in enumerate(progress):
                 progress.set_description_str(f'Train epoch {epoch}')
+                if batch_idx == 0 and self.selection_end is not None:
+                    self.swap_latency = time.time() - self.selection_end
+                    self.selection_end = None
                 
                 data, label = data.to(self.device), label.long().to(self.device)
                 gt = gt.long().to(self.device)
@@ -255,6 +274,8 @@ class FCoteachingTrainer(BaseTrainer):
                 if batch_idx == self.len_epoch_2:
                     break
 
+        labels_1, labels_gt_1 = self.dynamic_train_data_loader_1.active_labels()
+        labels_2, labels_gt_2 = self.dynamic_train_data_loader_2.active_labels()
         log = {
             'loss_1': total_loss_1 / self.len_epoch,
             'loss_2': total_loss_2 / self.len_epoch,
@@ -263,11 +284,13 @@ class FCoteachingTrainer(BaseTrainer):
             'metrics_2': (total_metrics_2 / self.len_epoch).tolist(),
             'metrics_gt_2': (total_metrics_gt_2 / self.len_epoch).tolist(),
             'learning rate': self.lr_scheduler_1.get_last_lr(),
-            'purity_1:': '{} = {}/{}'.format(self.purity_1, (self.dynamic_train_data_loader_1.train_dataset.train_labels == \
-                   self.dynamic_train_data_loader_1.train_dataset.train_labels_gt).sum(), len(self.dynamic_train_data_loader_1.train_dataset)),
-            'purity_2:': '{} = {}/{}'.format(self.purity_2, (self.dynamic_train_data_loader_2.train_dataset.train_labels == \
-                   self.dynamic_train_data_loader_2.train_dataset.train_labels_gt).sum(), len(self.dynamic_train_data_loader_2.train_dataset))
+            'purity_1:': '{} = {}/{}'.format(self.purity_1, (labels_1 == labels_gt_1).sum(), len(labels_1)),
+            'purity_2:': '{} = {}/{}'.format(self.purity_2, (labels_2 == labels_gt_2).sum(), len(labels_2))
         }
+        if self.swap_latency is not None:
+            # seconds from the end of the selection round to the first batch of this epoch
+            log['swap_latency'] = self.swap_latency
+            self.swap_latency = None
 
 
         if self.do_validation:
@@ -8,6 +8,8 @@ from selection.util import *
 import data_loader.data_loaders as module_data
 
 import copy
+import time
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import torch
 from tqdm import tqdm
@@ -42,7 +44,16 @@ class DynamicTrainer(BaseTrainer):
             # iteration-based training
             self.data_loader = inf_loop(data_loader)
             self.len_epoch = len_epoch
-        self.dynamic_train_data_loader = copy.deepcopy(data_loader)
+        if parse.persistent_loader:
+            # one loader with persistent workers for the whole run, re-selection swaps its sampler indices;
+            # a copy of data_loader, so the epochs before the first selection see the same split and pipeline
+            self.dynamic_train_data_loader = data_loader.persistent_copy()
+        else:
+            # update_dataloader rebinds a fresh loader and never mutates this one
+            self.dynamic_train_data_loader = data_loader
+        # end of the last selection round, for the latency to the first batch of the next epoch
+        self.selection_end = None
+        self.swap_latency = None
         self.valid_data_loader = valid_data_loader
         
         self.warm_up = parse.warmup
@@ -57,6 +68,19 @@ class DynamicTrainer(BaseTrainer):
             training=True,
             num_workers=self.config['data_loader']['args']['num_workers'],
             pin_memory=self.config['data_loader']['args']['pin_memory'])
+        # --async_selection: the background feature pass reads in its own thread, without worker processes, as
+        # forking them from that thread while CUDA runs in the main one can deadlock the workers
+        self.selection_data_loader = None
+        if parse.async_selection:
+            self.selection_data_loader = getattr(module_data, self.config['data_loader']['type'])(
+                self.config['data_loader']['args']['data_dir'],
+                batch_size=self.config['data_loader']['args']['batch_size'],
+                shuffle=False,
+                validation_split=0.1,
+                num_batches=self.config['data_loader']['args']['num_batches'],
+                training=True,
+                num_workers=0,
+                pin_memory=self.config['data_loader']['args']['pin_memory'])
         
         if teacher != None:
             self.teacher = teacher.to(self.device)
@@ -74,45 +98,151 @@ class DynamicTrainer(BaseTrainer):
         self.purity = (data_loader.train_dataset.train_labels == \
                        data_loader.train_dataset.train_labels_gt).sum() / len(data_loader.train_dataset)
         self.teacher_idx = None
+        # class-wise vectors of the last selection round, used to warm-start the eigen solver
+        self.vector_dict = None
+        # --async_selection: selection rounds run in one background thread, (snapshot epoch, future) of the running one
+        self.selection_executor = ThreadPoolExecutor(max_workers=1) if parse.async_selection else None
+        self.pending_selection = None
+        self.selection_time = None
+        self.selection_staleness = None
+        # selection epochs passed while the previous round was still running
+        self.selection_skipped = 0
         #Visdom visualization
         
         self.entropy = entropy
         if self.entropy: self.entro_loss = Entropy(threshold)
             
             
-    def update_dataloader(self, epoch):
-        
+    def select(self, model, prev_idx, vector_dict, data_loader=None):
+        '''
+        one FINE selection round of model over data_loader (orig_data_loader by default), from the previous teacher_idx
+        and class-wise vectors; returns the new teacher_idx, the new vectors and the selection statistics
+        '''
+        data_loader = self.orig_data_loader if data_loader is None else data_loader
+        census = None
         with torch.no_grad():
-            current_features, current_labels = get_features(self.model, self.orig_data_loader)
-            datanum = len(current_labels)
-            if self.teacher_idx is not None:
-                prev_features, prev_labels = current_features[self.teacher_idx], current_labels[self.teacher_idx]
+            if self.parse.streaming:
+                prev_mask = None
+                if prev_idx is not None:
+                    prev_mask = np.zeros(len(data_loader.train_dataset), dtype=bool)
+                    prev_mask[prev_idx] = True
+                teacher_idx, vector_dict = fine_streaming(model, data_loader, fit=self.parse.distill_mode, prev_mask=prev_mask, p_threshold=self.parse.zeta, solver=self.parse.solver,
+                                                          init_vectors=vector_dict, return_vectors=True)
             else:
-                prev_features, prev_labels = current_features, current_labels
-                
+                census = get_census(model, data_loader)
+                current_features, current_labels = get_features(model, data_loader, census=census)
+                datanum = len(current_labels)
+                if prev_idx is not None:
+                    prev_features, prev_labels = current_features[prev_idx], current_labels[prev_idx]
+                else:
+                    prev_features, prev_labels = current_features, current_labels
+                    
 
-#             if epoch > 10:
-            self.teacher_idx = fine(current_features, current_labels, fit=self.parse.distill_mode, prev_features=prev_features, prev_labels=prev_labels, p_threshold=self.parse.zeta)
+#                 if epoch > 10:
+                teacher_idx, vector_dict = fine(current_features, current_labels, fit=self.parse.distill_mode, prev_features=prev_features, prev_labels=prev_labels, p_threshold=self.parse.zeta, solver=self.parse.solver, n_jobs=self.parse.selection_jobs,
+                                                init_vectors=vector_dict, return_vectors=True)
 #             else:
 #                 self.teacher_idx = np.arange(datanum)
 #                 same_topk_index(orig_label, orig_out, prev_label, prev_out, np.clip((epoch-1) * 0.01, 0., 0.72))
             
             
-        curr_data_loader = getattr(module_data, self.config['data_loader']['type'])(
-            self.config['data_loader']['args']['data_dir'],
-            batch_size=self.config['data_loader']['args']['batch_size'],
-            shuffle=self.config['data_loader']['args']['shuffle'],
-            validation_split=0.1,
-            num_batches=self.config['data_loader']['args']['num_batches'],
-            training=True,
-            num_workers=self.config['data_loader']['args']['num_workers'],
-            pin_memory=self.config['data_loader']['args']['pin_memory'],
-            teacher_idx=self.teacher_idx)
+        stats = return_statistics(data_loader, teacher_idx, census=census)
+        return teacher_idx, vector_dict, stats
+
+    def swap_dataloader(self, teacher_idx, vector_dict, stats):
+        '''
+        make teacher_idx the selected subset: the loader of the next epochs serves it
+        '''
+        self.teacher_idx, self.vector_dict = teacher_idx, vector_dict
+        self.selected, self.precision, self.recall, self.f1, self.specificity, self.accuracy = stats
         
-        self.selected, self.precision, self.recall, self.f1, self.specificity, self.accuracy = return_statistics(self.orig_data_loader, self.teacher_idx)
+        # the loader swap (or rebuild) below counts towards the latency to the next first batch
+        self.selection_end = time.time()
+        if self.parse.persistent_loader:
+            curr_data_loader = self.dynamic_train_data_loader
+            curr_data_loader.set_active_indices(self.teacher_idx)
+        else:
+            curr_data_loader = getattr(module_data, self.config['data_loader']['type'])(
+                self.config['data_loader']['args']['data_dir'],
+                batch_size=self.config['data_loader']['args']['batch_size'],
+                shuffle=self.config['data_loader']['args']['shuffle'],
+                validation_split=0.1,
+                num_batches=self.config['data_loader']['args']['num_batches'],
+                training=True,
+                num_workers=self.config['data_loader']['args']['num_workers'],
+                pin_memory=self.config['data_loader']['args']['pin_memory'],
+                teacher_idx=self.teacher_idx)
         
         return curr_data_loader
-        
+
+    def update_dataloader(self, epoch):
+        return self.swap_dataloader(*self.select(self.model, self.teacher_idx, self.vector_dict))
+
+    def _select_snapshot(self, snapshot, prev_idx, vector_dict, stream):
+        # background thread: the feature pass runs on its own CUDA stream, next to the training kernels
+        start = time.time()
+        if stream is not None:
+            with torch.cuda.stream(stream):
+                result = self.select(snapshot, prev_idx, vector_dict, self.selection_data_loader)
+        else:
+            result = self.select(snapshot, prev_idx, vector_dict, self.selection_data_loader)
+        return result, time.time() - start
+
+    def pipeline_selection(self, epoch):
+        '''
+        --async_selection: at this epoch boundary, swap in the result of a finished background round, and on selection
+        epochs start a new round on a snapshot of the current weights while training goes on with the previous teacher_idx.
+        Returns whether a new subset was swapped in.
+        '''
+        swapped = False
+        if self.pending_selection is not None and self.pending_selection[1].done():
+            snapshot_epoch, future = self.pending_selection
+            self.pending_selection = None
+            result, self.selection_time = future.result()
+            self.dynamic_train_data_loader = self.swap_dataloader(*result)
+            # epochs trained since the weights the subset was selected with
+            self.selection_staleness = epoch - snapshot_epoch
+            swapped = True
+
+        if epoch % self.every == 1 and epoch > self.warm_up and self.pending_selection is not None:
+            # the round of an earlier selection epoch takes longer than every epochs: this selection epoch is dropped
+            self.selection_skipped += 1
+            self.logger.warning('selection of epoch {} skipped: the round of epoch {} is still running'.format(
+                epoch, self.pending_selection[0]))
+        elif epoch % self.every == 1 and epoch > self.warm_up:
+            snapshot = copy.deepcopy(self.model)
+            stream = None
+            if self.device.type == 'cuda':
+                stream = torch.cuda.Stream(self.device)
+                # the copy above was queued on the training stream
+                stream.wait_stream(torch.cuda.current_stream(self.device))
+            future = self.selection_executor.submit(self._select_snapshot, snapshot, self.teacher_idx, self.vector_dict, stream)
+            self.pending_selection = (epoch, future)
+        return swapped
+
+    def finish_selection(self):
+        '''
+        --async_selection: after the last epoch, wait for the round still running and keep its teacher_idx and statistics;
+        no epoch is left to train on them
+        '''
+        if self.pending_selection is None:
+            return
+        snapshot_epoch, future = self.pending_selection
+        self.pending_selection = None
+        (self.teacher_idx, self.vector_dict, stats), self.selection_time = future.result()
+        self.selected, self.precision, self.recall, self.f1, self.specificity, self.accuracy = stats
+        self.logger.info('selection of epoch {} finished after the last epoch: {} selected in {:.1f}s'.format(
+            snapshot_epoch, self.selected, self.selection_time))
+
+    def train(self):
+        try:
+            super().train()
+        finally:
+            if self.selection_executor is not None:
+                # waits for a running round, also when training stops on an error
+                self.selection_executor.shutdown(wait=True)
+        if self.selection_executor is not None:
+            self.finish_selection()
 
     def _eval_metrics(self, output, label):
         acc_metrics = np.zeros(len(self.metrics))
@@ -136,12 +266,17 @@ class DynamicTrainer(BaseTrainer):
 
             The metrics in log must have the key 'metrics'.
         """
-        if epoch % self.every == 1 and epoch > self.warm_up: # 
-            self.dynamic_train_data_loader = self.update_dataloader(epoch)
+        epoch_start = time.time()
+        if self.selection_executor is not None:
+            swapped = self.pipeline_selection(epoch)
+        else:
+            swapped = epoch % self.every == 1 and epoch > self.warm_up
+            if swapped:
+                self.dynamic_train_data_loader = self.update_dataloader(epoch)
+        if swapped:
             self.len_epoch = len(self.dynamic_train_data_loader)
-            self.purity = (self.dynamic_train_data_loader.train_dataset.train_labels == \
-                           self.dynamic_train_data_loader.train_dataset.train_labels_gt).sum() / \
-                        len(self.dynamic_train_data_loader.train_dataset)
+            labels, labels_gt = self.dynamic_train_data_loader.active_labels()
+            self.purity = (labels == labels_gt).sum() / len(labels)
             
 #         if epoch > 30:
 #             self.train_criterion = CCELoss()
@@ -155,6 +290,9 @@ class DynamicTrainer(BaseTrainer):
         with tqdm(self.dynamic_train_data_loader) as progress:
             for batch_idx, (data, label, indexs, gt) in enumerate(progress):
                 progress.set_description_str(f'Train epoch {epoch}')
+                if batch_idx == 0 and self.selection_end is not None:
+                    self.swap_latency = time.time() - self.selection_end
+                    self.selection_end = None
                 
                 data, label = data.to(self.device), label.long().to(self.device)
                 if self.teacher:
@@ -200,14 +338,25 @@ class DynamicTrainer(BaseTrainer):
         # if hasattr(self.data_loader, 'run'):
         #     self.data_loader.run()
 
+        labels, labels_gt = self.dynamic_train_data_loader.active_labels()
         log = {
             'loss': total_loss / self.len_epoch,
             'metrics': (total_metrics / self.len_epoch).tolist(),
             'metrics_gt': (total_metrics_gt / self.len_epoch).tolist(),
             'learning rate': self.lr_scheduler.get_last_lr(),
-            'purity:': '{} = {}/{}'.format(self.purity, (self.dynamic_train_data_loader.train_dataset.train_labels == \
-                   self.dynamic_train_data_loader.train_dataset.train_labels_gt).sum(), len(self.dynamic_train_data_loader.train_dataset))
+            'purity:': '{} = {}/{}'.format(self.purity, (labels == labels_gt).sum(), len(labels))
         }
+        if self.swap_latency is not None:
+            # seconds from the end of the selection round to the first batch of this epoch
+            log['swap_latency'] = self.swap_latency
+            self.swap_latency = None
+        if self.selection_staleness is not None:
+            # seconds the background round took, and epochs its weights were behind when it was swapped in
+            log['selection_time'] = self.selection_time
+            log['selection_staleness'] = self.selection_staleness
+            self.selection_staleness = None
+        if self.selection_executor is not None:
+            log['selection_skipped'] = self.selection_skipped
 
 
         if self.do_validation:
@@ -222,7 +371,8 @@ class DynamicTrainer(BaseTrainer):
 
         if self.lr_scheduler is not None:
             self.lr_scheduler.step()
-            
+
+        log['epoch_time'] = time.time() - epoch_start
         return log
 
 
@@ -8,6 +8,7 @@ from selection.util import *
 import data_loader.data_loaders as module_data
 
 import copy
+import time
 import numpy as np
 import torch
 from tqdm import tqdm
@@ -43,7 +44,16 @@ class InstanceTrainer(BaseTrainer):
             # iteration-based training
             self.data_loader = inf_loop(data_loader)
             self.len_epoch = len_epoch
-        self.dynamic_train_data_loader = copy.deepcopy(data_loader)
+        if parse.persistent_loader:
+            # one loader with persistent workers for the whole run, re-selection swaps its sampler indices;
+            # a copy of data_loader, so the epochs before the first selection see the same split and pipeline
+            self.dynamic_train_data_loader = data_loader.persistent_copy()
+        else:
+            # update_dataloader rebinds a fresh loader and never mutates this one
+            self.dynamic_train_data_loader = data_loader
+        # end of the last selection round, for the latency to the first batch of the next epoch
+        self.selection_end = None
+        self.swap_latency = None
         self.valid_data_loader = valid_data_loader
         
         self.warm_up = parse.warmup
@@ -84,7 +94,8 @@ class InstanceTrainer(BaseTrainer):
     def update_dataloader(self, epoch):
         
         with torch.no_grad():
-            current_features, current_labels = get_features(self.model, self.orig_data_loader)
+            census = get_census(self.model, self.orig_data_loader)
+            current_features, current_labels = get_features(self.model, self.orig_data_loader, census=census)
             datanum = len(current_labels)
             if self.teacher_idx is not None:
                 prev_features, prev_labels = current_features[self.teacher_idx], current_labels[self.teacher_idx]
@@ -93,24 +104,30 @@ class InstanceTrainer(BaseTrainer):
                 
 
 #             if epoch > 10:
-            self.teacher_idx = fine(current_features, current_labels, fit=self.parse.distill_mode, prev_features=prev_features, prev_labels=prev_labels)
+            self.teacher_idx = fine(current_features, current_labels, fit=self.parse.distill_mode, prev_features=prev_features, prev_labels=prev_labels, solver=self.parse.solver, n_jobs=self.parse.selection_jobs)
 #             else:
 #                 self.teacher_idx = np.arange(datanum)
 #                 same_topk_index(orig_label, orig_out, prev_label, prev_out, np.clip((epoch-1) * 0.01, 0., 0.72))
             
             
-        curr_data_loader = getattr(module_data, self.config['data_loader']['type'])(
-            self.config['data_loader']['args']['data_dir'],
-            batch_size=self.config['data_loader']['args']['batch_size'],
-            shuffle=self.config['data_loader']['args']['shuffle'],
-            validation_split=0.1,
-            num_batches=self.config['data_loader']['args']['num_batches'],
-            training=True,
-            num_workers=self.config['data_loader']['args']['num_workers'],
-            pin_memory=self.config['data_loader']['args']['pin_memory'],
-            teacher_idx=self.teacher_idx)
+        self.selected, self.precision, self.recall, self.f1, self.specificity, self.accuracy = return_statistics(self.orig_data_loader, self.teacher_idx, census=census)
         
-        self.selected, self.precision, self.recall, self.f1, self.specificity, self.accuracy = return_statistics(self.orig_data_loader, self.teacher_idx)
+        # the loader swap (or rebuild) below counts towards the latency to the next first batch
+        self.selection_end = time.time()
+        if self.parse.persistent_loader:
+            curr_data_loader = self.dynamic_train_data_loader
+            curr_data_loader.set_active_indices(self.teacher_idx)
+        else:
+            curr_data_loader = getattr(module_data, self.config['data_loader']['type'])(
+                self.config['data_loader']['args']['data_dir'],
+                batch_size=self.config['data_loader']['args']['batch_size'],
+                shuffle=self.config['data_loader']['args']['shuffle'],
+                validation_split=0.1,
+                num_batches=self.config['data_loader']['args']['num_batches'],
+                training=True,
+                num_workers=self.config['data_loader']['args']['num_workers'],
+                pin_memory=self.config['data_loader']['args']['pin_memory'],
+                teacher_idx=self.teacher_idx)
         
         return curr_data_loader
         
@@ -140,9 +157,8 @@ class InstanceTrainer(BaseTrainer):
         if epoch % self.every == 1 and epoch > self.warm_up: # 
             self.dynamic_train_data_loader = self.update_dataloader(epoch)
             self.len_epoch = len(self.dynamic_train_data_loader)
-            self.purity = (self.dynamic_train_data_loader.train_dataset.train_labels == \
-                           self.dynamic_train_data_loader.train_dataset.train_labels_gt).sum() / \
-                        len(self.dynamic_train_data_loader.train_dataset)
+            labels, labels_gt = self.dynamic_train_data_loader.active_labels()
+            self.purity = (labels == labels_gt).sum() / len(labels)
             
 #         if epoch > 30:
 #             self.train_criterion = CCELoss()
@@ -156,6 +172,9 @@ class InstanceTrainer(BaseTrainer):
         with tqdm(self.dynamic_train_data_loader) as progress:
             for batch_idx, (data, label, indexs, gt) in enumerate(progress):
                 progress.set_description_str(f'Train epoch {epoch}')
+                if batch_idx == 0 and self.selection_end is not None:
+                    self.swap_latency = time.time() - self.selection_end
+                    self.selection_end = None
                 
                 data, label = data.to(self.device), label.long().to(self.device)
                 
@@ -208,14 +227,18 @@ class InstanceTrainer(BaseTrainer):
         # if hasattr(self.data_loader, 'run'):
         #     self.data_loader.run()
 
+        labels, labels_gt = self.dynamic_train_data_loader.active_labels()
         log = {
             'loss': total_loss / self.len_epoch,
             'metrics': (total_metrics / self.len_epoch).tolist(),
             'metrics_gt': (total_metrics_gt / self.len_epoch).tolist(),
             'learning rate': self.lr_scheduler.get_last_lr(),
-            'purity:': '{} = {}/{}'.format(self.purity, (self.dynamic_train_data_loader.train_dataset.train_labels == \
-                   self.dynamic_train_data_loader.train_dataset.train_labels_gt).sum(), len(self.dynamic_train_data_loader.train_dataset))
+            'purity:': '{} = {}/{}'.format(self.purity, (labels == labels_gt).sum(), len(labels))
         }
+        if self.swap_latency is not None:
+            # seconds from the end of the selection round to the first batch of this epoch
+            log['swap_latency'] = self.swap_latency
+            self.swap_latency = None
 
 
         if self.do_validation:
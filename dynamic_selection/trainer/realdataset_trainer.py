@@ -10,6 +10,7 @@ from sklearn.mixture import GaussianMixture
 import pdb
 import numpy as np
 import copy
+import time
 
 from selection.svd_classifier import *
 from selection.gmm import *
@@ -42,7 +43,16 @@ class RealDatasetTrainer(BaseTrainer):
             self.data_loader = inf_loop(data_loader)
             self.len_epoch = len_epoch
         self.train_data_loader = data_loader
-        self.dynamic_train_data_loader = copy.deepcopy(data_loader)
+        if parse.persistent_loader:
+            # one loader with persistent workers for the whole run, re-selection swaps its sampler indices;
+            # a copy of data_loader, so the epochs before the first selection see the same split and pipeline
+            self.dynamic_train_data_loader = data_loader.persistent_copy()
+        else:
+            # update_dataloader rebinds a fresh loader and never mutates this one
+            self.dynamic_train_data_loader = data_loader
+        # end of the last selection round, for the latency to the first batch of the next epoch
+        self.selection_end = None
+        self.swap_latency = None
         self.valid_data_loader = valid_data_loader
         
         self.warm_up = parse.warmup
@@ -67,6 +77,8 @@ class RealDatasetTrainer(BaseTrainer):
         self.val_loss_list: List[float] = []
         self.test_loss_list: List[float] = []
         self.teacher_idx = None
+        # class-wise vectors of the last selection round, used to warm-start the eigen solver
+        self.vector_dict = None
             
         # Visdom visualization
         
@@ -82,6 +94,7 @@ class RealDatasetTrainer(BaseTrainer):
 
     def update_dataloader(self, epoch):
         
+        census = None
         with torch.no_grad():
             
             self.orig_data_loader = getattr(module_data, self.config['data_loader']['type'])(
@@ -95,25 +108,37 @@ class RealDatasetTrainer(BaseTrainer):
                 pin_memory=self.config['data_loader']['args']['pin_memory']
             )
             
-            current_features, current_labels = get_features(self.model, self.orig_data_loader)
-            datanum = len(current_labels)
-            prev_features, prev_labels = current_features, current_labels
-                
-            self.teacher_idx = fine(current_features, current_labels, fit=self.parse.distill_mode, prev_features=prev_features, prev_labels=prev_labels, p_threshold=0.5, norm=True)
+            if self.parse.streaming:
+                self.teacher_idx, self.vector_dict = fine_streaming(self.model, self.orig_data_loader, fit=self.parse.distill_mode, p_threshold=0.5, norm=True, solver=self.parse.solver,
+                                                                    init_vectors=self.vector_dict, return_vectors=True)
+            else:
+                census = get_census(self.model, self.orig_data_loader)
+                current_features, current_labels = get_features(self.model, self.orig_data_loader, census=census)
+                datanum = len(current_labels)
+                prev_features, prev_labels = current_features, current_labels
+                    
+                self.teacher_idx, self.vector_dict = fine(current_features, current_labels, fit=self.parse.distill_mode, prev_features=prev_features, prev_labels=prev_labels, p_threshold=0.5, norm=True, solver=self.parse.solver, n_jobs=self.parse.selection_jobs,
+                                                          init_vectors=self.vector_dict, return_vectors=True)
             
-        curr_data_loader = getattr(module_data, self.config['data_loader']['type'])(
-            self.config['data_loader']['args']['data_dir'],
-            batch_size=self.config['data_loader']['args']['batch_size'],
-            shuffle=self.config['data_loader']['args']['shuffle'],
-            validation_split=0.0,
-            num_batches=self.config['data_loader']['args']['num_batches'],
-            training=True,
-            num_workers=self.config['data_loader']['args']['num_workers'],
-            pin_memory=self.config['data_loader']['args']['pin_memory'],
-            teacher_idx=self.teacher_idx
-        )
+        self.selected, self.precision, self.recall, self.f1, self.specificity, self.accuracy = return_statistics(self.orig_data_loader, self.teacher_idx, census=census)
         
-        self.selected, self.precision, self.recall, self.f1, self.specificity, self.accuracy = return_statistics(self.orig_data_loader, self.teacher_idx)
+        # the loader swap (or rebuild) below counts towards the latency to the next first batch
+        self.selection_end = time.time()
+        if self.parse.persistent_loader:
+            curr_data_loader = self.dynamic_train_data_loader
+            curr_data_loader.set_active_indices(self.teacher_idx)
+        else:
+            curr_data_loader = getattr(module_data, self.config['data_loader']['type'])(
+                self.config['data_loader']['args']['data_dir'],
+                batch_size=self.config['data_loader']['args']['batch_size'],
+                shuffle=self.config['data_loader']['args']['shuffle'],
+                validation_split=0.0,
+                num_batches=self.config['data_loader']['args']['num_batches'],
+                training=True,
+                num_workers=self.config['data_loader']['args']['num_workers'],
+                pin_memory=self.config['data_loader']['args']['pin_memory'],
+                teacher_idx=self.teacher_idx
+            )
         
         return curr_data_loader
     
@@ -150,6 +175,9 @@ class RealDatasetTrainer(BaseTrainer):
         with tqdm(self.dynamic_train_data_loader) as progress:
             for batch_idx, (data, label, indexs, gt) in enumerate(progress):
                 progress.set_description_str(f'Train epoch {epoch}')
+                if batch_idx == 0 and self.selection_end is not None:
+                    self.swap_latency = time.time() - self.selection_end
+                    self.selection_end = None
                 
                 data, label = data.to(self.device), label.long().to(self.device)
                 gt = gt.long().to(self.device)
@@ -184,11 +212,15 @@ class RealDatasetTrainer(BaseTrainer):
 
         log = {
             'loss': total_loss / self.len_epoch,
-            'num_train': len(self.dynamic_train_data_loader.dataset),
+            'num_train': self.dynamic_train_data_loader.num_active(),
             'metrics': (total_metrics / self.len_epoch).tolist(),
             'metrics_gt': (total_metrics_gt / self.len_epoch).tolist(),
             'learning rate': self.lr_scheduler.get_lr()
         }
+        if self.swap_latency is not None:
+            # seconds from the end of the selection round to the first batch of this epoch
+            log['swap_latency'] = self.swap_latency
+            self.swap_latency = None
 
 
         if self.do_validation:
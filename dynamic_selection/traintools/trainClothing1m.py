@@ -7,6 +7,7 @@ import torch
 import mlflow
 import mlflow.pytorch
 import data_loader.data_loaders as module_data
+from data_loader.jpeg import draft_agreement
 import loss as module_loss
 import model.metric as module_metric
 import model.model as module_arch
@@ -64,14 +65,15 @@ def trainClothing1m(parse, config: ConfigParser):
     
     # test_data_loader = None
 
-    test_data_loader = getattr(module_data, config['data_loader']['type'])(
+    test_loader = getattr(module_data, config['data_loader']['type'])(
         config['data_loader']['args']['data_dir'],
         batch_size=128,
         shuffle=False,
         validation_split=0.0,
         training=False,
         num_workers=0
-    ).split_validation()
+    )
+    test_data_loader = test_loader.split_validation()
 
     print('---------')
     # build model architecture, then print to console
@@ -210,6 +212,10 @@ def trainClothing1m(parse, config: ConfigParser):
                                     )
 
     trainer.train()
+
+    if parse.jpeg_draft_check:
+        # accuracy of the trained model on held-out images decoded at full resolution and in draft mode
+        logger.info(draft_agreement(model, test_loader.val_dataset, parse.jpeg_draft_check, draft=256))
     
     logger = config.get_logger('trainer', config['trainer']['verbosity'])
     cfg_trainer = config['trainer']
@@ -29,6 +29,7 @@ from torch.autograd import Variable
 from parse_config import ConfigParser
 from collections import OrderedDict
 from utils.MCD_utils import *
+from selection.util import get_census
 
 def str2bool(v):
     if isinstance(v, bool):
@@ -115,38 +116,14 @@ def main(parse, config: ConfigParser):
     
     model = Represent(base_model)
     
-    isNoisy_list = np.empty((0,))
-    isFalse_list = np.empty((0,))
-    label_list = np.empty((0,))
-    gt_list = np.empty((0,))
-    conf_list = np.empty((0,))
-    loss_list = np.empty((0,))
-    
     #CLK / SAME
     
-    model.eval()
+    census = get_census(base_model, data_loader)
     model.cuda()
-    loss = 0
-
-    with tqdm(data_loader) as progress:
-        for batch_idx, (data, label, index, label_gt) in enumerate(progress):
-            data = data.cuda()
-            label, label_gt = label.long().cuda(), label_gt.long().cuda()
-            output = model(data)
-            _,prediction = base_model(data)
-            loss = torch.nn.CrossEntropyLoss(reduction='none')(prediction, label)
-            confidence, _ = torch.max(torch.nn.functional.softmax(prediction, dim=1), dim=1)
-            isNoisy = label != label_gt
-
-            gt_list = np.concatenate((gt_list, label_gt.cpu()))
-            label_list = np.concatenate((label_list, label.cpu()))
-            isNoisy_list = np.concatenate((isNoisy_list, isNoisy.cpu()))
-            conf_list = np.concatenate((conf_list, confidence.detach().cpu()))
-            loss_list = np.concatenate((loss_list, loss.detach().cpu()))
-            if batch_idx == 0:
-                out_list = output.detach().cpu()
-            else:
-                out_list = np.concatenate((out_list, output.detach().cpu()), axis=0)
+    
+    out_list, label_list, gt_list = census['features'], census['labels'], census['labels_gt']
+    conf_list, loss_list = census['confidence'], census['loss']
+    isNoisy_list = (label_list != gt_list).astype(np.float64)
                 
     singular_dict, v_ortho_dict = get_singular_value_vector(label_list, out_list)
 
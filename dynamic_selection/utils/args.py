@@ -113,6 +113,29 @@ def parse_args():
                       type=float,
                       default=0.5,
                       help='hyperparameter for fine')
+    args.add_argument('--solver',
+                      type=str,
+                      default='svd',
+                      choices=['svd', 'eigh', 'power', 'lanczos'],
+                      help='eigen solver for the class-wise singular vectors of fine')
+    args.add_argument('--streaming',
+                      action='store_true',
+                      help='if true, fine accumulates class-wise Gram matrices instead of holding all features')
+    args.add_argument('--selection_jobs',
+                      type=int,
+                      default=1,
+                      help='number of processes for the class-wise decomposition of fine; 1 (default) runs it serially, '
+                           'which is faster unless several cores are free for the pool')
+    args.add_argument('--persistent_loader',
+                      action='store_true',
+                      help='if true, the selected subset is served by one loader with persistent workers whose sampler indices are swapped')
+    args.add_argument('--async_selection',
+                      action='store_true',
+                      help='if true, fine runs in the background on a weight snapshot and its subset is swapped in at the next epoch boundary')
+    args.add_argument('--jpeg_draft_check',
+                      type=int,
+                      default=0,
+                      help='after training, compare the test accuracy of full and draft JPEG decoding on this many test images (0: off)')
 
 
     # custom cli options to modify configuration from default values given in json file.